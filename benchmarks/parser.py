@@ -0,0 +1,78 @@
+"""
+Compare the reply parsers on large MGET, LRANGE and HGETALL replies:
+
+    python benchmarks/parser.py [--size 10000] [--rounds 20]
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+from redis.connection import HiredisParser, PythonParser
+from redis.utils import HIREDIS_AVAILABLE
+
+import niceredis
+from niceredis.connection import BufferParser
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--size', type=int, default=10000,
+                        help='elements per reply')
+    parser.add_argument('--value-size', type=int, default=16,
+                        help='bytes per element')
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=9)
+    return parser.parse_args()
+
+
+def setup(client, size, value_size):
+    value = 'v' * value_size
+    keys = ['bench:%d' % i for i in range(size)]
+    pipe = client.pipeline(transaction=False)
+    pipe.delete('bench:list', 'bench:hash')
+    pipe.mset(dict((key, value) for key in keys))
+    pipe.rpush('bench:list', *[value] * size)
+    pipe.hmset('bench:hash', dict((key, value) for key in keys))
+    pipe.execute()
+    return keys
+
+
+def run(parser_class, args, keys):
+    client = niceredis.StrictRedis(host=args.host, port=args.port,
+                                   db=args.db, parser_class=parser_class)
+    commands = [
+        ('MGET', lambda: client.mget(keys)),
+        ('LRANGE', lambda: client.lrange('bench:list', 0, -1)),
+        ('HGETALL', lambda: client.hgetall('bench:hash')),
+    ]
+    results = []
+    for name, command in commands:
+        command()
+        start = time.time()
+        for _ in range(args.rounds):
+            command()
+        results.append((name, (time.time() - start) / args.rounds))
+    client.connection_pool.disconnect()
+    return results
+
+
+def main():
+    args = parse_args()
+    client = niceredis.StrictRedis(host=args.host, port=args.port,
+                                   db=args.db)
+    keys = setup(client, args.size, args.value_size)
+    parsers = [PythonParser, BufferParser]
+    if HIREDIS_AVAILABLE:
+        parsers.append(HiredisParser)
+    for parser_class in parsers:
+        for name, seconds in run(parser_class, args, keys):
+            print('%-14s %-8s %8.2f ms' % (parser_class.__name__, name,
+                                           seconds * 1000))
+    client.delete('bench:list', 'bench:hash', *keys)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,8 @@
 # -*- coding: utf-8 *-*
 import datetime
-from itertools import imap, izip
+from itertools import chain, imap, izip
 
-from redis._compat import b, nativestr
+from redis._compat import b, iteritems, nativestr
 
 
 def timestamp_to_datetime(response):
@@ -139,6 +139,11 @@ def pairs_to_dict(response):
     return dict(izip(it, it))
 
 
+def map_to_pairs(response):
+    "Flatten a RESP3 map to the list of key/value pairs RESP2 sends instead"
+    return chain.from_iterable(iteritems(response))
+
+
 def pairs_to_dict_typed(response, type_info):
     it = iter(response)
     result = {}
@@ -166,6 +171,19 @@ def zset_score_pairs(response, **options):
     return list(izip(it, imap(score_cast_func, it)))
 
 
+def zset_score_pairs_resp3(response, **options):
+    """
+    Like zset_score_pairs for the [value, score] arrays RESP3 sends, the
+    scores already being floats
+    """
+    if not response or not options['withscores']:
+        return response
+    score_cast_func = options.get('score_cast_func', float)
+    if score_cast_func is float:
+        return list(imap(tuple, response))
+    return [(value, score_cast_func(score)) for value, score in response]
+
+
 def sort_return_tuples(response, **options):
     """
     If ``groups`` is specified, return the response as a list of
@@ -229,3 +247,11 @@ def parse_slowlog_get(response, **options):
         'duration': int(item[2]),
         'command': b(' ').join(item[3])
     } for item in response]
+
+
+def parse_script_result(response, **options):
+    "Pass the result of a Lua script through its ``callback`` option"
+    callback = options.get('callback')
+    if callback is None:
+        return response
+    return callback(response)
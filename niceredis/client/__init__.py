@@ -1 +1,5 @@
-from .client import Redis, StrictRedis
\ No newline at end of file
+from .client import Redis, StrictRedis
+from .cluster import RedisCluster
+from .dispatch import HandlerPool
+from .sentinel import MasterNotFoundError, SentinelClient, SlaveNotFoundError
+from .sharded import HashRing, ShardedRedis
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 *-*
+import datetime
+import hashlib
+import time as mod_time
+import uuid
+
+from redis._compat import b, iteritems
+from redis.exceptions import NoScriptError
+
+from .base import RedisBase
+from .pipeline import BasePipeline
+from .script import Script
+
+
+def _builtin_script(source):
+    # the sha of a script is known without asking the server, so pipelines
+    # only have to check the server still knows it
+    script = Script(None, source)
+    script.sha = hashlib.sha1(b(source)).hexdigest()
+    return script
+
+
+def _seconds(time):
+    if isinstance(time, datetime.timedelta):
+        time = time.seconds + time.days * 24 * 3600
+    return time
+
+
+def _milliseconds(time):
+    if isinstance(time, datetime.timedelta):
+        ms = int(time.microseconds / 1000)
+        return (time.seconds + time.days * 24 * 3600) * 1000 + ms
+    return int(time * 1000)
+
+
+COMPARE_AND_SET = _builtin_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[2])
+    return 1
+end
+return 0""")
+
+GET_AND_EXPIRE = _builtin_script("""
+local value = redis.call('GET', KEYS[1])
+if value then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return value""")
+
+LPUSH_CAPPED = _builtin_script("""
+redis.call('LPUSH', KEYS[1], unpack(ARGV, 2))
+redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+return redis.call('LLEN', KEYS[1])""")
+
+RATE_LIMIT = _builtin_script("""
+local now = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - period)
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[3]) then
+    redis.call('ZADD', KEYS[1], now, ARGV[4])
+    redis.call('PEXPIRE', KEYS[1], period)
+    return 1
+end
+return 0""")
+
+MINCRBY = _builtin_script("""
+local time = tonumber(ARGV[1])
+local result = {}
+for i, key in ipairs(KEYS) do
+    result[i] = redis.call('INCRBY', key, ARGV[i + 1])
+    if time > 0 then
+        redis.call('EXPIRE', key, time)
+    end
+end
+return result""")
+
+ZPOP_MIN = _builtin_script("""
+local items = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1,
+                         'WITHSCORES')
+if #items > 0 then
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, #items / 2 - 1)
+end
+return items""")
+
+
+class AtomicCommands(RedisBase):
+    """
+    Read-modify-write operations done by built-in Lua scripts, each in a
+    single round trip instead of a WATCH/MULTI/EXEC retry loop.
+    """
+
+    def _run_script(self, script, keys, args, **options):
+        keys_and_args = tuple(keys) + tuple(args)
+        if isinstance(self, BasePipeline):
+            self.script_load_for_pipeline(script)
+            return self.execute_command('EVALSHA', script.sha, len(keys),
+                                        *keys_and_args, **options)
+        try:
+            return self.execute_command('EVALSHA', script.sha, len(keys),
+                                        *keys_and_args, **options)
+        except NoScriptError:
+            script.sha = self.script_load(script.script)
+            return self.execute_command('EVALSHA', script.sha, len(keys),
+                                        *keys_and_args, **options)
+
+    def compare_and_set(self, name, expected, value):
+        """
+        Set the value at key ``name`` to ``value`` if its current value is
+        ``expected``. Returns a boolean indicating if the value was set.
+        """
+        return self._run_script(COMPARE_AND_SET, [name], [expected, value],
+                                callback=bool)
+
+    def get_and_expire(self, name, time):
+        """
+        Return the value at key ``name`` and set it to expire in ``time``
+        seconds, or None if the key doesn't exist. ``time`` can be
+        represented by an integer or a Python timedelta object.
+        """
+        return self._run_script(GET_AND_EXPIRE, [name], [_seconds(time)])
+
+    def lpush_capped(self, name, max_length, *values):
+        """
+        Push ``values`` onto the head of the list ``name`` and trim it to
+        its first ``max_length`` elements. Returns the length of the list.
+        """
+        return self._run_script(LPUSH_CAPPED, [name],
+                                (max_length,) + values)
+
+    def rate_limit(self, name, limit, period):
+        """
+        Count a hit in the sliding window of ``period`` seconds at key
+        ``name``. Returns True if less than ``limit`` hits were counted
+        during the last ``period``, otherwise False and the hit isn't
+        counted. ``period`` can be represented by a number or a Python
+        timedelta object.
+        """
+        now = int(mod_time.time() * 1000)
+        return self._run_script(
+            RATE_LIMIT, [name],
+            [now, _milliseconds(period), limit, uuid.uuid4().hex],
+            callback=bool)
+
+    def mincrby(self, mapping, time=None):
+        """
+        Increment the value of each key in ``mapping`` by the amount it
+        maps to and let all of them expire in ``time`` seconds, if given.
+        Returns a dict of the keys and their new values.
+        """
+        keys = []
+        amounts = [_seconds(time) or 0]
+        for key, amount in iteritems(mapping):
+            keys.append(key)
+            amounts.append(amount)
+        return self._run_script(MINCRBY, keys, amounts,
+                                callback=lambda r: dict(zip(keys, r)))
+
+    def zpop_min(self, name, count=1, withscores=False,
+                 score_cast_func=float):
+        """
+        Remove and return up to ``count`` members with the lowest scores
+        from the sorted set ``name``.
+
+        ``withscores`` indicates to return the scores along with the values.
+        The return type is a list of (value, score) pairs
+
+        ``score_cast_func`` a callable used to cast the score return value
+        """
+        def callback(response):
+            if withscores:
+                it = iter(response)
+                return [(value, score_cast_func(score))
+                        for value, score in zip(it, it)]
+            return response[::2]
+        return self._run_script(ZPOP_MIN, [name], [count], callback=callback)
@@ -1,11 +1,25 @@
 # -*- coding: utf-8 *-*
+import time as mod_time
 import warnings
+from itertools import imap
 
 import redis
-from redis.connection import ConnectionPool, SSLConnection, UnixDomainSocketConnection
+from redis._compat import basestring, bytes, iteritems, nativestr, unicode
+from redis.connection import SSLConnection, Token, UnixDomainSocketConnection
 from redis.exceptions import ConnectionError, ResponseError, TimeoutError, WatchError
 from redis.lock import Lock, LuaLock
 
+from ..connection import (BoundedConnectionPool, CommandTemplate,
+                          ConnectionPool, EncodingCache, ReplicaSelector,
+                          Resp3Parser, get_deadline, pack_command,
+                          record_failure, socket_timeout, time_left,
+                          wait_for_reply)
+from .prepared import PreparedCommand
+from .retry import RetryPolicy
+from .transaction import ConflictStats
+from .utils import (SINGLE_KEY, key_positions, merge_class_dicts,
+                    merge_class_sets)
+
 
 class RedisBase(redis.StrictRedis):
     """
@@ -20,8 +34,57 @@ class RedisBase(redis.StrictRedis):
     Setting strict_redis to False provides backwards compatibility with older versions of redis-py
     that changed arguments to some commands to be more Pythonic, sane, or by accident and ttl values
     are returned as None if they are 0 in strict form.
+
+    Given ``replicas``, (host, port) pairs or connection pools, read-only
+    commands are sent to them instead, see ReplicaSelector for how one is
+    chosen. A command counts as read-only when it's in READ_ONLY_COMMANDS of
+    one of the command mixins. Pipelines, transactions and pub/sub always use
+    the primary. Reads from a replica may not see the latest writes yet.
+    With a ``hedging`` HedgingPolicy read-only commands go to the primary
+    instead, and to a replica as well when the primary is slow to answer.
+
+    A command failing with a ConnectionError, or a TimeoutError with
+    ``retry_on_timeout``, is sent again as allowed by the RetryPolicy
+    ``retry_policy``, by default once and right away. Once a command may
+    have reached the server it is only sent again when it's idempotent,
+    that is neither in NON_IDEMPOTENT_COMMANDS of one of the command mixins
+    nor given one of its NON_IDEMPOTENT_OPTIONS, so e.g. an INCR or a SET
+    with NX is never run twice. Commands only reporting how many elements
+    they changed, such as DEL, SADD or ZADD, count as idempotent: the data
+    ends up the same, while the count replied may be lower the second time.
+    Pipelines and PubSub objects share the client's policy and its counters,
+    ``retry_policy.stats``.
+
+    A ``circuit_breaker``, see CircuitBreaker, makes commands fail fast with
+    a CircuitOpenError while the server keeps failing.
+
+    With ``protocol=3`` the connections switch to RESP3 with HELLO, which
+    needs Redis 6, and parse its replies with Resp3Parser, or the given
+    ``parser_class``. Maps, sets and doubles then arrive as dicts, sets and
+    floats, so e.g. HGETALL, SMEMBERS and ZSCORE replies need no callback,
+    see RESP3_RESPONSE_CALLBACKS. A given ``connection_pool`` decides the
+    protocol by its parser.
+
+    Given ``encoding_cache_size`` the connections remember the bytes up to
+    that many text keys and values were encoded to, which saves encoding
+    them again when the same ones keep coming, see EncodingCache. Its hit
+    rate is in ``connection_pool.encoding_cache.stats()``.
     """
     strict_redis = False
+    # the commands of each mixin that replicas can serve
+    READ_ONLY_COMMANDS = set()
+    # the commands of each mixin that may not be run twice for one call, as
+    # they change data differently the second time, or reply with data the
+    # first run replaced or a failure where the first run succeeded
+    NON_IDEMPOTENT_COMMANDS = set()
+    # the options making commands of each mixin not idempotent, by command
+    NON_IDEMPOTENT_OPTIONS = {}
+    # where the keys of each mixin's commands are, if not just at the first
+    # argument, see utils.key_positions
+    KEY_SPECS = {}
+    # the callbacks that differ for RESP3 replies, see StrictRedis
+    RESP3_RESPONSE_CALLBACKS = {}
+    replica_selector = None
 
     @classmethod
     def from_url(cls, url, db=None, **kwargs):
@@ -58,7 +121,15 @@ class RedisBase(redis.StrictRedis):
                  charset=None, errors=None,
                  decode_responses=False, retry_on_timeout=False,
                  ssl=False, ssl_keyfile=None, ssl_certfile=None,
-                 ssl_cert_reqs=None, ssl_ca_certs=None):
+                 ssl_cert_reqs=None, ssl_ca_certs=None,
+                 max_connections=None, pool_timeout=20, min_connections=0,
+                 max_idle_time=None, replicas=None, max_replica_lag=None,
+                 replica_check_interval=1.0, replica_check_timeout=1.0,
+                 retry_policy=None,
+                 circuit_breaker=None, hedging=None, parser_class=None,
+                 protocol=None, encoding_cache_size=None):
+        if protocol not in (None, 2, 3):
+            raise ValueError('"protocol" must be 2 or 3')
         if not connection_pool:
             if charset is not None:
                 warnings.warn(DeprecationWarning(
@@ -76,8 +147,17 @@ class RedisBase(redis.StrictRedis):
                 'encoding': encoding,
                 'encoding_errors': encoding_errors,
                 'decode_responses': decode_responses,
-                'retry_on_timeout': retry_on_timeout
+                'retry_on_timeout': retry_on_timeout,
+                'circuit_breaker': circuit_breaker,
             }
+            # e.g. BufferParser instead of PythonParser without hiredis
+            if protocol == 3 and parser_class is None:
+                parser_class = Resp3Parser
+            if parser_class is not None:
+                kwargs['parser_class'] = parser_class
+            if encoding_cache_size is not None:
+                kwargs['encoding_cache'] = EncodingCache(
+                    encoding_cache_size, encoding, encoding_errors)
             # based on input, setup appropriate connection args
             if unix_socket_path is not None:
                 kwargs.update({
@@ -102,15 +182,136 @@ class RedisBase(redis.StrictRedis):
                         'ssl_cert_reqs': ssl_cert_reqs,
                         'ssl_ca_certs': ssl_ca_certs,
                     })
-            connection_pool = ConnectionPool(**kwargs)
+            # a bounded pool blocks instead of growing without limit
+            if max_connections is not None:
+                kwargs.update({
+                    'max_connections': max_connections,
+                    'timeout': pool_timeout,
+                    'min_connections': min_connections,
+                    'max_idle_time': max_idle_time,
+                })
+                connection_pool = BoundedConnectionPool(**kwargs)
+            else:
+                connection_pool = ConnectionPool(**kwargs)
         self.connection_pool = connection_pool
+        # as the connections encode keys, see encode_key
+        self.encoding = connection_pool.connection_kwargs.get('encoding',
+                                                              'utf-8')
+        self.encoding_errors = connection_pool.connection_kwargs.get(
+            'encoding_errors', 'strict')
+        # that of the pool's parser, if not given
+        parser_protocol = getattr(
+            connection_pool.connection_kwargs.get('parser_class'), 'protocol',
+            2)
+        if protocol is not None and protocol != parser_protocol:
+            raise ValueError('The connections speak protocol %s, not %s' %
+                             (parser_protocol, protocol))
+        self.protocol = parser_protocol
+        if hedging is not None and not replicas:
+            raise ValueError('Hedging reads needs "replicas"')
+        self.hedging = hedging
+        if replicas:
+            self.replica_selector = ReplicaSelector(
+                connection_pool,
+                [self._replica_pool(replica) for replica in replicas],
+                max_lag=max_replica_lag,
+                check_interval=replica_check_interval,
+                check_timeout=replica_check_timeout)
+        self._init_commands(retry_policy)
+
+    def _init_commands(self, retry_policy):
+        "Set up how commands are routed, retried and their replies parsed"
+        self.read_only_commands = merge_class_sets(type(self),
+                                                   'READ_ONLY_COMMANDS')
+        self.key_specs = merge_class_dicts(type(self), 'KEY_SPECS')
+        self.non_idempotent_commands = merge_class_sets(
+            type(self), 'NON_IDEMPOTENT_COMMANDS')
+        self.non_idempotent_options = merge_class_dicts(
+            type(self), 'NON_IDEMPOTENT_OPTIONS')
+        self.retry_policy = retry_policy or RetryPolicy(max_attempts=2)
         self._use_lua_lock = None
+        self.transaction_stats = ConflictStats()
 
         self.response_callbacks = self.__class__.RESPONSE_CALLBACKS.copy()
+        if self.protocol == 3:
+            for command, callback in iteritems(
+                    self.__class__.RESP3_RESPONSE_CALLBACKS):
+                if callback is None:
+                    self.response_callbacks.pop(command, None)
+                else:
+                    self.response_callbacks[command] = callback
 
     def __repr__(self):
         return "%s<%s>" % (type(self).__name__, repr(self.connection_pool))
 
+    def _replica_pool(self, replica):
+        "Make a pool like the primary's for a (host, port) ``replica``"
+        if not isinstance(replica, tuple):
+            return replica
+        pool = self.connection_pool
+        kwargs = dict(pool.connection_kwargs)
+        kwargs['host'], kwargs['port'] = replica
+        breaker = getattr(pool, 'circuit_breaker', None)
+        return ConnectionPool(connection_class=pool.connection_class,
+                              max_connections=pool.max_connections,
+                              circuit_breaker=breaker and breaker.copy(),
+                              encoding_cache=getattr(pool, 'encoding_cache',
+                                                     None),
+                              **kwargs)
+
+    def after_fork(self):
+        """
+        Drop the connections inherited from the parent process, to be called
+        in a forked child, e.g. from a post-fork hook of a prefork server.
+        The parent's connections stay intact. The client notices a fork by
+        itself the next time it uses the pool, this just does it up front.
+        """
+        pool = self.connection_pool
+        if isinstance(pool, ConnectionPool):
+            pool.after_fork()
+        else:
+            pool._checkpid()
+
+    def pool_stats(self):
+        """
+        Return a dictionary of counters of the connection pool, see
+        ``BoundedConnectionPool.stats`` for those of a bounded pool.
+        """
+        pool = self.connection_pool
+        if isinstance(pool, BoundedConnectionPool):
+            return pool.stats()
+        return {
+            'in_use': len(pool._in_use_connections),
+            'idle': len(pool._available_connections),
+            'created': pool._created_connections,
+        }
+
+    def get_key_positions(self, args):
+        "Return the positions of the keys in the command arguments ``args``"
+        return key_positions(args, self.key_specs.get(args[0], SINGLE_KEY))
+
+    def encode_key(self, key):
+        "Return the bytes ``key`` is sent as, like Connection.encode"
+        if isinstance(key, bytes):
+            return key
+        elif isinstance(key, float):
+            key = repr(key)
+        elif not isinstance(key, basestring):
+            key = str(key)
+        if isinstance(key, unicode):
+            key = key.encode(self.encoding, self.encoding_errors)
+        return key
+
+    def namespace(self, prefix):
+        """
+        Return a view of the client prepending ``prefix`` to the keys of all
+        commands, e.g. ``client.namespace('tenant:service:')``, encoded
+        once. It shares the client's connections, its pipelines use the
+        prefix as well. See NamespaceBase for which arguments are keys.
+        """
+        from .namespace import namespaced
+        return namespaced(self, prefix)
+
     def set_response_callback(self, command, callback):
         "Set a custom Response Callback"
         self.response_callbacks[command] = callback
@@ -120,19 +321,49 @@ class RedisBase(redis.StrictRedis):
         Convenience method for executing the callable `func` as a transaction
         while watching all keys specified in `watches`. The 'func' callable
         should expect a single argument which is a Pipeline object.
+
+        When a watched key changes, the transaction is run again as allowed
+        by the RetryPolicy ``retry_policy``, by default immediately and
+        without limit. Once it gives up, ``fallback`` is called with this
+        client and its result returned, e.g. a registered Lua script doing
+        the same work atomically on the server. Without a ``fallback`` the
+        WatchError is raised.
+
+        How the transaction ended is counted in ``transaction_stats`` under
+        ``stats_key``, which defaults to the pattern of the watched keys.
         """
         shard_hint = kwargs.pop('shard_hint', None)
         value_from_callable = kwargs.pop('value_from_callable', False)
+        retry_policy = kwargs.pop('retry_policy', None) or RetryPolicy()
+        fallback = kwargs.pop('fallback', None)
+        stats_key = kwargs.pop('stats_key', None)
+        if stats_key is None:
+            stats_key = self.transaction_stats.pattern(watches)
+        attempt = 0
         with self.pipeline(True, shard_hint) as pipe:
             while 1:
+                attempt += 1
                 try:
                     if watches:
                         pipe.watch(*watches)
                     func_value = func(pipe)
                     exec_value = pipe.execute()
-                    return func_value if value_from_callable else exec_value
                 except WatchError:
+                    # don't hold on to the connection while backing off
+                    pipe.reset()
+                    if not retry_policy.should_retry(attempt):
+                        break
+                    retry_policy.sleep(attempt)
                     continue
+                self.transaction_stats.record(stats_key, attempt, 'commit')
+                return func_value if value_from_callable else exec_value
+
+        if fallback is None:
+            self.transaction_stats.record(stats_key, attempt, 'abort')
+            raise WatchError('Watched variable changed in all %d attempts'
+                             % attempt)
+        self.transaction_stats.record(stats_key, attempt, 'fallback')
+        return fallback(self)
 
     def lock(self, name, timeout=None, sleep=0.1, blocking_timeout=None,
              lock_class=None, thread_local=True):
@@ -194,22 +425,166 @@ class RedisBase(redis.StrictRedis):
                           thread_local=thread_local)
 
     # COMMAND EXECUTION AND PROTOCOL PARSING
+    def prepare(self, *args):
+        """
+        Return a PreparedCommand for the command ``args``, None standing for
+        the arguments given each time it's called, e.g.::
+
+            get_name = client.prepare('HGET', None, 'name')
+            get_name('user:1')
+            get_name.using(pipe)('user:2')
+
+        The command name and constant arguments are encoded and packed only
+        once, the response callback applies as usual.
+        """
+        return PreparedCommand(self, CommandTemplate(args))
+
     def execute_command(self, *args, **options):
-        "Execute a command and return a parsed response"
+        """
+        Execute a command and return a parsed response.
+
+        A ``timeout`` in seconds or an absolute ``deadline``, a time.time()
+        value, limit how long this call waits on the socket instead of the
+        connection's socket_timeout. Retries only start while there's time
+        left. A TimeoutError is raised when it runs out.
+        """
+        deadline = get_deadline(options.pop('timeout', None),
+                                options.pop('deadline', None))
         pool = self.connection_pool
         command_name = args[0]
+        if self.replica_selector is not None and \
+                command_name in self.read_only_commands:
+            if self.hedging is not None:
+                return self._execute_hedged(args, options, deadline)
+            pool = self.replica_selector.get_pool()
+        connection = pool.get_connection(command_name, **options)
+        attempt = 1
+        try:
+            while 1:
+                sent = False
+                left = time_left(deadline)
+                try:
+                    with socket_timeout(connection, left):
+                        connection.send_packed_command(
+                            pack_command(connection, args))
+                        sent = True
+                        response = self.parse_response(
+                            connection, command_name, **options)
+                except (ConnectionError, TimeoutError) as e:
+                    connection.disconnect()
+                    # running out of a short per-call timeout says little
+                    # about the server's health
+                    if deadline is None or not isinstance(e, TimeoutError):
+                        record_failure(pool)
+                    if not connection.retry_on_timeout and \
+                            isinstance(e, TimeoutError):
+                        raise
+                    if not self._should_retry(attempt, (args,), sent):
+                        raise
+                    attempt += 1
+                    continue
+                if attempt > 1:
+                    self.retry_policy.stats.incr('recovered')
+                return response
+        finally:
+            pool.release(connection)
+
+    def _execute_hedged(self, args, options, deadline):
+        """
+        Send a read-only command to the primary and, unless it answers
+        within the hedging delay, to a replica as well. The first reply is
+        parsed and the connection still waiting for the other is closed.
+        Connection errors are not retried.
+        """
+        command_name = args[0]
+        start = mod_time.time()
+        pool = self.connection_pool
         connection = pool.get_connection(command_name, **options)
+        # (pool, connection) pairs waiting for a reply
+        waiting = [(pool, connection)]
+        winner = None
+        winner_pool = pool
         try:
-            connection.send_command(*args)
-            return self.parse_response(connection, command_name, **options)
+            left = time_left(deadline)
+            with socket_timeout(connection, left):
+                connection.send_packed_command(
+                    pack_command(connection, args))
+                delay = self.hedging.delay()
+                if left is not None:
+                    delay = min(delay, left)
+                if wait_for_reply([connection], delay) is None:
+                    self._send_hedge(args, options, deadline, waiting)
+                winner = wait_for_reply([c for _, c in waiting],
+                                        time_left(deadline))
+                if winner is None:
+                    raise TimeoutError('Deadline exceeded')
+                winner_pool = [p for p, c in waiting if c is winner][0]
+                with socket_timeout(winner, time_left(deadline)):
+                    response = self.parse_response(winner, command_name,
+                                                   **options)
         except (ConnectionError, TimeoutError) as e:
-            connection.disconnect()
-            if not connection.retry_on_timeout and isinstance(e, TimeoutError):
-                raise
-            connection.send_command(*args)
-            return self.parse_response(connection, command_name, **options)
+            if deadline is None or not isinstance(e, TimeoutError):
+                record_failure(winner_pool)
+            winner = None
+            raise
         finally:
+            for waiting_pool, waiting_connection in waiting:
+                if waiting_connection is not winner:
+                    # its reply is still to come
+                    waiting_connection.disconnect()
+                waiting_pool.release(waiting_connection)
+        self.hedging.record(mod_time.time() - start, len(waiting) > 1,
+                            winner is not connection)
+        return response
+
+    def _send_hedge(self, args, options, deadline, waiting):
+        # send the command to a replica too, if a healthy one is left
+        pool = self.replica_selector.get_pool()
+        if pool is self.connection_pool:
+            return
+        connection = pool.get_connection(args[0], **options)
+        waiting.append((pool, connection))
+        try:
+            with socket_timeout(connection, time_left(deadline)):
+                connection.send_packed_command(
+                    pack_command(connection, args))
+        except (ConnectionError, TimeoutError):
+            # stick to the primary
+            waiting.pop()
+            connection.disconnect()
             pool.release(connection)
+            record_failure(pool)
+
+    def _should_retry(self, attempt, commands, sent):
+        """
+        Indicates if the ``commands``, tuples of arguments, failing with a
+        connection error in their ``attempt`` are sent again, after waiting
+        as long as the retry policy asks. Once they were ``sent``, they may
+        have run already and are only sent again if they are all idempotent.
+        """
+        if sent and not all(imap(self.is_idempotent, commands)):
+            self.retry_policy.stats.incr('unsafe')
+            return False
+        return self.retry_policy.retry(attempt)
+
+    def is_idempotent(self, args):
+        """
+        Indicates if the command with the arguments ``args`` has the same
+        effect when run twice, see NON_IDEMPOTENT_COMMANDS
+        """
+        command_name = args[0]
+        if command_name in self.non_idempotent_commands:
+            return False
+        options = self.non_idempotent_options.get(command_name)
+        if options:
+            # after the key, which is no option
+            for arg in args[2:]:
+                if isinstance(arg, Token):
+                    arg = arg.value
+                if isinstance(arg, basestring) and len(arg) < 8 and \
+                        nativestr(arg).upper() in options:
+                    return False
+        return True
 
     def parse_response(self, connection, command_name, **options):
         "Parses a response from the Redis server"
@@ -5,6 +5,11 @@ from .base import RedisBase
 
 
 class ByteCommands(RedisBase):
+    READ_ONLY_COMMANDS = set(('BITCOUNT', 'BITPOS', 'GETBIT', 'GETRANGE',
+                              'STRLEN', 'SUBSTR'))
+    NON_IDEMPOTENT_COMMANDS = set(('APPEND', 'SETBIT'))
+    KEY_SPECS = {'BITOP': (2, -1, 1)}
+
     # direct byte(string) manipulation commands
     def append(self, key, value):
         """
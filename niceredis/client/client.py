@@ -1,12 +1,17 @@
 # -*- coding: utf-8 *-*
 from redis._compat import imap, nativestr
 
-from ..callbacks import (bool_ok, float_or_none, int_or_none, pairs_to_dict, parse_client_list,
-                         parse_config_get, parse_debug_object, parse_hscan, parse_info,
-                         parse_object, parse_scan, parse_sentinel_get_master, parse_sentinel_master,
-                         parse_sentinel_masters, parse_sentinel_slaves_and_sentinels,
-                         parse_slowlog_get, parse_zscan, sort_return_tuples, timestamp_to_datetime,
-                         zset_score_pairs)
+from ..callbacks import (bool_ok, float_or_none, int_or_none, map_to_pairs,
+                         pairs_to_dict, parse_client_list, parse_config_get,
+                         parse_debug_object, parse_hscan, parse_info,
+                         parse_object, parse_scan, parse_script_result,
+                         parse_sentinel_get_master, parse_sentinel_master,
+                         parse_sentinel_masters,
+                         parse_sentinel_slaves_and_sentinels,
+                         parse_slowlog_get, parse_zscan, sort_return_tuples,
+                         timestamp_to_datetime, zset_score_pairs,
+                         zset_score_pairs_resp3)
+from .atomic import AtomicCommands
 from .byte import ByteCommands
 from .hash import HashCommands
 from .hyperloglog import HyperloglogCommands
@@ -22,9 +27,10 @@ from .utils import dict_merge, string_keys_to_dict
 from .zset import ZsetCommands
 
 
-class StrictRedis(ByteCommands, HashCommands, HyperloglogCommands, KeyCommands, ListCommands,
-                   NumberCommands, PipelineCommands, PubSubCommands, ScriptCommands, ServerCommands,
-                   SetCommands, ZsetCommands):
+class StrictRedis(AtomicCommands, ByteCommands, HashCommands,
+                  HyperloglogCommands, KeyCommands, ListCommands,
+                  NumberCommands, PipelineCommands, PubSubCommands,
+                  ScriptCommands, ServerCommands, SetCommands, ZsetCommands):
     strict_redis = True
     RESPONSE_CALLBACKS = dict_merge(
         string_keys_to_dict(
@@ -63,6 +69,7 @@ class StrictRedis(ByteCommands, HashCommands, HyperloglogCommands, KeyCommands,
         ),
         string_keys_to_dict('ZRANK ZREVRANK', int_or_none),
         string_keys_to_dict('BGREWRITEAOF BGSAVE', lambda r: True),
+        string_keys_to_dict('EVAL EVALSHA', parse_script_result),
         {
             'CLIENT GETNAME': lambda r: r and nativestr(r),
             'CLIENT KILL': bool_ok,
@@ -101,6 +108,28 @@ class StrictRedis(ByteCommands, HashCommands, HyperloglogCommands, KeyCommands,
             'ZSCAN': parse_zscan
         }
     )
+    # the callbacks replaced with protocol=3, None where the maps, sets and
+    # doubles of RESP3 need no conversion
+    RESP3_RESPONSE_CALLBACKS = dict_merge(
+        string_keys_to_dict('SDIFF SINTER SMEMBERS SUNION', None),
+        string_keys_to_dict('ZSCORE ZINCRBY', None),
+        string_keys_to_dict(
+            'ZRANGE ZRANGEBYSCORE ZREVRANGE ZREVRANGEBYSCORE',
+            zset_score_pairs_resp3
+        ),
+        {
+            'CONFIG GET': lambda r: parse_config_get(map_to_pairs(r)),
+            'HGETALL': None,
+            'SENTINEL MASTER': lambda r: parse_sentinel_master(
+                map_to_pairs(r)),
+            'SENTINEL MASTERS': lambda r: parse_sentinel_masters(
+                imap(map_to_pairs, r)),
+            'SENTINEL SENTINELS': lambda r: (
+                parse_sentinel_slaves_and_sentinels(imap(map_to_pairs, r))),
+            'SENTINEL SLAVES': lambda r: parse_sentinel_slaves_and_sentinels(
+                imap(map_to_pairs, r)),
+        }
+    )
 
 
 class Redis(StrictRedis):
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 *-*
+from __future__ import absolute_import, with_statement
+
+import threading
+
+from redis._compat import nativestr
+from redis.exceptions import (ConnectionError, RedisError, ResponseError,
+                              TimeoutError)
+
+from ..connection import (get_deadline, pack_command, record_failure,
+                          socket_timeout, time_left)
+from .client import StrictRedis
+from .sharded import ShardedPipelineBase, ShardedRedis
+from .utils import hash_tag
+
+HASH_SLOTS = 16384
+
+
+def _crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = (crc << 1) ^ 0x1021
+            else:
+                crc <<= 1
+        table.append(crc & 0xffff)
+    return table
+
+
+_CRC16_TABLE = _crc16_table()
+
+
+def crc16(data):
+    "CRC16-CCITT (XModem) of the bytes ``data``, as used by Redis Cluster"
+    crc = 0
+    for byte in bytearray(data):
+        crc = ((crc << 8) & 0xffff) ^ _CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+
+def key_slot(key):
+    "Return the hash slot of the encoded ``key``"
+    return crc16(hash_tag(key)) % HASH_SLOTS
+
+
+def parse_redirect(error):
+    """
+    Return ('MOVED' or 'ASK', slot, (host, port)) of a redirection error,
+    or None for other errors
+    """
+    parts = str(error).split()
+    if len(parts) != 3 or parts[0] not in ('MOVED', 'ASK'):
+        return None
+    host, port = parts[2].rsplit(':', 1)
+    return parts[0], int(parts[1]), (host, int(port))
+
+
+class ClusterPipelineBase(ShardedPipelineBase):
+    """
+    Pipeline of a RedisCluster, see ShardedPipelineBase. Commands whose
+    slot moved are run again on their own, following the redirections.
+    """
+
+    def _handle_errors(self, stack, response):
+        for index, reply in enumerate(response):
+            if isinstance(reply, ResponseError) and parse_redirect(reply):
+                slot, args, options = stack[index]
+                try:
+                    response[index] = self.client._execute_on(slot, args,
+                                                              options)
+                except ResponseError as e:
+                    response[index] = e
+
+
+class RedisCluster(ShardedRedis):
+    """
+    Redis Cluster client, sending every command straight to the node
+    serving the hash slot of its keys.
+
+    >>> rc = RedisCluster([('127.0.0.1', 7000)])
+    >>> rc.set('foo', 'bar')
+
+    The slot map is loaded with CLUSTER SLOTS from one of the
+    ``startup_nodes`` (host, port) pairs, or of the nodes known by then, and
+    kept up to date by MOVED redirections, each moving one slot. ASK
+    redirections during a slot migration are followed for the one command.
+    When a node can't be reached, the whole map is loaded again and the
+    command retried as the ``retry_policy`` allows, like with RedisBase: if
+    it may have run already, only when it is idempotent.
+    ``max_redirects`` redirections per command are followed before giving up.
+
+    Multi-key commands need their keys in one slot, except MGET, MSET and
+    DEL which are split by slot. Commands without keys run on all masters.
+    Pipelines run the commands of each node concurrently, see
+    ClusterPipelineBase.
+    """
+    pipeline_base = ClusterPipelineBase
+
+    def __init__(self, startup_nodes, max_redirects=16,
+                 redis_class=StrictRedis, **connection_kwargs):
+        super(RedisCluster, self).__init__({}, redis_class=redis_class,
+                                           **connection_kwargs)
+        self.startup_nodes = [(host, int(port))
+                              for host, port in startup_nodes]
+        self.max_redirects = max_redirects
+        self.slots = [None] * HASH_SLOTS
+        self._nodes_lock = threading.Lock()
+        self.refresh_slots()
+
+    def __repr__(self):
+        return '%s<startup_nodes=%r>' % (type(self).__name__,
+                                         self.startup_nodes)
+
+    def add_shard(self, name, shard):
+        self.shards[name] = shard
+        return shard
+
+    def remove_shard(self, name):
+        return self.shards.pop(name)
+
+    def get_node(self, address):
+        "Return the client of the node at ``address``, a (host, port) pair"
+        name = '%s:%s' % address
+        node = self.shards.get(name)
+        if node is None:
+            with self._nodes_lock:
+                node = self.shards.get(name)
+                if node is None:
+                    node = self.add_shard(name, self.redis_class(
+                        address[0], address[1], **self._node_kwargs()))
+        return node
+
+    def refresh_slots(self):
+        "Load the slot map from the first node that answers"
+        addresses = self.startup_nodes + [
+            address for address in set(self.slots)
+            if address is not None and address not in self.startup_nodes]
+        for address in addresses:
+            try:
+                reply = self.get_node(address).execute_command('CLUSTER SLOTS')
+            except (ConnectionError, TimeoutError, ResponseError):
+                continue
+            slots = [None] * HASH_SLOTS
+            for item in reply:
+                start, end, master = item[0], item[1], item[2]
+                # the node we asked may not know its own address
+                master = (nativestr(master[0]) or address[0], int(master[1]))
+                for slot in range(start, end + 1):
+                    slots[slot] = master
+            self.slots = slots
+            return
+        raise ConnectionError('None of the cluster nodes answered')
+
+    def _route(self, key):
+        return key_slot(self.encode_key(key))
+
+    def get_shard_name(self, key):
+        "Return the name, host:port, of the node serving ``key``"
+        return '%s:%s' % self.get_slot_address(self._route(key))
+
+    def get_shard(self, key):
+        "Return the client of the node serving ``key``"
+        return self.get_node(self.get_slot_address(self._route(key)))
+
+    def get_slot_address(self, slot):
+        "Return the address of the node serving ``slot``"
+        address = self.slots[slot]
+        if address is None:
+            # not served by any node last time we asked
+            self.refresh_slots()
+            address = self.slots[slot]
+            if address is None:
+                raise RedisError('Slot %d is not served by any node' % slot)
+        return address
+
+    def _get_route_shard(self, slot):
+        return self.get_node(self.get_slot_address(slot))
+
+    def _broadcast_names(self):
+        return sorted(set(['%s:%s' % address for address in self.slots
+                           if address is not None]))
+
+    def _broadcast(self, args, options):
+        # make sure all masters have clients
+        for address in set(self.slots):
+            if address is not None:
+                self.get_node(address)
+        return super(RedisCluster, self)._broadcast(args, options)
+
+    def _execute_on(self, slot, args, options):
+        """
+        Execute a command on the node of ``slot``, following redirections.
+        A ``timeout`` or ``deadline`` option covers all of them, see
+        RedisBase.execute_command.
+        """
+        # the options may be shared with other slots of a split command
+        options = dict(options)
+        deadline = get_deadline(options.pop('timeout', None),
+                                options.pop('deadline', None))
+        command_name = args[0]
+        address = self.get_slot_address(slot)
+        asking = False
+        attempt = 1
+        for _ in range(self.max_redirects + 1):
+            sent = False
+            left = time_left(deadline)
+            pool = self.get_node(address).connection_pool
+            connection = pool.get_connection(command_name, **options)
+            try:
+                with socket_timeout(connection, left):
+                    if asking:
+                        connection.send_command('ASKING')
+                        connection.read_response()
+                    connection.send_packed_command(
+                        pack_command(connection, args))
+                    sent = True
+                    response = self.parse_response(connection, command_name,
+                                                   **options)
+            except ResponseError as e:
+                redirect = parse_redirect(e)
+                if redirect is None:
+                    raise
+                kind, redirect_slot, address = redirect
+                asking = kind == 'ASK'
+                if not asking:
+                    # the slot moved for good
+                    self.slots[redirect_slot] = address
+            except (ConnectionError, TimeoutError) as e:
+                connection.disconnect()
+                if deadline is None or not isinstance(e, TimeoutError):
+                    record_failure(pool)
+                if not connection.retry_on_timeout and \
+                        isinstance(e, TimeoutError):
+                    raise
+                if not self._should_retry(attempt, (args,), sent):
+                    raise
+                attempt += 1
+                # the node may be down and replaced, ask the cluster
+                self.refresh_slots()
+                address = self.get_slot_address(slot)
+                asking = False
+            else:
+                if attempt > 1:
+                    self.retry_policy.stats.incr('recovered')
+                return response
+            finally:
+                pool.release(connection)
+        raise RedisError('Too many redirections for slot %d' % slot)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 *-*
+from __future__ import with_statement
+
+import logging
+import pickle
+import tempfile
+import threading
+from collections import deque
+from multiprocessing.pool import Pool
+
+logger = logging.getLogger(__name__)
+
+
+class _Lane(object):
+    # the queue of one worker: up to ``size`` messages in memory, then with
+    # the spill policy the rest in a file, read back once the queue is empty
+    def __init__(self, size):
+        self.size = size
+        self.condition = threading.Condition(threading.Lock())
+        self.queue = deque()
+        self.spilled = 0
+        # the handlers of the spilled messages by id, as they can't all be
+        # pickled
+        self.handlers = {}
+        self._file = None
+        self._read_at = 0
+
+    def __len__(self):
+        return len(self.queue) + self.spilled
+
+    def full(self):
+        return self.spilled or len(self.queue) >= self.size
+
+    def spill(self, handler, message):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile()
+        self._file.seek(0, 2)
+        pickle.dump((id(handler), message), self._file,
+                    pickle.HIGHEST_PROTOCOL)
+        self.handlers[id(handler)] = handler
+        self.spilled += 1
+
+    def unspill(self):
+        self._file.seek(self._read_at)
+        handler_id, message = pickle.load(self._file)
+        handler = self.handlers[handler_id]
+        self.spilled -= 1
+        if self.spilled:
+            self._read_at = self._file.tell()
+        else:
+            self._file.seek(0)
+            self._file.truncate()
+            self._read_at = 0
+            self.handlers.clear()
+        return handler, message
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.handlers.clear()
+
+
+class HandlerPool(object):
+    """
+    Calls the message handlers of PubSub objects in ``workers`` threads,
+    or processes with ``processes=True``, instead of the thread reading
+    the messages, see ``PubSub``'s ``handler_pool``. In processes the
+    handlers and messages are pickled, so the handlers have to be module
+    level functions.
+
+    The messages of a channel are always handled by the same worker, one
+    after the other and in the order they arrived. Each worker queues up
+    to ``queue_size`` messages. When its queue is full, the ``policy``
+    decides:
+
+    - ``block``: the reading thread waits for room in the queue. The
+      messages pile up on the server then, as its output buffer limits for
+      pub/sub clients allow.
+    - ``drop``: the message is dropped.
+    - ``spill``: the message goes to a temporary file on disk, along with
+      all later ones of the worker, until the worker caught up.
+
+    A handler raising an exception is counted and logged with its
+    traceback, or ``error_handler(message, exception)`` is called. ``stats()``
+    returns the current queue depths and the counters.
+    """
+    BLOCK = 'block'
+    DROP = 'drop'
+    SPILL = 'spill'
+    POLICIES = (BLOCK, DROP, SPILL)
+    COUNTERS = ('dispatched', 'handled', 'dropped', 'spilled', 'errors')
+
+    def __init__(self, workers=4, queue_size=1000, policy=BLOCK,
+                 processes=False, error_handler=None):
+        if workers < 1:
+            raise ValueError('"workers" must be a positive integer')
+        if queue_size < 1:
+            raise ValueError('"queue_size" must be a positive integer')
+        if policy not in self.POLICIES:
+            raise ValueError('"policy" must be one of %s' %
+                             ', '.join(self.POLICIES))
+        self.workers = workers
+        self.queue_size = queue_size
+        self.policy = policy
+        self.error_handler = error_handler
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(self.COUNTERS, 0)
+        self._max_depth = 0
+        self._closed = False
+        self._process_pool = None
+        if processes:
+            self._process_pool = Pool(workers)
+        self._lanes = [_Lane(queue_size) for _ in range(workers)]
+        self._threads = []
+        for lane in self._lanes:
+            thread = threading.Thread(target=self._work, args=(lane,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def __repr__(self):
+        return '%s<workers=%s,queue_size=%s,policy=%s>' % (
+            type(self).__name__, self.workers, self.queue_size, self.policy)
+
+    def dispatch(self, channel, handler, message):
+        """
+        Queue ``handler(message)`` for the worker of ``channel``. Returns
+        False if the message was dropped.
+        """
+        lane = self._lanes[hash(channel) % self.workers]
+        with lane.condition:
+            if self._closed:
+                raise RuntimeError('The handler pool is closed')
+            while lane.full() and self.policy == self.BLOCK:
+                lane.condition.wait()
+                if self._closed:
+                    raise RuntimeError('The handler pool is closed')
+            if lane.full():
+                if self.policy == self.DROP:
+                    self._incr('dropped')
+                    return False
+                lane.spill(handler, message)
+                self._incr('spilled')
+            else:
+                lane.queue.append((handler, message))
+            depth = len(lane)
+            lane.condition.notify_all()
+        with self._lock:
+            self._stats['dispatched'] += 1
+            if depth > self._max_depth:
+                self._max_depth = depth
+        return True
+
+    def _incr(self, counter):
+        with self._lock:
+            self._stats[counter] += 1
+
+    def _work(self, lane):
+        while True:
+            with lane.condition:
+                while not len(lane) and not self._closed:
+                    lane.condition.wait()
+                if lane.queue:
+                    handler, message = lane.queue.popleft()
+                elif lane.spilled:
+                    handler, message = lane.unspill()
+                else:
+                    lane.close()
+                    return
+                # room for a blocked dispatch
+                lane.condition.notify_all()
+            self._handle(handler, message)
+
+    def _handle(self, handler, message):
+        try:
+            if self._process_pool is not None:
+                self._process_pool.apply(handler, (message,))
+            else:
+                handler(message)
+        except Exception as e:
+            self._incr('errors')
+            if self.error_handler is not None:
+                self.error_handler(message, e)
+            else:
+                logger.exception('Error handling the message %r', message)
+        else:
+            self._incr('handled')
+
+    def stats(self):
+        """
+        Return the counters: the messages ``queued`` right now, in all
+        queues and by worker in ``depths``, the ``max_depth`` a queue
+        reached, and in total the messages ``dispatched``, ``handled``,
+        ``dropped`` and ``spilled``, and the handler ``errors``
+        """
+        depths = [len(lane) for lane in self._lanes]
+        with self._lock:
+            stats = dict(self._stats)
+            stats['max_depth'] = self._max_depth
+        stats['depths'] = depths
+        stats['queued'] = sum(depths)
+        return stats
+
+    def close(self, timeout=None):
+        """
+        Stop taking messages and end the workers once they handled those
+        queued, waiting up to ``timeout`` seconds for them. A worker still
+        busy then removes its spill file once done.
+        """
+        self._closed = True
+        for lane in self._lanes:
+            with lane.condition:
+                lane.condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        if self._process_pool is not None:
+            self._process_pool.close()
+            self._process_pool.join()
@@ -8,6 +8,10 @@ from .utils import list_or_args
 
 
 class HashCommands(RedisBase):
+    READ_ONLY_COMMANDS = set(('HEXISTS', 'HGET', 'HGETALL', 'HKEYS', 'HLEN',
+                              'HMGET', 'HSCAN', 'HVALS'))
+    NON_IDEMPOTENT_COMMANDS = set(('HINCRBY', 'HINCRBYFLOAT', 'HSETNX'))
+
     # HASH COMMANDS
     def hdel(self, name, *keys):
         "Delete ``keys`` from hash ``name``"
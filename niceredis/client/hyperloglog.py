@@ -1,8 +1,12 @@
 # -*- coding: utf-8 *-*
 from .base import RedisBase
+from .utils import ALL_KEYS, string_keys_to_dict
 
 
 class HyperloglogCommands(RedisBase):
+    READ_ONLY_COMMANDS = set(('PFCOUNT',))
+    KEY_SPECS = string_keys_to_dict('PFCOUNT PFMERGE', ALL_KEYS)
+
     # HYPERLOGLOG COMMANDS
     def pfadd(self, name, *values):
         "Adds the specified elements to the specified HyperLogLog."
@@ -7,10 +7,32 @@ from redis.connection import Token
 from redis.exceptions import DataError, RedisError
 
 from .base import RedisBase
-from .utils import list_or_args
+from .utils import ALL_KEYS, dict_merge, list_or_args, string_keys_to_dict
+
+
+def _sort_key_positions(args):
+    # the sorted key and the STORE destination, if any
+    positions = [1]
+    for i, arg in enumerate(args):
+        if isinstance(arg, Token) and arg.value == 'STORE':
+            positions.append(i + 1)
+    return positions
 
 
 class KeyCommands(RedisBase):
+    READ_ONLY_COMMANDS = set(('DUMP', 'EXISTS', 'GET', 'KEYS', 'MGET', 'PTTL',
+                              'RANDOMKEY', 'SCAN', 'TTL', 'TYPE'))
+    NON_IDEMPOTENT_COMMANDS = set(('GETSET', 'MOVE', 'MSETNX', 'RENAME',
+                                   'RENAMENX', 'RESTORE', 'SETNX'))
+    NON_IDEMPOTENT_OPTIONS = {'SET': set(('GET', 'NX', 'XX'))}
+    KEY_SPECS = dict_merge(
+        string_keys_to_dict('DEL EXISTS MGET', ALL_KEYS),
+        string_keys_to_dict('MSET MSETNX', (1, -1, 2)),
+        string_keys_to_dict('RENAME RENAMENX', (1, 2, 1)),
+        string_keys_to_dict('KEYS RANDOMKEY SCAN', None),
+        {'SORT': _sort_key_positions}
+    )
+
     # BASIC KEY COMMANDS
     def delete(self, *names):
         "Delete one or more keys specified by ``names``"
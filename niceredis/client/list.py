@@ -1,9 +1,19 @@
 # -*- coding: utf-8 *-*
 from .base import RedisBase
+from .utils import dict_merge, string_keys_to_dict
 
 NOT_SET = object()
 
 class ListCommands(RedisBase):
+    READ_ONLY_COMMANDS = set(('LINDEX', 'LLEN', 'LRANGE'))
+    NON_IDEMPOTENT_COMMANDS = set(('BLPOP', 'BRPOP', 'BRPOPLPUSH', 'LINSERT',
+                                   'LPOP', 'LPUSH', 'LPUSHX', 'LREM', 'RPOP',
+                                   'RPOPLPUSH', 'RPUSH', 'RPUSHX'))
+    KEY_SPECS = dict_merge(
+        string_keys_to_dict('BLPOP BRPOP', (1, -2, 1)),
+        string_keys_to_dict('BRPOPLPUSH RPOPLPUSH', (1, 2, 1))
+    )
+
     # LIST COMMANDS
     def blpop(self, keys, timeout=0):
         """
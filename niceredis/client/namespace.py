@@ -0,0 +1,221 @@
+# -*- coding: utf-8 *-*
+import re
+
+from redis._compat import b, bytes, iteritems
+from redis.connection import Token
+
+from ..connection import CommandTemplate
+from .pipeline import Reference
+
+# the glob characters escaped where the prefix is part of a pattern
+_GLOB_CHARACTERS = re.compile(b(r'([*?\[\]\\])'))
+
+
+def _token_positions(args, tokens):
+    # the positions of the arguments following the ``tokens``
+    return [i + 1 for i, arg in enumerate(args)
+            if isinstance(arg, Token) and arg.value in tokens]
+
+
+def _sort_pattern_positions(args):
+    # the BY and GET patterns, but for "GET #", the sorted element itself
+    return [i for i in _token_positions(args, ('BY', 'GET'))
+            if args[i] not in ('#', b('#'))]
+
+
+# where commands take patterns of keys, the prefix going in front of them
+# as well, and whether they are globs, which get the prefix with its glob
+# characters escaped. SORT only substitutes the ``*`` of its patterns.
+PATTERN_SPECS = {
+    'KEYS': (lambda args: [1], True),
+    'SCAN': (lambda args: _token_positions(args, ('MATCH',)), True),
+    'SORT': (_sort_pattern_positions, False),
+}
+
+
+def _strip_keys(view, keys):
+    return [view.strip_prefix(key) for key in keys]
+
+
+def _strip_scan(view, reply):
+    if isinstance(reply, dict):
+        # a ShardedRedis's, by shard
+        return dict([(name, _strip_scan(view, shard_reply))
+                     for name, shard_reply in iteritems(reply)])
+    cursor, keys = reply
+    return cursor, _strip_keys(view, keys)
+
+
+def _strip_popped(view, reply):
+    return reply and (view.strip_prefix(reply[0]), reply[1])
+
+
+# how the keys in the replies of commands lose their prefix
+KEY_REPLIES = {
+    'BLPOP': _strip_popped,
+    'BRPOP': _strip_popped,
+    'KEYS': _strip_keys,
+    'SCAN': _strip_scan,
+}
+
+
+# the view classes made for each mixin and class of the viewed object
+_VIEW_CLASSES = {}
+
+
+def namespaced(client, prefix):
+    """
+    Return a view of ``client`` prepending the encoded ``prefix`` to all
+    keys, see ``RedisBase.namespace``
+    """
+    return _make_view(NamespaceBase, client, client,
+                      client.encode_key(prefix))
+
+
+def _make_view(mixin, obj, unprefixed, prefix):
+    # an object of a subclass of obj's class that has its state and runs
+    # the commands of the mixin first
+    bases = (mixin, type(obj))
+    cls = _VIEW_CLASSES.get(bases)
+    if cls is None:
+        cls = _VIEW_CLASSES.setdefault(
+            bases, type('Namespaced' + type(obj).__name__, bases, {}))
+    view = cls.__new__(cls)
+    view.__dict__.update(obj.__dict__)
+    view._set_namespace(unprefixed, prefix)
+    return view
+
+
+class NamespaceBase(object):
+    """
+    View of a client whose commands get ``key_prefix`` prepended to their
+    keys, where KEY_SPECS puts them, and to the key patterns of KEYS, SCAN
+    and SORT. The prefix is taken off again the keys in the replies of
+    KEYS, SCAN and BLPOP/BRPOP, and so of ``keys`` and ``scan_iter``.
+    Channels, script bodies and RANDOMKEY are left alone.
+    """
+
+    def _set_namespace(self, unprefixed, prefix):
+        self._unprefixed = unprefixed
+        self.key_prefix = prefix
+        self._pattern_prefix = _GLOB_CHARACTERS.sub(b(r'\\\1'), prefix)
+        self._text_prefix = prefix.decode(unprefixed.encoding,
+                                          unprefixed.encoding_errors)
+        # for pipelines, which have none of their own
+        self.key_specs = unprefixed.key_specs
+        self.encoding = unprefixed.encoding
+        self.encoding_errors = unprefixed.encoding_errors
+
+    def __repr__(self):
+        return '%s<prefix=%r, %r>' % (type(self).__name__, self.key_prefix,
+                                      self._unprefixed)
+
+    def namespace(self, prefix):
+        "Return a view with ``prefix`` added to this one's"
+        return _make_view(NamespaceBase, self._unprefixed, self._unprefixed,
+                          self.key_prefix + self.encode_key(prefix))
+
+    def strip_prefix(self, key):
+        "Return ``key`` as returned by Redis without the prefix"
+        if isinstance(key, bytes):
+            return key[len(self.key_prefix):]
+        return key[len(self._text_prefix):]
+
+    def add_prefix(self, args):
+        "Return the arguments ``args`` of a command with prefixed keys"
+        command_name = args[0]
+        positions = self.get_key_positions(args)
+        pattern_spec = PATTERN_SPECS.get(command_name)
+        if not positions and pattern_spec is None:
+            return args
+        args = list(args)
+        for i in positions:
+            args[i] = self._prefixed(self.key_prefix, args[i])
+        if pattern_spec is not None:
+            pattern_positions, glob = pattern_spec
+            if command_name == 'SCAN' and not pattern_positions(args):
+                args.extend([Token('MATCH'), '*'])
+            prefix = glob and self._pattern_prefix or self.key_prefix
+            for i in pattern_positions(args):
+                args[i] = self._prefixed(prefix, args[i])
+        if command_name.__class__ is CommandTemplate and \
+                not set(positions).issubset(command_name.slots):
+            # the template packed the keys given when it was prepared
+            # without the prefix
+            args[0] = str(command_name)
+        return args
+
+    def _prefixed(self, prefix, key):
+        if isinstance(key, Reference):
+            return key.map(lambda value: prefix + self.encode_key(value))
+        return prefix + self.encode_key(key)
+
+    def execute_command(self, *args, **options):
+        command_name = args[0]
+        response = super(NamespaceBase, self).execute_command(
+            *self.add_prefix(args), **options)
+        strip = KEY_REPLIES.get(command_name)
+        if strip is None:
+            return response
+        if response is self:
+            # queued in a pipeline, the reply comes with execute()
+            self._key_replies.append((len(self) - 1, strip))
+            return response
+        return strip(self, response)
+
+    def scan_iter(self, match=None, count=None):
+        """
+        Iterate over the keys of the namespace, see ``scan_iter`` of the
+        client
+        """
+        if match is None:
+            match = '*'
+        match = self._pattern_prefix + self.encode_key(match)
+        for key in self._unprefixed.scan_iter(match=match, count=count):
+            yield self.strip_prefix(key)
+
+    def pipeline(self, *args, **kwargs):
+        """
+        Return a pipeline of the client whose commands use the namespace as
+        well
+        """
+        # made by the client without the namespace, as the pipeline's own
+        # methods come first in its class
+        pipe = self._unprefixed.pipeline(*args, **kwargs)
+        return _make_view(NamespacedPipelineBase, pipe, self._unprefixed,
+                          self.key_prefix)
+
+
+class NamespacedPipelineBase(NamespaceBase):
+    "Pipeline of a namespace view, taking the prefix off keys in replies"
+
+    def _set_namespace(self, unprefixed, prefix):
+        super(NamespacedPipelineBase, self)._set_namespace(unprefixed,
+                                                           prefix)
+        # (index, strip function) of the replies holding keys
+        self._key_replies = []
+
+    def reset(self):
+        self._key_replies = []
+        super(NamespacedPipelineBase, self).reset()
+
+    def _strip_replies(self, key_replies, response):
+        for index, strip in key_replies:
+            if not isinstance(response[index], Exception):
+                response[index] = strip(self, response[index])
+        return response
+
+    def execute(self, *args, **kwargs):
+        key_replies = self._key_replies
+        return self._strip_replies(
+            key_replies,
+            super(NamespacedPipelineBase, self).execute(*args, **kwargs))
+
+    def execute_iter(self, *args, **kwargs):
+        strips = dict(self._key_replies)
+        replies = super(NamespacedPipelineBase, self).execute_iter(
+            *args, **kwargs)
+        for index, reply in enumerate(replies):
+            if index in strips and not isinstance(reply, Exception):
+                reply = strips[index](self, reply)
+            yield reply
@@ -3,6 +3,8 @@ from .base import RedisBase
 
 
 class NumberCommands(RedisBase):
+    NON_IDEMPOTENT_COMMANDS = set(('DECRBY', 'INCRBY', 'INCRBYFLOAT'))
+
     # direct number manipulation commands
     def decr(self, name, amount=1):
         """
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 *-*
+import os
 import sys
 import warnings
 from itertools import chain, imap, izip
@@ -6,27 +7,53 @@ from itertools import chain, imap, izip
 from redis.exceptions import (ConnectionError, ExecAbortError, RedisError, ResponseError,
                               TimeoutError, WatchError)
 
+from ..connection import (coalesce, forget_connection, get_deadline,
+                          pack_buffers, pack_command, record_failure,
+                          socket_timeout, time_left)
 from .base import RedisBase
+from .retry import RetryPolicy
+from .utils import ALL_KEYS, dict_merge
+
+# the pipeline classes made for each client class
+_PIPELINE_CLASSES = {}
 
 
 class PipelineCommands(RedisBase):
-    def pipeline(self, transaction=True, shard_hint=None):
+    KEY_SPECS = dict_merge(
+        {'WATCH': ALL_KEYS},
+        dict.fromkeys(('DISCARD', 'EXEC', 'MULTI', 'UNWATCH'))
+    )
+
+    def pipeline(self, transaction=True, shard_hint=None, flush_size=None):
         """
         Return a new pipeline object that can queue multiple commands for
         later execution. ``transaction`` indicates whether all commands
         should be executed atomically. Apart from making a group of operations
         atomic, pipelines are useful for reducing the back-and-forth overhead
         between the client and server.
-        """
-        class Pipeline(BasePipeline, self.__class__):
-            "Pipeline for the Redis class"
-            pass
 
-        return Pipeline(
+        If ``flush_size`` is set on a pipeline without transaction, commands
+        are packed as they are queued and written to the connection whenever
+        at least ``flush_size`` bytes are pending, so the network transfer
+        overlaps with building the rest of the batch. Replies are still read
+        by execute().
+        """
+        cls = _PIPELINE_CLASSES.get(self.__class__)
+        if cls is None:
+            class Pipeline(BasePipeline, self.__class__):
+                "Pipeline for the Redis class"
+                pass
+            cls = _PIPELINE_CLASSES.setdefault(self.__class__, Pipeline)
+
+        return cls(
             self.connection_pool,
             self.response_callbacks,
             transaction,
-            shard_hint)
+            shard_hint,
+            flush_size,
+            self.retry_policy,
+            self.non_idempotent_commands,
+            self.non_idempotent_options)
 
     def watch(self, *names):
         """
@@ -42,6 +69,42 @@ class PipelineCommands(RedisBase):
             DeprecationWarning('Call UNWATCH from a Pipeline object'))
 
 
+class Reference(object):
+    """
+    Placeholder for the result of a command queued earlier on the same
+    pipeline, returned by ``BasePipeline.ref``. It can be passed to later
+    commands in place of an argument and is replaced by the parsed result
+    when the pipeline executes.
+
+    ``map`` returns a new Reference that passes the result through ``func``
+    first, e.g. to build a key name from an id::
+
+        user_id = pipe.get('session:abc').ref()
+        pipe.hgetall(user_id.map('user:{0}'.format))
+    """
+
+    def __init__(self, index, transform=None):
+        self.index = index
+        self.transform = transform
+
+    def __repr__(self):
+        return 'Reference<%d>' % self.index
+
+    def map(self, func):
+        "Return a Reference to ``func`` applied to the referenced result"
+        if self.transform is None:
+            return Reference(self.index, func)
+        transform = self.transform
+        return Reference(self.index, lambda value: func(transform(value)))
+
+    def resolve(self, results):
+        "Return the referenced value from the list of pipeline ``results``"
+        value = results[self.index]
+        if self.transform is not None:
+            value = self.transform(value)
+        return value
+
+
 class BasePipeline(object):
     """
     Pipelines provide a way to transmit multiple commands to the Redis server
@@ -59,19 +122,30 @@ class BasePipeline(object):
     instance of an exception as a potential value. In general, these will be
     ResponseError exceptions, such as those raised when issuing a command
     on a key of a different datatype.
+
+    After a connection error the pipeline is sent again as the client's
+    retry policy allows, unless it was sent already and holds a command
+    that isn't idempotent.
     """
 
     UNWATCH_COMMANDS = set(('DISCARD', 'EXEC', 'UNWATCH'))
 
     def __init__(self, connection_pool, response_callbacks, transaction,
-                 shard_hint):
+                 shard_hint, flush_size=None, retry_policy=None,
+                 non_idempotent_commands=(), non_idempotent_options=None):
         self.connection_pool = connection_pool
         self.connection = None
         self.response_callbacks = response_callbacks
         self.transaction = transaction
         self.shard_hint = shard_hint
+        self.flush_size = flush_size
+        self.retry_policy = retry_policy or RetryPolicy(max_attempts=2)
+        self.non_idempotent_commands = non_idempotent_commands
+        self.non_idempotent_options = non_idempotent_options or {}
 
         self.watching = False
+        self._in_flight = False
+        self.pid = os.getpid()
         self.reset()
 
     def __enter__(self):
@@ -90,6 +164,24 @@ class BasePipeline(object):
         return len(self.command_stack)
 
     def reset(self):
+        if self.pid != os.getpid():
+            self.after_fork()
+        # commands written ahead by a flushing pipeline still have their
+        # replies queued on the socket, the connection can't be reused
+        if self._in_flight and self.connection:
+            self.connection.disconnect()
+        self._in_flight = False
+        self._write_buffer = None
+        self._write_buffer_size = 0
+        self._flush_failed = False
+        # the connection error of commands written ahead, which execute()
+        # counts as a first attempt that was sent
+        self._flush_error = None
+        # whether commands went out on the connection, so that the server
+        # may have run them
+        self._sent = False
+        self._references_issued = False
+        self._staged = False
         self.command_stack = []
         self.scripts = set()
         # make sure to reset the connection state in the event that we were
@@ -112,6 +204,39 @@ class BasePipeline(object):
             self.connection_pool.release(self.connection)
             self.connection = None
 
+    def after_fork(self):
+        """
+        Drop the connection inherited from the parent process, leaving it
+        intact there. Queued commands are kept and sent on a new connection,
+        a WATCH is lost. Commands the parent wrote ahead may have run, so
+        they are sent again only if they are all idempotent, as after a
+        connection error. Does nothing if the process didn't fork.
+        """
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        if self.connection:
+            forget_connection(self.connection)
+            self.connection = None
+        self.watching = False
+        # commands written ahead went out on the parent's connection, so
+        # execute() has to send the whole stack
+        if self._sent and self._flush_error is None:
+            self._flush_error = ConnectionError(
+                'The process forked after commands of the pipeline were sent')
+        self._in_flight = False
+        self._write_buffer = None
+        self._flush_failed = True
+
+    def _checkpid(self):
+        if self.pid != os.getpid():
+            watching = self.watching
+            self.after_fork()
+            if watching:
+                self.reset()
+                raise WatchError("The process forked while watching one or "
+                                 "more keys")
+
     def multi(self):
         """
         Start a transactional block of the pipeline after WATCH commands
@@ -137,6 +262,7 @@ class BasePipeline(object):
         issuing WATCH or subsequent commands retrieving their values but before
         MULTI is called.
         """
+        self._checkpid()
         command_name = args[0]
         conn = self.connection
         # if this is the first call, we need a connection
@@ -144,23 +270,33 @@ class BasePipeline(object):
             conn = self.connection_pool.get_connection(command_name,
                                                        self.shard_hint)
             self.connection = conn
-        try:
-            conn.send_command(*args)
-            return self.parse_response(conn, command_name, **options)
-        except (ConnectionError, TimeoutError) as e:
-            conn.disconnect()
-            if not conn.retry_on_timeout and isinstance(e, TimeoutError):
-                raise
-            # if we're not already watching, we can safely retry the command
+        attempt = 1
+        while 1:
+            sent = False
             try:
-                if not self.watching:
-                    conn.send_command(*args)
-                    return self.parse_response(conn, command_name, **options)
-            except ConnectionError:
-                # the retry failed so cleanup.
+                conn.send_packed_command(pack_command(conn, args))
+                sent = True
+                response = self.parse_response(conn, command_name, **options)
+            except (ConnectionError, TimeoutError) as e:
                 conn.disconnect()
-                self.reset()
-                raise
+                record_failure(self.connection_pool)
+                if not conn.retry_on_timeout and isinstance(e, TimeoutError):
+                    raise
+                # the WATCH is lost with the connection, see execute()
+                if self.watching:
+                    self.reset()
+                    raise WatchError("A ConnectionError occured on while "
+                                     "watching one or more keys")
+                if not self._should_retry(attempt, (args,), sent):
+                    # cleanup if the retry failed
+                    if attempt > 1:
+                        self.reset()
+                    raise
+                attempt += 1
+                continue
+            if attempt > 1:
+                self.retry_policy.stats.incr('recovered')
+            return response
 
     def pipeline_execute_command(self, *args, **options):
         """
@@ -174,12 +310,107 @@ class BasePipeline(object):
         At some other point, you can then run: pipe.execute(),
         which will execute all commands queued in the pipe.
         """
+        if self._references_issued and self._check_references(args):
+            # commands depending on earlier results can't be written ahead
+            self._staged = True
+        elif self.flushing:
+            self._buffer_command(args)
         self.command_stack.append((args, options))
         return self
 
+    def ref(self, index=-1):
+        """
+        Return a Reference to the result of the queued command at ``index``,
+        by default the one queued last. Commands taking a Reference as an
+        argument are executed in a later round trip than the command they
+        refer to, all others are sent together with the first one.
+        """
+        if self.transaction or self.explicit_transaction:
+            raise RedisError("Results can't be referenced in a transaction")
+        size = len(self.command_stack)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError('No command #%d queued in pipeline' % index)
+        self._references_issued = True
+        return Reference(index)
+
+    def _check_references(self, args):
+        found = False
+        for arg in args:
+            if isinstance(arg, Reference):
+                if arg.index >= len(self.command_stack):
+                    raise RedisError('%r refers to a command not queued yet'
+                                     % arg)
+                found = True
+        return found
+
+    @property
+    def flushing(self):
+        "Indicates if queued commands are written before execute() is called"
+        return bool(self.flush_size) and not self._flush_failed and \
+            not (self.transaction or self.explicit_transaction)
+
+    def _buffer_command(self, args):
+        conn = self.connection
+        if not conn:
+            conn = self.connection_pool.get_connection('MULTI',
+                                                       self.shard_hint)
+            self.connection = conn
+        if self._write_buffer is None:
+            self._write_buffer = []
+        for chunk in pack_command(conn, args):
+            self._write_buffer.append(chunk)
+            self._write_buffer_size += len(chunk)
+        if self._write_buffer_size < self.flush_size:
+            return
+        self._checkpid()
+        if not self.flushing:
+            # the process forked, execute() sends everything
+            return
+
+        all_cmds = coalesce(self._write_buffer)
+        self._write_buffer = []
+        self._write_buffer_size = 0
+        self._in_flight = True
+        self._sent = True
+        try:
+            conn.send_packed_command(all_cmds)
+        except (ConnectionError, TimeoutError) as e:
+            # the server may have run what made it there. stop writing ahead
+            # and let execute() handle this as a failed first attempt, so
+            # the stack is only sent again if that is safe
+            conn.disconnect()
+            record_failure(self.connection_pool)
+            self._in_flight = False
+            self._write_buffer = None
+            self._flush_failed = True
+            self._flush_error = e
+
+    def _execute_aside(self, *args, **options):
+        # our own connection may have replies pending for commands written
+        # ahead, so commands needing an answer now use another connection
+        return RedisBase.execute_command(self, *args, **options)
+
+    def _send_pipeline(self, connection, commands):
+        if self._write_buffer is not None:
+            # a flushing pipeline has packed everything already and possibly
+            # written most of it, only the rest of the buffer is left to send
+            all_cmds = coalesce(self._write_buffer)
+            self._write_buffer = None
+        else:
+            # build up all commands into a single request to increase
+            # network perf, without copying large values
+            all_cmds = pack_buffers(connection,
+                                    [args for args, _ in commands])
+        self._in_flight = True
+        self._sent = True
+        connection.send_packed_command(all_cmds)
+
     def _execute_transaction(self, connection, commands, raise_on_error):
         cmds = chain([(('MULTI',), {})], commands, [(('EXEC',), {})])
-        all_cmds = connection.pack_commands([args for args, _ in cmds])
+        all_cmds = pack_buffers(connection, [args for args, _ in cmds])
+        self._sent = True
         connection.send_packed_command(all_cmds)
         errors = []
 
@@ -239,9 +470,7 @@ class BasePipeline(object):
         return data
 
     def _execute_pipeline(self, connection, commands, raise_on_error):
-        # build up all commands into a single request to increase network perf
-        all_cmds = connection.pack_commands([args for args, _ in commands])
-        connection.send_packed_command(all_cmds)
+        self._send_pipeline(connection, commands)
 
         response = []
         for args, options in commands:
@@ -250,18 +479,93 @@ class BasePipeline(object):
                     self.parse_response(connection, args[0], **options))
             except ResponseError:
                 response.append(sys.exc_info()[1])
+        self._in_flight = False
 
         if raise_on_error:
             self.raise_first_error(commands, response)
         return response
 
+    def _execute_pipeline_iter(self, connection, commands, raise_on_error):
+        # same wire format as _execute_pipeline, but each reply is handed to
+        # the caller as soon as it has been read off the socket
+        self._send_pipeline(connection, commands)
+
+        error = None
+        for i, (args, options) in enumerate(commands):
+            try:
+                r = self.parse_response(connection, args[0], **options)
+            except ResponseError:
+                r = sys.exc_info()[1]
+                if raise_on_error and error is None:
+                    self.annotate_exception(r, i + 1, args)
+                    error = r
+            # once an error is pending we keep reading so the connection is
+            # left in a clean state, but stop handing out replies
+            if error is None:
+                yield r
+        self._in_flight = False
+
+        if error is not None:
+            raise error
+
+    def _execute_staged(self, connection, commands, raise_on_error):
+        # each command runs one stage after the latest one it refers to, so
+        # the number of round trips is the length of the longest dependency
+        # chain rather than the number of dependent commands
+        stages = []
+        stage_of = []
+        for args, _ in commands:
+            stage = 0
+            for arg in args:
+                if isinstance(arg, Reference):
+                    stage = max(stage, stage_of[arg.index] + 1)
+            stage_of.append(stage)
+            if stage == len(stages):
+                stages.append([])
+            stages[stage].append(len(stage_of) - 1)
+
+        response = [None] * len(commands)
+        resolved = list(commands)
+        for stage in stages:
+            batch = []
+            for i in stage:
+                args, options = commands[i]
+                try:
+                    args = tuple([self._resolve(arg, response, i)
+                                  for arg in args])
+                except ResponseError:
+                    response[i] = sys.exc_info()[1]
+                    continue
+                resolved[i] = (args, options)
+                batch.append(i)
+            if not batch:
+                continue
+            replies = self._execute_pipeline(
+                connection, [resolved[i] for i in batch], False)
+            for i, r in izip(batch, replies):
+                response[i] = r
+
+        if raise_on_error:
+            self.raise_first_error(resolved, response)
+        return response
+
+    def _resolve(self, arg, response, number):
+        if not isinstance(arg, Reference):
+            return arg
+        if isinstance(response[arg.index], Exception):
+            raise ResponseError('Command # %d depends on the result of '
+                                'command # %d which failed'
+                                % (number + 1, arg.index + 1))
+        return arg.resolve(response)
+
     def raise_first_error(self, commands, response):
         for i, r in enumerate(response):
             if isinstance(r, ResponseError):
                 self.annotate_exception(r, i + 1, commands[i][0])
                 raise r
 
-    def annotate_exception(self, exception, number, command):
+    @staticmethod
+    def annotate_exception(exception, number, command):
         cmd = unicode(' ').join(imap(unicode, command))
         msg = unicode('Command # %d (%s) of pipeline caused error: %s') % (
             number, cmd, unicode(exception.args[0]))
@@ -291,15 +595,42 @@ class BasePipeline(object):
                     s.sha = immediate('SCRIPT', 'LOAD', s.script,
                                       **{'parse': 'LOAD'})
 
-    def execute(self, raise_on_error=True):
-        "Execute all the commands in the current pipeline"
+    def _first_attempt(self, conn, stack):
+        """
+        Return the number of the next attempt to send ``stack``, 2 if writing
+        it ahead failed. Raises the error of that failure if the stack can't
+        be sent again.
+        """
+        error = self._flush_error
+        if error is None:
+            return 1
+        self._flush_error = None
+        if not conn.retry_on_timeout and isinstance(error, TimeoutError):
+            raise error
+        if not self._should_retry(1, [args for args, _ in stack], True):
+            raise error
+        self._sent = False
+        return 2
+
+    def execute(self, raise_on_error=True, timeout=None, deadline=None):
+        """
+        Execute all the commands in the current pipeline.
+
+        A ``timeout`` in seconds or an absolute ``deadline``, a time.time()
+        value, limit how long this call waits on the socket, see
+        ``execute_command``.
+        """
         stack = self.command_stack
         if not stack:
             return []
-        if self.scripts:
+        deadline = get_deadline(timeout, deadline)
+        self._checkpid()
+        if self.scripts and not self.flushing:
             self.load_scripts()
         if self.transaction or self.explicit_transaction:
             execute = self._execute_transaction
+        elif self._staged:
+            execute = self._execute_staged
         else:
             execute = self._execute_pipeline
 
@@ -312,25 +643,118 @@ class BasePipeline(object):
             self.connection = conn
 
         try:
-            return execute(conn, stack, raise_on_error)
-        except (ConnectionError, TimeoutError) as e:
-            conn.disconnect()
-            if not conn.retry_on_timeout and isinstance(e, TimeoutError):
-                raise
-            # if we were watching a variable, the watch is no longer valid
-            # since this connection has died. raise a WatchError, which
-            # indicates the user should retry his transaction. If this is more
-            # than a temporary failure, the WATCH that the user next issues
-            # will fail, propegating the real ConnectionError
-            if self.watching:
-                raise WatchError("A ConnectionError occured on while watching "
-                                 "one or more keys")
-            # otherwise, it's safe to retry since the transaction isn't
-            # predicated on any state
-            return execute(conn, stack, raise_on_error)
+            attempt = self._first_attempt(conn, stack)
+            while 1:
+                left = time_left(deadline)
+                try:
+                    with socket_timeout(conn, left):
+                        response = execute(conn, stack, raise_on_error)
+                except (ConnectionError, TimeoutError) as e:
+                    conn.disconnect()
+                    if deadline is None or not isinstance(e, TimeoutError):
+                        record_failure(self.connection_pool)
+                    if not conn.retry_on_timeout and \
+                            isinstance(e, TimeoutError):
+                        raise
+                    # if we were watching a variable, the watch is no longer
+                    # valid since this connection has died. raise a
+                    # WatchError, which indicates the user should retry his
+                    # transaction. If this is more than a temporary failure,
+                    # the WATCH that the user next issues will fail,
+                    # propegating the real ConnectionError
+                    if self.watching:
+                        raise WatchError("A ConnectionError occured on while "
+                                         "watching one or more keys")
+                    # otherwise, it's safe to retry since the transaction
+                    # isn't predicated on any state, unless the commands may
+                    # have run already
+                    if not self._should_retry(
+                            attempt, [args for args, _ in stack], self._sent):
+                        raise
+                    attempt += 1
+                    self._sent = False
+                    continue
+                if attempt > 1:
+                    self.retry_policy.stats.incr('recovered')
+                return response
         finally:
             self.reset()
 
+    def execute_iter(self, raise_on_error=True):
+        """
+        Execute all the commands in the current pipeline, yielding each
+        parsed reply as soon as it is read off the socket instead of
+        collecting them into a list first.
+
+        Replies of a transaction only arrive together with EXEC, and commands
+        referring to earlier results need them all, so for those pipelines
+        the replies are yielded from the list returned by execute().
+
+        If ``raise_on_error`` is set, the first ResponseError is raised, with
+        the same annotation execute() adds, after all replies have been read;
+        replies following it are not yielded. Abandoning the iterator before
+        it is exhausted disconnects the pipeline's connection.
+        """
+        stack = self.command_stack
+        if not stack:
+            return
+        if self.transaction or self.explicit_transaction or self._staged:
+            for r in self.execute(raise_on_error):
+                yield r
+            return
+        self._checkpid()
+        if self.scripts and not self.flushing:
+            self.load_scripts()
+
+        conn = self.connection
+        if not conn:
+            conn = self.connection_pool.get_connection('MULTI',
+                                                       self.shard_hint)
+            self.connection = conn
+
+        # whether every reply has been read off the socket
+        drained = False
+        # a reply that has been handed out can't be taken back, so retrying
+        # is only safe until the first one was yielded
+        started = False
+        try:
+            attempt = self._first_attempt(conn, stack)
+            while 1:
+                try:
+                    for r in self._execute_pipeline_iter(conn, stack,
+                                                         raise_on_error):
+                        started = True
+                        yield r
+                except (ConnectionError, TimeoutError) as e:
+                    conn.disconnect()
+                    record_failure(self.connection_pool)
+                    if started:
+                        raise
+                    if not conn.retry_on_timeout and \
+                            isinstance(e, TimeoutError):
+                        raise
+                    if self.watching:
+                        raise WatchError("A ConnectionError occured on while "
+                                         "watching one or more keys")
+                    if not self._should_retry(
+                            attempt, [args for args, _ in stack], self._sent):
+                        raise
+                    attempt += 1
+                    self._sent = False
+                    continue
+                if attempt > 1:
+                    self.retry_policy.stats.incr('recovered')
+                break
+            drained = True
+        except ResponseError:
+            drained = True
+            raise
+        finally:
+            if not drained:
+                # unread replies are still queued on the socket
+                conn.disconnect()
+            self.reset()
+
     def watch(self, *names):
         "Watches the values at keys ``names``"
         if self.explicit_transaction:
@@ -343,6 +767,18 @@ class BasePipeline(object):
 
     def script_load_for_pipeline(self, script):
         "Make sure scripts are loaded prior to pipeline execution"
+        if self.flushing:
+            # EVALSHA may be on the wire before execute() is called, so the
+            # server has to know the script right away
+            if script not in self.scripts:
+                if not script.sha or not self._execute_aside(
+                        'SCRIPT', 'EXISTS', script.sha,
+                        **{'parse': 'EXISTS'})[0]:
+                    script.sha = self._execute_aside('SCRIPT', 'LOAD',
+                                                     script.script,
+                                                     **{'parse': 'LOAD'})
+                self.scripts.add(script)
+            return
         # we need the sha now so that Script.__call__ can use it to run
         # evalsha.
         if not script.sha:
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 *-*
+from itertools import izip
+
+
+class PreparedCommand(object):
+    """
+    A command with its constant arguments packed in advance, returned by
+    ``RedisBase.prepare``. Calling it with the missing arguments runs the
+    command on ``client``, or queues it if that's a pipeline, passing any
+    keyword arguments on as ``execute_command`` options.
+    """
+
+    def __init__(self, client, template):
+        self.client = client
+        self.template = template
+
+    def __repr__(self):
+        args = [str(self.template)] + [
+            '?' if arg is None else repr(arg)
+            for arg in self.template.args[1:]]
+        return '%s<%s>' % (type(self).__name__, ' '.join(args))
+
+    def __call__(self, *values, **options):
+        template = self.template
+        if len(values) != len(template.slots):
+            raise TypeError('Prepared %s takes %d arguments (%d given)' %
+                            (template, len(template.slots), len(values)))
+        args = list(template.args)
+        for slot, value in izip(template.slots, values):
+            args[slot] = value
+        return self.client.execute_command(*args, **options)
+
+    def using(self, client):
+        "Return this command run on ``client``, e.g. a pipeline"
+        return PreparedCommand(client, self.template)
@@ -1,23 +1,32 @@
 # -*- coding: utf-8 *-*
-from __future__ import absolute_import
+from __future__ import absolute_import, with_statement
 
+import os
+import select
 import threading
-import time as mod_time
 
-from redis._compat import bytes, imap, iteritems, iterkeys, nativestr, unicode
+from redis._compat import (b, bytes, imap, iteritems, iterkeys, nativestr, u,
+                           unicode)
 from redis.exceptions import ConnectionError, PubSubError, TimeoutError
 
+from ..connection import forget_connection, record_failure
 from .base import RedisBase
+from .retry import RetryPolicy
 from .utils import list_or_args
 
 
 class PubSubCommands(RedisBase):
+    NON_IDEMPOTENT_COMMANDS = set(('PUBLISH',))
+    KEY_SPECS = dict.fromkeys(('PUBLISH', 'PSUBSCRIBE', 'PUNSUBSCRIBE',
+                               'SUBSCRIBE', 'UNSUBSCRIBE'))
+
     def pubsub(self, **kwargs):
         """
         Return a Publish/Subscribe object. With this object, you can
         subscribe to channels and listen for messages that get published to
         them.
         """
+        kwargs.setdefault('retry_policy', self.retry_policy)
         return PubSub(self.connection_pool, **kwargs)
 
     def publish(self, channel, message):
@@ -28,6 +37,70 @@ class PubSubCommands(RedisBase):
         return self.execute_command('PUBLISH', channel, message)
 
 
+class Message(object):
+    """
+    A message of a PubSub with ``message_class=Message``, holding the
+    fields of the usual message dicts as attributes without a dict for
+    each message. ``message['data']`` works as well.
+    """
+    __slots__ = ('type', 'pattern', 'channel', 'data')
+
+    def __init__(self, type, pattern, channel, data):
+        self.type = type
+        self.pattern = pattern
+        self.channel = channel
+        self.data = data
+
+    def __repr__(self):
+        return '%s<type=%r, pattern=%r, channel=%r, data=%r>' % (
+            type(self).__name__, self.type, self.pattern, self.channel,
+            self.data)
+
+    def __reduce__(self):
+        return type(self), self._fields()
+
+    def _fields(self):
+        return self.type, self.pattern, self.channel, self.data
+
+    def __getitem__(self, field):
+        if field not in self.__slots__:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __eq__(self, other):
+        if isinstance(other, Message):
+            return self._fields() == other._fields()
+        if isinstance(other, dict):
+            return other == self.as_dict()
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def as_dict(self):
+        "Return the message as a dict like those of PubSub by default"
+        return _message_dict(*self._fields())
+
+
+def _message_dict(type, pattern, channel, data):
+    return {'type': type, 'pattern': pattern, 'channel': channel,
+            'data': data}
+
+
+def _message_tuple(*fields):
+    return fields
+
+
+_MESSAGE_TYPES = ('message', 'pmessage', 'subscribe', 'unsubscribe',
+                  'psubscribe', 'punsubscribe', 'pong')
+# the message types, interned, by the bytes or text they are read as
+MESSAGE_TYPES = dict([(b(name), name) for name in _MESSAGE_TYPES] +
+                     [(u(name), name) for name in _MESSAGE_TYPES])
+
+
 class PubSub(object):
     """
     PubSub provides publish, subscribe and listen support to Redis channels.
@@ -35,16 +108,39 @@ class PubSub(object):
     After subscribing to one or more channels, the listen() method will block
     until a message arrives on one of the subscribed channels. That message
     will be returned and it's safe to start listening again.
+
+    After a connection error, the connection is made again, subscribing to
+    the same channels and patterns, as often as the RetryPolicy
+    ``retry_policy`` allows, by default once.
+
+    Message handlers are called by the thread reading the messages, or by
+    the workers of a ``handler_pool``, see HandlerPool, so that slow ones
+    don't hold up reading.
+
+    Messages are dicts, or with ``message_class=Message`` Message objects
+    with the same fields, or with ``message_class=tuple`` (type, pattern,
+    channel, data) tuples, which spares allocating a dict per message.
     """
     PUBLISH_MESSAGE_TYPES = ('message', 'pmessage')
     UNSUBSCRIBE_MESSAGE_TYPES = ('unsubscribe', 'punsubscribe')
 
     def __init__(self, connection_pool, shard_hint=None,
-                 ignore_subscribe_messages=False):
+                 ignore_subscribe_messages=False, retry_policy=None,
+                 handler_pool=None, message_class=dict):
         self.connection_pool = connection_pool
+        self.handler_pool = handler_pool
+        self.message_class = message_class
+        if message_class is dict:
+            self._make_message = _message_dict
+        elif message_class is tuple:
+            self._make_message = _message_tuple
+        else:
+            self._make_message = message_class
+        self.retry_policy = retry_policy or RetryPolicy(max_attempts=2)
         self.shard_hint = shard_hint
         self.ignore_subscribe_messages = ignore_subscribe_messages
         self.connection = None
+        self.pid = os.getpid()
         # we need to know the encoding options for this connection in order
         # to lookup channel and pattern names for callback handlers.
         conn = connection_pool.get_connection('pubsub', shard_hint)
@@ -66,6 +162,7 @@ class PubSub(object):
             pass
 
     def reset(self):
+        self._checkpid()
         if self.connection:
             self.connection.disconnect()
             self.connection.clear_connect_callbacks()
@@ -77,6 +174,24 @@ class PubSub(object):
     def close(self):
         self.reset()
 
+    def _checkpid(self):
+        if self.pid != os.getpid():
+            self.after_fork()
+
+    def after_fork(self):
+        """
+        Drop the connection inherited from the parent process, leaving it
+        and its subscriptions intact there. Channels and patterns are
+        subscribed to again on a new connection with the next command or
+        read. Does nothing if the process didn't fork.
+        """
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        if self.connection:
+            forget_connection(self.connection)
+            self.connection = None
+
     def on_connect(self, connection):
         "Re-subscribe to any channels and patterns previously subscribed to"
         # NOTE: for python3, we can't pass bytestrings as keyword arguments
@@ -120,35 +235,58 @@ class PubSub(object):
         # legitmate message off the stack if the connection is already
         # subscribed to one or more channels
 
+        self._checkpid()
         if self.connection is None:
-            self.connection = self.connection_pool.get_connection(
-                'pubsub',
-                self.shard_hint
-            )
-            # register a callback that re-subscribes to any channels we
-            # were listening to when we were disconnected
-            self.connection.register_connect_callback(self.on_connect)
+            self._get_connection()
         connection = self.connection
         self._execute(connection, connection.send_command, *args)
 
+    def _get_connection(self):
+        self.connection = self.connection_pool.get_connection(
+            'pubsub',
+            self.shard_hint
+        )
+        # register a callback that re-subscribes to any channels we
+        # were listening to when we were disconnected
+        self.connection.register_connect_callback(self.on_connect)
+        return self.connection
+
     def _execute(self, connection, command, *args):
-        try:
-            return command(*args)
-        except (ConnectionError, TimeoutError) as e:
-            connection.disconnect()
-            if not connection.retry_on_timeout and isinstance(e, TimeoutError):
-                raise
-            # Connect manually here. If the Redis server is down, this will
-            # fail and raise a ConnectionError as desired.
-            connection.connect()
-            # the ``on_connect`` callback should haven been called by the
-            # connection to resubscribe us to any channels and patterns we were
-            # previously listening to
-            return command(*args)
+        attempt = 1
+        while 1:
+            try:
+                # the connection is made again after a failed attempt. If
+                # the Redis server is down, this will fail and raise a
+                # ConnectionError as desired.
+                if attempt > 1:
+                    connection.connect()
+                # the ``on_connect`` callback should haven been called by the
+                # connection to resubscribe us to any channels and patterns
+                # we were previously listening to
+                response = command(*args)
+            except (ConnectionError, TimeoutError) as e:
+                connection.disconnect()
+                record_failure(self.connection_pool)
+                if not connection.retry_on_timeout and \
+                        isinstance(e, TimeoutError):
+                    raise
+                # subscribing and reading messages are safe to repeat
+                if not self.retry_policy.retry(attempt):
+                    raise
+                attempt += 1
+                continue
+            if attempt > 1:
+                self.retry_policy.stats.incr('recovered')
+            return response
 
     def parse_response(self, block=True):
         "Parse the response from a publish/subscribe command"
+        self._checkpid()
         connection = self.connection
+        if connection is None and self.subscribed:
+            # the process forked, connecting subscribes us again
+            connection = self._get_connection()
+            self._execute(connection, connection.connect)
         if not block and not connection.can_read():
             return None
         return self._execute(connection, connection.read_response)
@@ -227,27 +365,51 @@ class PubSub(object):
             return self.handle_message(response, ignore_subscribe_messages)
         return None
 
+    def get_messages(self, max_count=None, ignore_subscribe_messages=False):
+        """
+        Return the messages available, reading up to ``max_count`` replies.
+        Unlike calling ``get_message`` repeatedly, this only polls the
+        socket again once the replies already buffered are read.
+        """
+        messages = []
+        # nothing to read before subscribing
+        if self.connection is None or max_count == 0:
+            return messages
+        response = self.parse_response(block=False)
+        count = 0
+        while response is not None:
+            message = self.handle_message(response, ignore_subscribe_messages)
+            if message is not None:
+                messages.append(message)
+            count += 1
+            if count == max_count:
+                break
+            response = self._read_buffered()
+        return messages
+
+    def _read_buffered(self):
+        # the next reply if it has been received, only polling the socket
+        # when the parser has nothing buffered
+        connection = self.connection
+        if connection is None:
+            return None
+        if connection._parser.can_read() or connection.can_read():
+            return self.parse_response(block=True)
+        return None
+
     def handle_message(self, response, ignore_subscribe_messages=False):
         """
         Parses a pub/sub message. If the channel or pattern was subscribed to
         with a message handler, the handler is invoked instead of a parsed
         message being returned.
         """
-        message_type = nativestr(response[0])
+        message_type = MESSAGE_TYPES.get(response[0])
+        if message_type is None:
+            message_type = nativestr(response[0])
         if message_type == 'pmessage':
-            message = {
-                'type': message_type,
-                'pattern': response[1],
-                'channel': response[2],
-                'data': response[3]
-            }
+            pattern, channel, data = response[1], response[2], response[3]
         else:
-            message = {
-                'type': message_type,
-                'pattern': None,
-                'channel': response[1],
-                'data': response[2]
-            }
+            pattern, channel, data = None, response[1], response[2]
 
         # if this is an unsubscribe message, remove it from memory
         if message_type in self.UNSUBSCRIBE_MESSAGE_TYPES:
@@ -257,7 +419,7 @@ class PubSub(object):
             else:
                 subscribed_dict = self.channels
             try:
-                del subscribed_dict[message['channel']]
+                del subscribed_dict[channel]
             except KeyError:
                 pass
 
@@ -265,11 +427,16 @@ class PubSub(object):
             # if there's a message handler, invoke it
             handler = None
             if message_type == 'pmessage':
-                handler = self.patterns.get(message['pattern'], None)
+                handler = self.patterns.get(pattern, None)
             else:
-                handler = self.channels.get(message['channel'], None)
+                handler = self.channels.get(channel, None)
             if handler:
-                handler(message)
+                message = self._make_message(message_type, pattern, channel,
+                                             data)
+                if self.handler_pool is not None:
+                    self.handler_pool.dispatch(channel, handler, message)
+                else:
+                    handler(message)
                 return None
         else:
             # this is a subscribe/unsubscribe message. ignore if we don't
@@ -277,34 +444,86 @@ class PubSub(object):
             if ignore_subscribe_messages or self.ignore_subscribe_messages:
                 return None
 
-        return message
+        return self._make_message(message_type, pattern, channel, data)
 
     def run_in_thread(self, sleep_time=0):
+        """
+        Return a started PubSubWorkerThread calling the handlers of the
+        messages until it's stopped or all channels and patterns are
+        unsubscribed. It waits on the socket in between, ``sleep_time`` is
+        no longer used.
+        """
         for channel, handler in iteritems(self.channels):
             if handler is None:
                 raise PubSubError("Channel: '%s' has no handler registered")
         for pattern, handler in iteritems(self.patterns):
             if handler is None:
                 raise PubSubError("Pattern: '%s' has no handler registered")
-        pubsub = self
+        thread = PubSubWorkerThread(self)
+        thread.start()
+        return thread
 
-        class WorkerThread(threading.Thread):
-            def __init__(self, *args, **kwargs):
-                super(WorkerThread, self).__init__(*args, **kwargs)
-                self._running = False
 
-            def run(self):
-                if self._running:
-                    return
-                self._running = True
-                while self._running and pubsub.subscribed:
-                    pubsub.get_message(ignore_subscribe_messages=True)
-                    mod_time.sleep(sleep_time)
+def _wait_readable(fds, timeout=None):
+    # poll where there is, as select fails for descriptors past FD_SETSIZE
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        for fd in fds:
+            poller.register(fd, select.POLLIN)
+        poller.poll(None if timeout is None else timeout * 1000)
+    else:
+        select.select(fds, [], [], timeout)
+
+
+class PubSubWorkerThread(threading.Thread):
+    """
+    Thread handling the messages of ``pubsub``, see ``PubSub.run_in_thread``.
+
+    It blocks on the socket of the connection until messages arrive, then
+    handles all that have been received before waiting again. ``stop()``
+    wakes it through a pipe, so it ends right away.
+    """
+
+    def __init__(self, pubsub):
+        super(PubSubWorkerThread, self).__init__()
+        self.pubsub = pubsub
+        self._running = False
+        self._lock = threading.Lock()
+        self._wakeup_read = self._wakeup_write = None
+
+    def start(self):
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        self._running = True
+        super(PubSubWorkerThread, self).start()
 
-            def stop(self):
+    def run(self):
+        pubsub = self.pubsub
+        try:
+            while self._running and pubsub.subscribed:
+                # parse_response connects again if needed
+                response = pubsub.parse_response(block=False)
+                while response is not None:
+                    pubsub.handle_message(response,
+                                          ignore_subscribe_messages=True)
+                    if not self._running:
+                        return
+                    response = pubsub._read_buffered()
+                connection = pubsub.connection
+                sock = connection and connection._sock
+                if sock is not None and self._running and pubsub.subscribed:
+                    _wait_readable([sock.fileno(), self._wakeup_read])
+        finally:
+            # under the lock, so stop() doesn't write to a closed pipe
+            with self._lock:
                 self._running = False
-                self.join()
+                os.close(self._wakeup_read)
+                os.close(self._wakeup_write)
 
-        thread = WorkerThread()
-        thread.start()
-        return thread
+    def stop(self):
+        "Stop handling messages and wait for the thread to end"
+        with self._lock:
+            if self._running:
+                self._running = False
+                os.write(self._wakeup_write, b('x'))
+        if threading.current_thread() is not self and self.is_alive():
+            self.join()
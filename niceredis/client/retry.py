@@ -0,0 +1,91 @@
+# -*- coding: utf-8 *-*
+import random
+import threading
+import time as mod_time
+
+
+class RetryStats(object):
+    """
+    Counts what happened to operations failing with a connection error:
+    ``retries`` of them, those ``recovered`` by a retry, those given up on
+    once the attempts were ``exhausted``, and those not retried as
+    ``unsafe`` because the server may have run them already.
+    """
+    COUNTERS = ('retries', 'recovered', 'exhausted', 'unsafe')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def incr(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def get(self):
+        "Return a copy of the counters"
+        with self._lock:
+            return dict(self._counters)
+
+    def reset(self):
+        with self._lock:
+            self._counters = dict.fromkeys(self.COUNTERS, 0)
+
+
+class RetryPolicy(object):
+    """
+    Decides how often and how fast a failed operation is tried again.
+
+    ``max_attempts`` is the total number of attempts including the first
+    one, None allows any number of them. The delay before the n-th retry is
+    ``backoff * 2 ** (n - 1)`` seconds, capped at ``max_backoff``. With
+    ``jitter`` a random delay between 0 and that value is used instead, so
+    clients failing at the same moment don't retry at the same moment.
+
+    What the retries came to is counted in ``stats``, a RetryStats.
+    """
+
+    def __init__(self, max_attempts=None, backoff=0, max_backoff=1.0,
+                 jitter=True):
+        if max_attempts is not None and max_attempts < 1:
+            raise ValueError('"max_attempts" must be a positive integer')
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.stats = RetryStats()
+
+    def __repr__(self):
+        return '%s<max_attempts=%s,backoff=%s,max_backoff=%s>' % (
+            type(self).__name__, self.max_attempts, self.backoff,
+            self.max_backoff)
+
+    def should_retry(self, attempt):
+        "Indicates if another attempt may follow the failed ``attempt``"
+        return self.max_attempts is None or attempt < self.max_attempts
+
+    def get_delay(self, attempt):
+        "Return the seconds to wait after the failed ``attempt``"
+        if not self.backoff:
+            return 0
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def sleep(self, attempt):
+        "Wait before retrying the failed ``attempt``"
+        delay = self.get_delay(attempt)
+        if delay:
+            mod_time.sleep(delay)
+
+    def retry(self, attempt):
+        """
+        Count and wait before retrying the failed ``attempt``, or count it as
+        exhausted and return False if no attempt may follow
+        """
+        if not self.should_retry(attempt):
+            self.stats.incr('exhausted')
+            return False
+        self.stats.incr('retries')
+        self.sleep(attempt)
+        return True
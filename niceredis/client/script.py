@@ -3,9 +3,18 @@ from redis.exceptions import NoScriptError
 
 from .base import RedisBase
 from .pipeline import BasePipeline
+from .utils import dict_merge, numkeys_positions, string_keys_to_dict
 
 
 class ScriptCommands(RedisBase):
+    # scripts may do anything
+    NON_IDEMPOTENT_COMMANDS = set(('EVAL', 'EVALSHA'))
+    KEY_SPECS = dict_merge(
+        string_keys_to_dict('EVAL EVALSHA', numkeys_positions(2)),
+        dict.fromkeys(('SCRIPT EXISTS', 'SCRIPT FLUSH', 'SCRIPT KILL',
+                       'SCRIPT LOAD'))
+    )
+
     def eval(self, script, numkeys, *keys_and_args):
         """
         Execute the Lua ``script``, specifying the ``numkeys`` the script
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 *-*
+from __future__ import absolute_import, with_statement
+
+import threading
+import time as mod_time
+import weakref
+
+from redis._compat import iteritems, nativestr
+from redis.exceptions import ConnectionError, ResponseError, TimeoutError
+from redis.sentinel import MasterNotFoundError, SlaveNotFoundError
+
+from ..connection.sentinel import SentinelConnectionPool
+from .client import StrictRedis
+
+
+class SentinelClient(object):
+    """
+    Redis Sentinel client, resolving the master and the replicas of
+    monitored services through the sentinels.
+
+    >>> sentinel = SentinelClient([('localhost', 26379)], socket_timeout=0.1)
+    >>> master = sentinel.master_for('mymaster')
+    >>> master.set('foo', 'bar')
+    >>> replica = sentinel.replica_for('mymaster')
+    >>> replica.get('foo')
+    'bar'
+
+    Resolved addresses are cached. Instead of polling, a background thread
+    listens to the sentinels' ``+switch-master`` and replica ``+sdown``,
+    ``-sdown`` and ``+slave`` events, updates the cache and drops the pooled
+    connections to the node that went away only. Pass ``watch=False`` to
+    not start it, the cache is then only refreshed when connecting to a
+    cached address fails.
+
+    ``min_other_sentinels`` is the minimum number of peers a sentinel must
+    see for its answers to be considered valid.
+
+    ``sentinel_kwargs`` are the connection arguments used for the
+    sentinels. By default the socket_* options of ``connection_kwargs`` are
+    used, which in turn are the arguments for connections to the Redis
+    servers.
+    """
+    WATCH_RETRY_INTERVAL = 1.0
+
+    def __init__(self, sentinels, min_other_sentinels=0, sentinel_kwargs=None,
+                 watch=True, **connection_kwargs):
+        # if sentinel_kwargs isn't defined, use the socket_* options from
+        # connection_kwargs
+        if sentinel_kwargs is None:
+            sentinel_kwargs = dict([(k, v)
+                                    for k, v in iteritems(connection_kwargs)
+                                    if k.startswith('socket_')
+                                    ])
+        self.sentinel_kwargs = sentinel_kwargs
+        self.sentinels = [StrictRedis(hostname, port, **self.sentinel_kwargs)
+                          for hostname, port in sentinels]
+        self.min_other_sentinels = min_other_sentinels
+        self.connection_kwargs = connection_kwargs
+        self.watch = watch
+        self._lock = threading.Lock()
+        self._masters = {}
+        self._replicas = {}
+        # pool -> service name of the pools we handed out
+        self._pools = weakref.WeakKeyDictionary()
+        self._watcher = None
+        self._watch_pubsub = None
+        self._closed = False
+
+    def __repr__(self):
+        sentinel_addresses = []
+        for sentinel in self.sentinels:
+            sentinel_addresses.append('%s:%s' % (
+                sentinel.connection_pool.connection_kwargs['host'],
+                sentinel.connection_pool.connection_kwargs['port'],
+            ))
+        return '%s<sentinels=[%s]>' % (
+            type(self).__name__,
+            ','.join(sentinel_addresses))
+
+    def check_master_state(self, state, service_name):
+        if not state['is_master'] or state['is_sdown'] or state['is_odown']:
+            return False
+        # Check if our sentinel doesn't see other nodes
+        if state['num-other-sentinels'] < self.min_other_sentinels:
+            return False
+        return True
+
+    def discover_master(self, service_name):
+        """
+        Asks sentinel servers for the Redis master's address corresponding
+        to the service labeled ``service_name``, bypassing the cache.
+
+        Returns a pair (address, port) or raises MasterNotFoundError if no
+        master is found.
+        """
+        sentinels = self.sentinels
+        for sentinel_no, sentinel in enumerate(sentinels):
+            try:
+                masters = sentinel.sentinel_masters()
+            except (ConnectionError, TimeoutError):
+                continue
+            state = masters.get(service_name)
+            if state and self.check_master_state(state, service_name):
+                # Put this sentinel at the top of the list
+                sentinels[0], sentinels[sentinel_no] = (
+                    sentinel, sentinels[0])
+                return state['ip'], state['port']
+        raise MasterNotFoundError("No master found for %r" % (service_name,))
+
+    def filter_replicas(self, replicas):
+        "Remove replicas that are in an ODOWN or SDOWN state"
+        replicas_alive = []
+        for replica in replicas:
+            if replica['is_odown'] or replica['is_sdown']:
+                continue
+            replicas_alive.append((replica['ip'], replica['port']))
+        return replicas_alive
+
+    def discover_replicas(self, service_name):
+        """
+        Returns a list of alive replicas for service ``service_name``,
+        bypassing the cache
+        """
+        for sentinel in self.sentinels:
+            try:
+                replicas = sentinel.sentinel_slaves(service_name)
+            except (ConnectionError, TimeoutError, ResponseError):
+                continue
+            replicas = self.filter_replicas(replicas)
+            if replicas:
+                return replicas
+        return []
+
+    def master_address(self, service_name, discover=True):
+        """
+        Returns the cached master address of ``service_name``, asking the
+        sentinels if it isn't cached. With ``discover`` False, None is
+        returned instead.
+        """
+        address = self._masters.get(service_name)
+        if address is None and discover:
+            address = self.discover_master(service_name)
+            with self._lock:
+                address = self._masters.setdefault(service_name, address)
+        return address
+
+    def replica_addresses(self, service_name, discover=True):
+        """
+        Returns the cached replica addresses of ``service_name``, asking the
+        sentinels if they aren't cached. With ``discover`` False, None is
+        returned instead.
+        """
+        addresses = self._replicas.get(service_name)
+        if addresses is None and discover:
+            addresses = self.discover_replicas(service_name)
+            with self._lock:
+                addresses = self._replicas.setdefault(service_name, addresses)
+        return addresses
+
+    def invalidate(self, service_name=None):
+        """
+        Forget the cached addresses of ``service_name``, or of all services,
+        so that they're asked from the sentinels again when next needed.
+        """
+        with self._lock:
+            if service_name is None:
+                self._masters.clear()
+                self._replicas.clear()
+            else:
+                self._masters.pop(service_name, None)
+                self._replicas.pop(service_name, None)
+
+    def _drop_address(self, service_name, address, is_master=None):
+        for pool, name in list(self._pools.items()):
+            if name == service_name and \
+                    (is_master is None or pool.is_master == is_master):
+                pool.drop_address(address)
+
+    def on_switch_master(self, message):
+        """
+        Handles a ``+switch-master`` event: the service's master moved from
+        one address to another.
+        """
+        service_name, old_ip, old_port, new_ip, new_port = \
+            nativestr(message['data']).split()
+        with self._lock:
+            self._masters[service_name] = (new_ip, int(new_port))
+            # the new master used to be a replica, the old one may come
+            # back as one
+            self._replicas.pop(service_name, None)
+        self._drop_address(service_name, (old_ip, int(old_port)))
+
+    def on_instance_event(self, message):
+        """
+        Handles ``+sdown``, ``-sdown`` and ``+slave`` events, of which only
+        the ones about replicas are relevant:
+        ``slave <name> <ip> <port> @ <master name> <master ip> <master port>``
+        """
+        parts = nativestr(message['data']).split()
+        if parts[0] != 'slave' or '@' not in parts:
+            return
+        service_name = parts[parts.index('@') + 1]
+        with self._lock:
+            self._replicas.pop(service_name, None)
+        if nativestr(message['channel']) == '+sdown':
+            self._drop_address(service_name, (parts[2], int(parts[3])),
+                               is_master=False)
+
+    def _start_watching(self):
+        with self._lock:
+            if self._watcher is not None or self._closed:
+                return
+            self._watcher = threading.Thread(target=self._watch)
+            self._watcher.daemon = True
+        self._watcher.start()
+
+    def _watch(self):
+        handlers = {
+            '+switch-master': self.on_switch_master,
+            '+sdown': self.on_instance_event,
+            '-sdown': self.on_instance_event,
+            '+slave': self.on_instance_event,
+        }
+        # block for events as long as it takes
+        kwargs = dict(self.sentinel_kwargs, socket_timeout=None)
+        while not self._closed:
+            for sentinel in list(self.sentinels):
+                pool_kwargs = sentinel.connection_pool.connection_kwargs
+                client = StrictRedis(pool_kwargs['host'], pool_kwargs['port'],
+                                     **kwargs)
+                try:
+                    pubsub = client.pubsub(ignore_subscribe_messages=True)
+                    self._watch_pubsub = pubsub
+                    pubsub.subscribe(**handlers)
+                    # events may have been missed while we weren't listening
+                    self.invalidate()
+                    for _ in pubsub.listen():
+                        pass
+                except (ConnectionError, TimeoutError):
+                    pass
+                finally:
+                    self._watch_pubsub = None
+                    client.connection_pool.disconnect()
+                if self._closed:
+                    return
+            # no sentinel is reachable right now
+            mod_time.sleep(self.WATCH_RETRY_INTERVAL)
+
+    def close(self):
+        "Stop listening to the sentinels' events"
+        self._closed = True
+        pubsub = self._watch_pubsub
+        if pubsub is not None:
+            try:
+                # ends the watcher's listen() loop
+                pubsub.unsubscribe()
+            except (ConnectionError, TimeoutError):
+                pass
+
+    def _client_for(self, service_name, is_master, redis_class,
+                    connection_pool_class, kwargs):
+        connection_kwargs = dict(self.connection_kwargs)
+        connection_kwargs.update(kwargs)
+        # the master and the replicas each get a circuit breaker of their own
+        if connection_kwargs.get('circuit_breaker') is not None:
+            connection_kwargs['circuit_breaker'] = \
+                connection_kwargs['circuit_breaker'].copy()
+        pool = connection_pool_class(service_name, self, is_master=is_master,
+                                     **connection_kwargs)
+        with self._lock:
+            self._pools[pool] = service_name
+        if self.watch:
+            self._start_watching()
+        return redis_class(connection_pool=pool)
+
+    def master_for(self, service_name, redis_class=StrictRedis,
+                   connection_pool_class=SentinelConnectionPool, **kwargs):
+        """
+        Returns a redis client instance for the ``service_name`` master.
+
+        All other keyword arguments are merged with any connection_kwargs
+        passed to this class and passed to the connection pool as keyword
+        arguments to be used to initialize Redis connections.
+        """
+        return self._client_for(service_name, True, redis_class,
+                                connection_pool_class, kwargs)
+
+    def replica_for(self, service_name, redis_class=StrictRedis,
+                    connection_pool_class=SentinelConnectionPool, **kwargs):
+        """
+        Returns a redis client instance for the ``service_name`` replicas,
+        balancing connections over them round robin. Falls back to the
+        master when no replica is available.
+
+        All other keyword arguments are merged with any connection_kwargs
+        passed to this class and passed to the connection pool as keyword
+        arguments to be used to initialize Redis connections.
+        """
+        return self._client_for(service_name, False, redis_class,
+                                connection_pool_class, kwargs)
@@ -5,9 +5,24 @@ from redis.connection import Token
 from redis.exceptions import ConnectionError, RedisError
 
 from .base import RedisBase
+from .utils import dict_merge
 
 
 class ServerCommands(RedisBase):
+    KEY_SPECS = dict_merge(
+        dict.fromkeys((
+            'BGREWRITEAOF', 'BGSAVE', 'CLIENT GETNAME', 'CLIENT KILL',
+            'CLIENT LIST', 'CLIENT SETNAME', 'CONFIG GET', 'CONFIG RESETSTAT',
+            'CONFIG REWRITE', 'CONFIG SET', 'DBSIZE', 'ECHO', 'FLUSHALL',
+            'FLUSHDB', 'INFO', 'LASTSAVE', 'PING', 'SAVE', 'SHUTDOWN',
+            'SLAVEOF', 'SLOWLOG GET', 'SLOWLOG LEN', 'SLOWLOG RESET', 'TIME')),
+        dict.fromkeys((
+            'SENTINEL GET-MASTER-ADDR-BY-NAME', 'SENTINEL MASTER',
+            'SENTINEL MASTERS', 'SENTINEL MONITOR', 'SENTINEL REMOVE',
+            'SENTINEL SENTINELS', 'SENTINEL SET', 'SENTINEL SLAVES')),
+        {'OBJECT': (2, 2, 1)}
+    )
+
     # SERVER INFORMATION
 
     def bgrewriteaof(self):
@@ -2,10 +2,19 @@
 from redis.connection import Token
 
 from .base import RedisBase
-from .utils import list_or_args
+from .utils import ALL_KEYS, dict_merge, list_or_args, string_keys_to_dict
 
 
 class SetCommands(RedisBase):
+    READ_ONLY_COMMANDS = set(('SCARD', 'SDIFF', 'SINTER', 'SISMEMBER',
+                              'SMEMBERS', 'SRANDMEMBER', 'SSCAN', 'SUNION'))
+    NON_IDEMPOTENT_COMMANDS = set(('SMOVE', 'SPOP'))
+    KEY_SPECS = dict_merge(
+        string_keys_to_dict('SDIFF SDIFFSTORE SINTER SINTERSTORE SUNION '
+                            'SUNIONSTORE', ALL_KEYS),
+        {'SMOVE': (1, 2, 1)}
+    )
+
     # SET COMMANDS
     def sadd(self, name, *values):
         "Add ``value(s)`` to set ``name``"
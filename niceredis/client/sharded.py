@@ -0,0 +1,427 @@
+# -*- coding: utf-8 *-*
+from __future__ import absolute_import, with_statement
+
+import hashlib
+import os
+import threading
+from bisect import bisect, insort
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from redis._compat import b, basestring, iteritems
+from redis.exceptions import RedisError, ResponseError
+
+from ..connection import get_deadline
+from .base import RedisBase
+from .client import StrictRedis
+from .pipeline import BasePipeline
+from .utils import SINGLE_KEY, hash_tag
+
+
+class HashRing(object):
+    """
+    Consistent hash ring mapping keys to node names. Each node is placed on
+    the ring ``vnodes`` times, so keys spread evenly and adding or removing
+    a node only moves the keys between it and its neighbours.
+    """
+
+    def __init__(self, nodes=(), vnodes=160):
+        self.vnodes = vnodes
+        self._points = []
+        self._nodes = {}
+        for node in nodes:
+            self.add_node(node)
+
+    @staticmethod
+    def hash(value):
+        return int(hashlib.md5(value).hexdigest()[:8], 16)
+
+    def add_node(self, node):
+        for i in range(self.vnodes):
+            point = self.hash(b('%s-%s' % (node, i)))
+            # the first node keeps a point both happen to hash to
+            if point not in self._nodes:
+                self._nodes[point] = node
+                insort(self._points, point)
+
+    def remove_node(self, node):
+        for point, name in list(iteritems(self._nodes)):
+            if name == node:
+                del self._nodes[point]
+                self._points.remove(point)
+
+    def get_node(self, key):
+        "Return the node of the encoded ``key``"
+        if not self._points:
+            raise RedisError('The hash ring has no nodes')
+        index = bisect(self._points, self.hash(key)) % len(self._points)
+        return self._nodes[self._points[index]]
+
+
+# the pipeline classes made for each pipeline base and client class
+_PIPELINE_CLASSES = {}
+
+
+def _concat(replies):
+    merged = []
+    for reply in replies:
+        merged.extend(reply)
+    return merged
+
+
+def _all_of_each(replies):
+    return [all(flags) for flags in zip(*replies)]
+
+
+class ShardedPipelineBase(object):
+    """
+    Pipeline of a ShardedRedis. The queued commands are bucketed by the
+    shard they go to. Each bucket runs as a pipeline of its own on one of
+    its shard's connections, all buckets concurrently, and the replies are
+    put back in the order the commands were queued in.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.command_stack = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def reset(self):
+        self.command_stack = []
+
+    def execute_command(self, *args, **options):
+        "Queue a command, checking its keys go to a single shard"
+        client = self.client
+        routes = set([client._route(args[i])
+                      for i in client.get_key_positions(args)])
+        if len(routes) != 1:
+            raise RedisError('Pipelined commands need keys that go to one '
+                             'shard, %s has keys going to %d' %
+                             (args[0], len(routes)))
+        self.command_stack.append((routes.pop(), args, options))
+        return self
+
+    def _execute_bucket(self, shard, commands, deadline):
+        pipe = shard.pipeline(transaction=False)
+        for _, args, options in commands:
+            pipe.execute_command(*args, **options)
+        return pipe.execute(raise_on_error=False, deadline=deadline)
+
+    def _handle_errors(self, stack, response):
+        "Hook to retry the commands that failed"
+
+    def execute(self, raise_on_error=True, timeout=None, deadline=None):
+        """
+        Execute all the queued commands, returning their replies in order.
+        ``timeout`` and ``deadline`` apply to the pipelines of all shards,
+        see BasePipeline.execute.
+        """
+        stack = self.command_stack
+        self.reset()
+        if not stack:
+            return []
+        deadline = get_deadline(timeout, deadline)
+        client = self.client
+        # shard client -> indexes of its commands in the stack
+        buckets = {}
+        for index, (route, _, _) in enumerate(stack):
+            shard = client._get_route_shard(route)
+            buckets.setdefault(shard, []).append(index)
+        shards = list(buckets)
+        bucket_replies = client.run_concurrently([
+            partial(self._execute_bucket, shard,
+                    [stack[i] for i in buckets[shard]], deadline)
+            for shard in shards])
+        response = [None] * len(stack)
+        for shard, replies in zip(shards, bucket_replies):
+            for index, reply in zip(buckets[shard], replies):
+                response[index] = reply
+        self._handle_errors(stack, response)
+        if raise_on_error:
+            for index, reply in enumerate(response):
+                if isinstance(reply, ResponseError):
+                    # numbered in the order of this pipeline, not the
+                    # bucket's
+                    BasePipeline.annotate_exception(reply, index + 1,
+                                                    stack[index][1])
+                    raise reply
+        return response
+
+
+class ShardedRedis(StrictRedis):
+    """
+    Client spreading keys over several independent Redis servers, the
+    shards, by consistent hashing.
+
+    >>> r = ShardedRedis({'a': ('10.0.0.1', 6379), 'b': ('10.0.0.2', 6379)})
+    >>> r.set('foo', 'bar')
+    >>> r.get_shard_name('foo')
+    'b'
+
+    ``shards`` maps shard names to clients, redis:// URLs or (host, port)
+    pairs, from which clients are made with ``connection_kwargs``. A list
+    of those is named by position. Keys are placed by the names, so a shard
+    can move to another address without moving its keys.
+
+    With ``hash_tags``, only the part of a key between the first ``{`` and
+    ``}`` is hashed, like in Redis Cluster, to put related keys on the same
+    shard.
+
+    Commands are routed by their keys. MGET, MSET and DEL with keys on
+    several shards are split, run on the shards concurrently and the
+    replies combined in the order of the keys; other commands with keys on
+    several shards raise a RedisError. Commands without keys run on all
+    shards, returning a dict of the replies by shard name, except for
+    those in BROADCAST_REPLIES whose replies are combined.
+
+    Pipelines run the commands of each shard concurrently, see
+    ShardedPipelineBase. Transactions and pub/sub need a single shard, see
+    ``get_shard``.
+    """
+    pipeline_base = ShardedPipelineBase
+    # how the replies of a command split over shards are combined
+    SPLIT_REPLIES = {
+        'DEL': sum,
+        'MGET': None,  # in the order of the keys
+        'MSET': all,
+    }
+    # how the replies of a command without keys run on all shards are
+    # combined
+    BROADCAST_REPLIES = {
+        'DBSIZE': sum,
+        'FLUSHALL': all,
+        'FLUSHDB': all,
+        'KEYS': _concat,
+        'PING': all,
+        'PUBLISH': sum,
+        'SCRIPT EXISTS': _all_of_each,
+        'SCRIPT FLUSH': all,
+        # identical on all shards
+        'SCRIPT LOAD': lambda replies: replies[0],
+    }
+
+    def __init__(self, shards, vnodes=160, hash_tags=True,
+                 redis_class=StrictRedis, **connection_kwargs):
+        self.hash_tags = hash_tags
+        self.encoding = connection_kwargs.get('encoding', 'utf-8')
+        self.encoding_errors = connection_kwargs.get('encoding_errors',
+                                                     'strict')
+        self.redis_class = redis_class
+        self.connection_kwargs = connection_kwargs
+        self.shards = {}
+        self.ring = HashRing(vnodes=vnodes)
+        if not isinstance(shards, dict):
+            shards = dict(enumerate(shards))
+        for name, shard in iteritems(shards):
+            self.add_shard(name, shard)
+        # the replies are those of the shards made with connection_kwargs
+        self.protocol = connection_kwargs.get('protocol') or getattr(
+            connection_kwargs.get('parser_class'), 'protocol', 2)
+        # shared with those shards, so their retries are counted together
+        self._init_commands(connection_kwargs.get('retry_policy'))
+        self._executor = None
+        self._executor_pid = None
+        self._executor_size = 0
+        # how many calls are running on each executor
+        self._executor_users = {}
+        self._executor_lock = threading.Lock()
+
+    def __repr__(self):
+        return '%s<shards=[%s]>' % (
+            type(self).__name__,
+            ','.join(['%s=%r' % item for item in sorted(self.shards.items())]))
+
+    def add_shard(self, name, shard):
+        """
+        Add the shard ``name``: a client, a redis:// URL or a (host, port)
+        pair. Only keys placed next to its points on the ring move to it.
+        """
+        if isinstance(shard, basestring):
+            shard = self.redis_class.from_url(shard, **self._node_kwargs())
+        elif not isinstance(shard, RedisBase):
+            host, port = shard
+            shard = self.redis_class(host, port, **self._node_kwargs())
+        self.shards[name] = shard
+        self.ring.add_node(name)
+        return shard
+
+    def _node_kwargs(self):
+        # each node gets a circuit breaker of its own
+        kwargs = dict(self.connection_kwargs)
+        if kwargs.get('circuit_breaker') is not None:
+            kwargs['circuit_breaker'] = kwargs['circuit_breaker'].copy()
+        return kwargs
+
+    def remove_shard(self, name):
+        "Remove the shard ``name``, its keys now map to the other shards"
+        self.ring.remove_node(name)
+        return self.shards.pop(name)
+
+    def get_shard_name(self, key):
+        "Return the name of the shard ``key`` is stored on"
+        key = self.encode_key(key)
+        if self.hash_tags:
+            key = hash_tag(key)
+        return self.ring.get_node(key)
+
+    def get_shard(self, key):
+        "Return the client of the shard ``key`` is stored on"
+        return self.shards[self.get_shard_name(key)]
+
+    def _acquire_executor(self):
+        size = max(len(self.shards), 1)
+        with self._executor_lock:
+            if self._executor_pid != os.getpid():
+                # the threads of a pool made before a fork don't exist here
+                self._executor = None
+                self._executor_users = {}
+            elif self._executor is not None and self._executor_size < size:
+                # a thread for each shard added since, the old pool is
+                # closed once the calls running on it are done
+                old = self._executor
+                self._executor = None
+                self._close_if_unused(old)
+            if self._executor is None:
+                self._executor = ThreadPool(size)
+                self._executor_pid = os.getpid()
+                self._executor_size = size
+            executor = self._executor
+            self._executor_users[executor] = \
+                self._executor_users.get(executor, 0) + 1
+            return executor
+
+    def _release_executor(self, executor):
+        with self._executor_lock:
+            if executor in self._executor_users:
+                self._executor_users[executor] -= 1
+                self._close_if_unused(executor)
+
+    def _close_if_unused(self, executor):
+        # with the lock held
+        if executor is not self._executor and \
+                not self._executor_users.get(executor):
+            self._executor_users.pop(executor, None)
+            executor.close()
+
+    def run_concurrently(self, functions):
+        """
+        Call ``functions`` concurrently and return their results in order.
+        The first error is raised once all are done.
+        """
+        if len(functions) == 1:
+            return [functions[0]()]
+        executor = self._acquire_executor()
+        try:
+            return executor.map(lambda function: function(), functions)
+        finally:
+            self._release_executor(executor)
+
+    def _route(self, key):
+        "Return where the commands on ``key`` go, passed to _execute_on"
+        return self.get_shard_name(key)
+
+    def _get_route_shard(self, route):
+        return self.shards[route]
+
+    def _execute_on(self, route, args, options):
+        return self._get_route_shard(route).execute_command(*args, **options)
+
+    def execute_command(self, *args, **options):
+        "Execute a command on the shards holding its keys"
+        command_name = args[0]
+        positions = self.get_key_positions(args)
+        if not positions:
+            return self._broadcast(args, options)
+        names = [self._route(args[i]) for i in positions]
+        if len(set(names)) == 1:
+            return self._execute_on(names[0], args, options)
+        if command_name not in self.SPLIT_REPLIES:
+            raise RedisError('The keys of %s are on different shards, use '
+                             'hash tags to put them on the same one'
+                             % command_name)
+        return self._split(args, options, positions, names)
+
+    def _split(self, args, options, positions, names):
+        command_name = args[0]
+        spec = self.key_specs.get(command_name, SINGLE_KEY)
+        # each key goes along with the arguments up to the next one, e.g.
+        # its value in MSET
+        step = isinstance(spec, tuple) and spec[2] or 1
+        order = []
+        # shard name -> (its arguments, the indexes of its keys)
+        shard_args = {}
+        for index, (position, name) in enumerate(zip(positions, names)):
+            if name not in shard_args:
+                order.append(name)
+                shard_args[name] = ([command_name], [])
+            pieces, indexes = shard_args[name]
+            pieces.extend(args[position:position + step])
+            indexes.append(index)
+        replies = self.run_concurrently([
+            partial(self._execute_on, name, shard_args[name][0], options)
+            for name in order])
+        combine = self.SPLIT_REPLIES[command_name]
+        if combine is not None:
+            return combine(replies)
+        merged = [None] * len(positions)
+        for name, reply in zip(order, replies):
+            for index, value in zip(shard_args[name][1], reply):
+                merged[index] = value
+        return merged
+
+    def _broadcast_names(self):
+        return sorted(self.shards)
+
+    def _broadcast(self, args, options):
+        names = self._broadcast_names()
+        replies = self.run_concurrently([
+            partial(self.shards[name].execute_command, *args, **options)
+            for name in names])
+        combine = self.BROADCAST_REPLIES.get(args[0])
+        if combine is not None:
+            return combine(replies)
+        return dict(zip(names, replies))
+
+    def scan_iter(self, match=None, count=None):
+        "Iterate over the keys of all shards, one shard after the other"
+        for name in self._broadcast_names():
+            for key in self.shards[name].scan_iter(match=match, count=count):
+                yield key
+
+    def after_fork(self):
+        "Drop the connections inherited from the parent process"
+        for shard in self.shards.values():
+            shard.after_fork()
+
+    def pool_stats(self):
+        "Return the counters of the connection pool of each shard by name"
+        return dict([(name, shard.pool_stats())
+                     for name, shard in iteritems(self.shards)])
+
+    def pipeline(self, transaction=False, shard_hint=None):
+        """
+        Return a pipeline running the commands of each shard concurrently,
+        see ShardedPipelineBase. Transactions are not supported.
+        """
+        if transaction:
+            raise RedisError('Use get_shard(key).pipeline() for a '
+                             'transaction on the shard holding the keys')
+        bases = (self.pipeline_base, type(self))
+        cls = _PIPELINE_CLASSES.get(bases)
+        if cls is None:
+            cls = _PIPELINE_CLASSES.setdefault(
+                bases, type('ShardedPipeline', bases, {}))
+        return cls(self)
+
+    def _single_shard_only(self, *args, **kwargs):
+        raise RedisError('Use get_shard(key) to get the client of the shard '
+                         'holding the keys')
+    pubsub = transaction = _single_shard_only
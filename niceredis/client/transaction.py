@@ -0,0 +1,74 @@
+# -*- coding: utf-8 *-*
+import re
+import threading
+
+from redis._compat import basestring, nativestr
+
+
+class ConflictStats(object):
+    """
+    Counts how transactions run with ``transaction()`` end, grouped by a
+    pattern of the keys they watch. Runs of digits in key names are replaced
+    by ``*``, so ``user:1:visits`` and ``user:2:visits`` are counted together
+    as ``user:*:visits``.
+    """
+    DIGITS = re.compile(r'\d+')
+    COUNTERS = ('transactions', 'attempts', 'conflicts', 'commits',
+                'fallbacks', 'aborts')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._patterns = {}
+
+    def pattern(self, names):
+        "Return the pattern watched keys ``names`` are counted under"
+        parts = []
+        for name in names:
+            if not isinstance(name, basestring):
+                name = str(name)
+            parts.append(self.DIGITS.sub('*', nativestr(name)))
+        return ' '.join(parts)
+
+    def record(self, pattern, attempts, outcome):
+        """
+        Record a transaction on ``pattern`` that took ``attempts`` and
+        ended with ``outcome``, one of 'commit', 'fallback' or 'abort'
+        """
+        with self._lock:
+            counters = self._patterns.get(pattern)
+            if counters is None:
+                counters = self._patterns[pattern] = dict.fromkeys(
+                    self.COUNTERS, 0)
+            counters['transactions'] += 1
+            counters['attempts'] += attempts
+            if outcome == 'commit':
+                counters['conflicts'] += attempts - 1
+                counters['commits'] += 1
+            else:
+                counters['conflicts'] += attempts
+                counters[outcome + 's'] += 1
+
+    def get(self, pattern):
+        "Return a copy of the counters of ``pattern``"
+        with self._lock:
+            counters = self._patterns.get(pattern)
+            if counters is None:
+                return dict.fromkeys(self.COUNTERS, 0)
+            return dict(counters)
+
+    def conflict_rate(self, pattern):
+        "Return the share of attempts on ``pattern`` that hit a conflict"
+        counters = self.get(pattern)
+        if not counters['attempts']:
+            return 0.0
+        return float(counters['conflicts']) / counters['attempts']
+
+    def snapshot(self):
+        "Return a copy of the counters of all patterns"
+        with self._lock:
+            return dict((pattern, dict(counters))
+                        for pattern, counters in self._patterns.items())
+
+    def reset(self):
+        with self._lock:
+            self._patterns = {}
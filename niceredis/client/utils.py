@@ -23,3 +23,68 @@ def dict_merge(*dicts):
     merged = {}
     [merged.update(d) for d in dicts]
     return merged
+
+
+def merge_class_sets(cls, attribute):
+    "Union of the sets named ``attribute`` of ``cls`` and its base classes"
+    merged = set()
+    for klass in cls.__mro__:
+        merged.update(vars(klass).get(attribute, ()))
+    return merged
+
+
+def merge_class_dicts(cls, attribute):
+    """
+    Merge the dicts named ``attribute`` of ``cls`` and its base classes,
+    subclasses overriding their bases
+    """
+    merged = {}
+    for klass in reversed(cls.__mro__):
+        merged.update(vars(klass).get(attribute, {}))
+    return merged
+
+
+# Where the keys are among the arguments of a command, as in the reply of
+# COMMAND INFO: the positions of the first and the last key and the step
+# between them, a negative last position counting from the end. None for
+# commands without keys, or a function returning the positions of the keys
+# in the arguments it's passed.
+SINGLE_KEY = (1, 1, 1)
+ALL_KEYS = (1, -1, 1)
+
+
+def numkeys_positions(numkeys_at, leading=()):
+    """
+    Key positions of a command taking a count of keys at ``numkeys_at``,
+    followed by the keys, and possibly keys at the ``leading`` positions
+    """
+    def positions(args):
+        first = numkeys_at + 1
+        last = first + int(args[numkeys_at])
+        return list(leading) + list(range(first, last))
+    return positions
+
+
+def key_positions(args, spec=SINGLE_KEY):
+    "Return the positions of the keys in the arguments ``args`` of a command"
+    if spec is None:
+        return []
+    if callable(spec):
+        return spec(args)
+    first, last, step = spec
+    if last < 0:
+        last += len(args)
+    return list(range(first, min(last, len(args) - 1) + 1, step))
+
+
+def hash_tag(key):
+    """
+    Return the part of the encoded ``key`` that decides where it's stored:
+    the first non-empty ``{...}`` section of it, if any, else all of it
+    """
+    start = key.find(b'{')
+    if start != -1:
+        end = key.find(b'}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
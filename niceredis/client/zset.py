@@ -4,9 +4,19 @@ from redis.connection import Token
 from redis.exceptions import RedisError
 
 from .base import RedisBase
+from .utils import numkeys_positions, string_keys_to_dict
 
 
 class ZsetCommands(RedisBase):
+    READ_ONLY_COMMANDS = set(('ZCARD', 'ZCOUNT', 'ZLEXCOUNT', 'ZRANGE',
+                              'ZRANGEBYLEX', 'ZRANGEBYSCORE', 'ZRANK',
+                              'ZREVRANGE', 'ZREVRANGEBYSCORE', 'ZREVRANK',
+                              'ZSCAN', 'ZSCORE'))
+    NON_IDEMPOTENT_COMMANDS = set(('ZINCRBY',))
+    NON_IDEMPOTENT_OPTIONS = {'ZADD': set(('INCR',))}
+    KEY_SPECS = string_keys_to_dict('ZINTERSTORE ZUNIONSTORE',
+                                    numkeys_positions(2, leading=(1,)))
+
     # SORTED SET COMMANDS
     def zadd(self, name, *args, **kwargs):
         """
@@ -0,0 +1,9 @@
+from .breaker import CircuitBreaker, CircuitOpenError
+from .packer import CommandTemplate, EncodingCache, pack_command
+from .parser import BufferParser, Resp3Parser
+from .pool import (BoundedConnectionPool, ConnectionPool, forget_connection,
+                   record_failure)
+from .replica import (HedgingPolicy, ReplicaSelector, replication_info,
+                      wait_for_reply)
+from .timeouts import get_deadline, socket_timeout, time_left
+from .vectored import coalesce, pack_buffers
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 *-*
+from __future__ import with_statement
+
+import threading
+import time as mod_time
+from collections import deque
+
+from redis.exceptions import ConnectionError, RedisError
+
+
+class CircuitOpenError(ConnectionError):
+    "Raised instead of using a node whose circuit breaker is open"
+
+
+class CircuitBreaker(object):
+    """
+    Fails fast instead of waiting on a node that keeps failing.
+
+    The breaker is ``closed`` as long as less than ``failure_threshold``
+    connection errors and timeouts happen within ``window`` seconds. Then
+    it trips ``open`` and getting a connection from the pool raises a
+    CircuitOpenError right away. After ``reset_timeout`` seconds the next
+    caller turns it ``half-open`` and probes the node with a PING on a
+    connection of its own while other callers keep failing fast. If the
+    node answers the breaker closes, otherwise it opens again.
+
+    Each breaker guards one node, see ``copy``. ``add_listener`` registers
+    callbacks for the state changes and ``stats()`` returns the counters.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+    COUNTERS = ('failures', 'trips', 'rejected', 'probes', 'failed_probes')
+
+    def __init__(self, failure_threshold=5, window=10.0, reset_timeout=5.0):
+        if failure_threshold < 1:
+            raise ValueError('"failure_threshold" must be a positive integer')
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._state = self.CLOSED
+        self._failures = deque()
+        self._opened_at = None
+        self._stats = dict.fromkeys(self.COUNTERS, 0)
+
+    def __repr__(self):
+        return '%s<state=%s,failure_threshold=%s,window=%s>' % (
+            type(self).__name__, self._state, self.failure_threshold,
+            self.window)
+
+    def copy(self):
+        "Return a closed breaker with the same settings and listeners"
+        breaker = type(self)(self.failure_threshold, self.window,
+                             self.reset_timeout)
+        breaker._listeners = list(self._listeners)
+        return breaker
+
+    @property
+    def state(self):
+        "One of 'closed', 'open' or 'half-open'"
+        return self._state
+
+    def add_listener(self, callback):
+        """
+        Call ``callback(breaker, old_state, new_state)`` whenever the state
+        changes. It's called in the thread causing the change.
+        """
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def _set_state(self, state):
+        # called holding the lock, the listeners are called after releasing
+        # it
+        old_state = self._state
+        self._state = state
+        if state == self.OPEN:
+            self._opened_at = mod_time.time()
+            self._stats['trips'] += 1
+        elif state == self.CLOSED:
+            self._failures.clear()
+        return old_state
+
+    def _notify(self, old_state, new_state):
+        for callback in list(self._listeners):
+            callback(self, old_state, new_state)
+
+    def allow(self, probe):
+        """
+        Return if the node may be used, else raise a CircuitOpenError. Once
+        the breaker has been open for ``reset_timeout`` seconds, the node is
+        probed first by calling ``probe``, which raises a RedisError or
+        returns False when the node isn't healthy. Other errors of the probe
+        open the breaker again as well and are raised.
+        """
+        if self._state == self.CLOSED:
+            return
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            if self._state == self.HALF_OPEN or \
+                    mod_time.time() - self._opened_at < self.reset_timeout:
+                self._stats['rejected'] += 1
+                raise CircuitOpenError('Circuit breaker is %s' % self._state)
+            old_state = self._set_state(self.HALF_OPEN)
+            self._stats['probes'] += 1
+        self._notify(old_state, self.HALF_OPEN)
+
+        healthy = False
+        try:
+            healthy = probe()
+        except RedisError:
+            pass
+        finally:
+            # never left half-open, which would reject all calls for good
+            with self._lock:
+                if healthy:
+                    old_state = self._set_state(self.CLOSED)
+                else:
+                    self._stats['failed_probes'] += 1
+                    old_state = self._set_state(self.OPEN)
+            self._notify(old_state, self._state)
+        if not healthy:
+            raise CircuitOpenError('Circuit breaker is open, the node failed '
+                                   'a probe')
+
+    def record_failure(self):
+        "Count a connection error or timeout, tripping the breaker if due"
+        now = mod_time.time()
+        with self._lock:
+            self._stats['failures'] += 1
+            if self._state != self.CLOSED:
+                return
+            failures = self._failures
+            failures.append(now)
+            while failures and failures[0] <= now - self.window:
+                failures.popleft()
+            if len(failures) < self.failure_threshold:
+                return
+            old_state = self._set_state(self.OPEN)
+        self._notify(old_state, self.OPEN)
+
+    def stats(self):
+        """
+        Return the breaker's ``state`` and its counters: connection
+        ``failures``, ``trips`` to open, calls ``rejected`` while not
+        closed, ``probes`` and ``failed_probes``.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['state'] = self._state
+        return stats
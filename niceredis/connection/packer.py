@@ -0,0 +1,172 @@
+# -*- coding: utf-8 *-*
+from redis._compat import b, basestring, bytes, long, unicode
+from redis.connection import (SYM_CRLF, SYM_DOLLAR, SYM_EMPTY, SYM_STAR,
+                              Token)
+
+# values longer than this are sent as chunks of their own, as by
+# Connection.pack_command, so they aren't copied
+LARGE_VALUE = 6000
+
+
+def _bulk(value):
+    return SYM_EMPTY.join((SYM_DOLLAR, b(str(len(value))), SYM_CRLF, value,
+                           SYM_CRLF))
+
+
+class EncodingCache(object):
+    """
+    Memo of the bytes text arguments are encoded to, for the pool's
+    connections to encode with instead of ``Connection.encode``, see
+    ``ConnectionPool``. Byte strings are returned as they are before any
+    other check, text is looked up, anything else is encoded as usual.
+
+    At most ``size`` texts are kept, about the least recently used ones
+    are dropped: the memo is split in two generations, a text found in the
+    older one moves to the newer one, and once the newer one is full the
+    older one is dropped. This needs no lock, the counters may miss a few
+    hits or misses under concurrent use though. ``stats()`` returns them.
+    """
+
+    def __init__(self, size=10000, encoding='utf-8',
+                 encoding_errors='strict'):
+        if size < 2:
+            raise ValueError('"size" must be at least 2')
+        self.size = size
+        self.encoding = encoding
+        self.encoding_errors = encoding_errors
+        self._generation_size = size // 2
+        self.clear()
+
+    def __repr__(self):
+        return '%s<size=%s,encoding=%s>' % (type(self).__name__, self.size,
+                                            self.encoding)
+
+    def __len__(self):
+        return len(self._recent) + len(self._older)
+
+    def clear(self):
+        "Forget all texts and reset the counters"
+        self._recent = {}
+        self._older = {}
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, value):
+        "Return a bytestring representation of the value"
+        if value.__class__ is bytes:
+            return value
+        if value.__class__ is not unicode:
+            return self._encode(value)
+        recent = self._recent
+        encoded = recent.get(value)
+        if encoded is not None:
+            self.hits += 1
+            return encoded
+        encoded = self._older.get(value)
+        if encoded is None:
+            self.misses += 1
+            encoded = value.encode(self.encoding, self.encoding_errors)
+        else:
+            self.hits += 1
+        if len(recent) >= self._generation_size:
+            self._older = recent
+            self._recent = recent = {}
+        recent[value] = encoded
+        return encoded
+
+    def _encode(self, value):
+        # as Connection.encode
+        if isinstance(value, Token):
+            return b(value.value)
+        elif isinstance(value, bytes):
+            return value
+        elif isinstance(value, (int, long)):
+            value = b(str(value))
+        elif isinstance(value, float):
+            value = b(repr(value))
+        elif not isinstance(value, basestring):
+            value = str(value)
+        if isinstance(value, unicode):
+            value = value.encode(self.encoding, self.encoding_errors)
+        return value
+
+    def stats(self):
+        """
+        Return the counters: the texts ``cached`` right now, and in total
+        ``hits`` and ``misses`` and their ``hit_rate``
+        """
+        hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            'cached': len(self),
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': float(hits) / lookups if lookups else 0.0,
+        }
+
+
+class CommandTemplate(str):
+    """
+    Name of a prepared command, the arguments ``args`` with None in place
+    of those given per call, see ``RedisBase.prepare``. It equals the plain
+    command name, so callbacks and command sets apply as usual, while
+    ``pack_command`` packs the constant arguments just once and then only
+    encodes those at the ``slots``.
+    """
+
+    def __new__(cls, args):
+        template = str.__new__(cls, args[0])
+        template.args = (template,) + tuple(args[1:])
+        template.slots = tuple([i for i, arg in enumerate(args)
+                                if arg is None])
+        template._chunks = None
+        return template
+
+    def _compile(self, connection):
+        # the packed command split at the slots
+        words = self.split(' ')
+        pieces = [SYM_STAR, b(str(len(words) + len(self.args) - 1)),
+                  SYM_CRLF]
+        pieces.extend([_bulk(b(word)) for word in words])
+        chunks = []
+        for arg in self.args[1:]:
+            if arg is None:
+                chunks.append(SYM_EMPTY.join(pieces))
+                pieces = []
+            else:
+                pieces.append(_bulk(connection.encode(arg)))
+        chunks.append(SYM_EMPTY.join(pieces))
+        self._chunks = chunks
+        return chunks
+
+    def pack(self, connection, args):
+        "Pack ``args``, these arguments filled in, like ``pack_command``"
+        chunks = self._chunks
+        if chunks is None:
+            chunks = self._compile(connection)
+        encode = connection.encode
+        output = []
+        pieces = [chunks[0]]
+        for i, slot in enumerate(self.slots):
+            value = encode(args[slot])
+            header = SYM_EMPTY.join((SYM_DOLLAR, b(str(len(value))),
+                                     SYM_CRLF))
+            if len(value) > LARGE_VALUE:
+                pieces.append(header)
+                output.append(SYM_EMPTY.join(pieces))
+                output.append(value)
+                pieces = [SYM_CRLF, chunks[i + 1]]
+            else:
+                pieces.extend((header, value, SYM_CRLF, chunks[i + 1]))
+        output.append(SYM_EMPTY.join(pieces))
+        return output
+
+
+def pack_command(connection, args):
+    """
+    Pack the command ``args`` for ``connection``, a list of byte strings as
+    returned by ``Connection.pack_command``
+    """
+    if args[0].__class__ is CommandTemplate:
+        return args[0].pack(connection, args)
+    return connection.pack_command(*args)
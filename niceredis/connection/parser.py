@@ -0,0 +1,240 @@
+# -*- coding: utf-8 *-*
+import socket
+import sys
+
+from redis._compat import long, nativestr, xrange
+from redis.connection import (SERVER_CLOSED_CONNECTION_ERROR, SYM_CRLF,
+                              BaseParser)
+from redis.exceptions import (ConnectionError, InvalidResponse, RedisError,
+                              TimeoutError)
+
+from ..callbacks import pairs_to_dict
+
+SYM_ERROR, SYM_STATUS, SYM_INTEGER, SYM_BULK, SYM_ARRAY = map(ord, '-+:$*')
+# the types RESP3 adds
+(SYM_NULL, SYM_DOUBLE, SYM_BOOLEAN, SYM_BLOB_ERROR, SYM_VERBATIM,
+ SYM_BIG_NUMBER, SYM_MAP, SYM_SET, SYM_ATTRIBUTE, SYM_PUSH) = map(ord,
+                                                                  '_,#!=(%~|>')
+SYM_TRUE = ord('t')
+
+# how the elements of each aggregate type are turned into its reply
+AGGREGATES = {
+    SYM_ARRAY: None,
+    SYM_PUSH: None,
+    SYM_MAP: pairs_to_dict,
+    SYM_SET: set,
+}
+
+
+class BufferParser(BaseParser):
+    """
+    Plain Python parser for where hiredis isn't available, e.g. on PyPy.
+    Unlike PythonParser it reads into one reusable bytearray, finds the
+    lines in it by offset and copies out only the values, and it builds
+    nested arrays in a loop rather than by recursion. Needs Python 2.7 or
+    later for memoryview.
+
+    It parses the types of RESP3 as well, see Resp3Parser: maps become
+    dicts, sets sets, doubles floats and booleans bools, while attributes
+    are dropped.
+    """
+    encoding = None
+    # the protocol version the connections speak
+    protocol = 2
+    # a buffer grown beyond this for a large reply is dropped after it
+    max_buffer_size = 1024 * 1024
+
+    def __init__(self, socket_read_size):
+        self.socket_read_size = socket_read_size
+        self._sock = None
+        self._buffer = None
+        self._view = None
+        # offsets of the first unparsed byte and of the end of the data read
+        self._pos = self._end = 0
+
+    def __del__(self):
+        try:
+            self.on_disconnect()
+        except Exception:
+            pass
+
+    def on_connect(self, connection):
+        "Called when the socket connects"
+        self._sock = connection._sock
+        self._set_buffer(bytearray(self.socket_read_size))
+        if connection.decode_responses:
+            self.encoding = connection.encoding
+
+    def on_disconnect(self):
+        "Called when the socket disconnects"
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        self._buffer = self._view = None
+        self._pos = self._end = 0
+        self.encoding = None
+
+    def can_read(self):
+        return self._end > self._pos
+
+    def _set_buffer(self, buf):
+        self._buffer = buf
+        self._view = memoryview(buf)
+
+    def _fill(self, size):
+        "Read from the socket until ``size`` unparsed bytes are buffered"
+        while self._end - self._pos < size:
+            buf = self._buffer
+            if self._end == len(buf) or self._pos + size > len(buf):
+                # move the unparsed bytes to the front, into a larger
+                # buffer if they wouldn't fit
+                length = self._end - self._pos
+                if size > len(buf):
+                    new = bytearray(max(size, 2 * len(buf)))
+                    new[:length] = self._view[self._pos:self._end]
+                    self._set_buffer(new)
+                else:
+                    buf[:length] = buf[self._pos:self._end]
+                self._pos, self._end = 0, length
+            try:
+                read = self._sock.recv_into(self._view[self._end:])
+            except socket.timeout:
+                raise TimeoutError("Timeout reading from socket")
+            except socket.error:
+                e = sys.exc_info()[1]
+                raise ConnectionError("Error while reading from socket: %s" %
+                                      (e.args,))
+            if not read:
+                raise ConnectionError(SERVER_CLOSED_CONNECTION_ERROR)
+            self._end += read
+
+    def read_response(self):
+        if self._buffer is None:
+            raise ConnectionError(SERVER_CLOSED_CONNECTION_ERROR)
+        # the arrays being filled in, with their lengths
+        stack = []
+        while True:
+            pos = self._pos
+            crlf = self._buffer.find(SYM_CRLF, pos, self._end)
+            if crlf == -1:
+                self._fill(self._end - pos + 1)
+                continue
+            buf = self._buffer
+            byte = buf[pos]
+            self._pos = crlf + 2
+
+            if byte == SYM_BULK:
+                length = int(buf[pos + 1:crlf])
+                if length == -1:
+                    response = None
+                else:
+                    if self._end - self._pos < length + 2:
+                        self._fill(length + 2)
+                    pos = self._pos
+                    response = self._view[pos:pos + length].tobytes()
+                    self._pos = pos + length + 2
+                    if self.encoding:
+                        response = response.decode(self.encoding)
+            elif byte == SYM_INTEGER:
+                response = long(buf[pos + 1:crlf])
+            elif byte in AGGREGATES:
+                length = int(buf[pos + 1:crlf])
+                convert = AGGREGATES[byte]
+                if length == -1:
+                    response = None
+                elif length == 0:
+                    response = convert([]) if convert else []
+                else:
+                    if byte == SYM_MAP:
+                        length *= 2
+                    stack.append(([], length, convert))
+                    continue
+            elif byte == SYM_STATUS:
+                response = self._view[pos + 1:crlf].tobytes()
+                if self.encoding:
+                    response = response.decode(self.encoding)
+            elif byte == SYM_ERROR:
+                response = self.parse_error(
+                    nativestr(self._view[pos + 1:crlf].tobytes()))
+                # a ConnectionError is raised right away, other errors are
+                # returned to be raised by the connection or the pipeline
+                if isinstance(response, ConnectionError):
+                    raise response
+            elif byte == SYM_NULL:
+                response = None
+            elif byte == SYM_DOUBLE:
+                response = float(buf[pos + 1:crlf])
+            elif byte == SYM_BOOLEAN:
+                response = buf[pos + 1] == SYM_TRUE
+            elif byte == SYM_BIG_NUMBER:
+                response = long(buf[pos + 1:crlf])
+            elif byte == SYM_VERBATIM:
+                # without the format, e.g. "txt:"
+                response = self._read_blob(int(buf[pos + 1:crlf]))[4:]
+                if self.encoding:
+                    response = response.decode(self.encoding)
+            elif byte == SYM_BLOB_ERROR:
+                response = self.parse_error(
+                    nativestr(self._read_blob(int(buf[pos + 1:crlf]))))
+                if isinstance(response, ConnectionError):
+                    raise response
+            elif byte == SYM_ATTRIBUTE:
+                # a map of details about the reply that follows, dropped
+                for _ in xrange(2 * int(buf[pos + 1:crlf])):
+                    self.read_response()
+                continue
+            else:
+                raise InvalidResponse("Protocol Error: %r" %
+                                      self._view[pos:crlf].tobytes())
+
+            # add the reply to its aggregate, and the aggregates it completes
+            # to theirs in turn
+            while stack:
+                array, length, convert = stack[-1]
+                array.append(response)
+                if len(array) < length:
+                    break
+                stack.pop()
+                response = convert(array) if convert else array
+            if not stack:
+                self._reset()
+                return response
+
+    def _read_blob(self, length):
+        "Return the ``length`` bytes of a blob whose header was parsed"
+        if self._end - self._pos < length + 2:
+            self._fill(length + 2)
+        pos = self._pos
+        self._pos = pos + length + 2
+        return self._view[pos:pos + length].tobytes()
+
+    def _reset(self):
+        if self._pos == self._end:
+            self._pos = self._end = 0
+            if len(self._buffer) > self.max_buffer_size:
+                self._set_buffer(bytearray(self.socket_read_size))
+
+
+class Resp3Parser(BufferParser):
+    """
+    BufferParser switching connections to RESP3 with HELLO when they
+    connect, which needs Redis 6 or later
+    """
+    protocol = 3
+
+    def on_connect(self, connection):
+        "Called when the socket connects"
+        super(Resp3Parser, self).on_connect(connection)
+        # the connection sends AUTH and SELECT once its parser is set up,
+        # HELLO follows them, before the callbacks resubscribing pub/sub
+        callbacks = connection._connect_callbacks
+        if self._hello not in callbacks:
+            callbacks.insert(0, self._hello)
+
+    def _hello(self, connection):
+        try:
+            connection.send_command('HELLO', self.protocol)
+            connection.read_response()
+        except RedisError:
+            connection.disconnect()
+            raise
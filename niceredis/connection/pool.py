@@ -0,0 +1,338 @@
+# -*- coding: utf-8 *-*
+from __future__ import with_statement
+
+import os
+import socket
+import threading
+import time as mod_time
+import weakref
+from collections import deque
+from itertools import chain
+
+import redis.connection
+from redis._compat import nativestr
+from redis.connection import Connection
+from redis.exceptions import ConnectionError, RedisError
+
+
+def forget_connection(connection):
+    """
+    Drop the socket of a connection inherited from a parent process. Unlike
+    ``disconnect()`` this doesn't shut the socket down, which would break it
+    for the parent as well, but only closes this process' file descriptor.
+    """
+    sock = connection._sock
+    connection._sock = None
+    connection._parser.on_disconnect()
+    if sock is not None:
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+
+def record_failure(pool):
+    """
+    Report a connection error or timeout on a connection of ``pool`` to its
+    circuit breaker, if it has one
+    """
+    breaker = getattr(pool, 'circuit_breaker', None)
+    if breaker is not None:
+        breaker.record_failure()
+
+
+class ConnectionPool(redis.connection.ConnectionPool):
+    """
+    Generic connection pool that can be shared with forked child processes.
+
+    A child notices the fork on its first use of the pool and starts over
+    with an empty pool, while the connections inherited from the parent
+    stay usable in the parent.
+
+    With a ``circuit_breaker``, see CircuitBreaker, getting a connection
+    fails fast while the server keeps failing. The clients report the
+    connection errors and timeouts to it.
+
+    The connections encode the arguments of commands with ``encoding_cache``,
+    an EncodingCache, if given. It should use the connections' encoding.
+    """
+
+    def __init__(self, connection_class=Connection, max_connections=None,
+                 circuit_breaker=None, encoding_cache=None,
+                 **connection_kwargs):
+        self.circuit_breaker = circuit_breaker
+        self.encoding_cache = encoding_cache
+        super(ConnectionPool, self).__init__(
+            connection_class=connection_class,
+            max_connections=max_connections,
+            **connection_kwargs)
+
+    def _checkpid(self):
+        if self.pid != os.getpid():
+            self.after_fork()
+
+    def _connections(self):
+        return list(chain(self._available_connections,
+                          self._in_use_connections))
+
+    def make_connection(self):
+        "Create a new connection"
+        return self._setup_connection(
+            super(ConnectionPool, self).make_connection())
+
+    def _setup_connection(self, connection):
+        if self.encoding_cache is not None:
+            connection.encode = self.encoding_cache.encode
+        return connection
+
+    def get_connection(self, command_name, *keys, **options):
+        "Get a connection from the pool"
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.allow(self.ping)
+        return super(ConnectionPool, self).get_connection(
+            command_name, *keys, **options)
+
+    def ping(self):
+        """
+        Return if the server answers a PING, sent on a connection of its
+        own that is closed afterwards
+        """
+        connection = self.connection_class(**self.connection_kwargs)
+        try:
+            connection.send_command('PING')
+            return nativestr(connection.read_response()) == 'PONG'
+        finally:
+            connection.disconnect()
+
+    def after_fork(self):
+        """
+        Start over with an empty pool in a forked child process, dropping
+        the connections inherited from the parent without closing them there.
+        Does nothing if the process didn't fork since the pool was created.
+        """
+        with self._check_lock:
+            if self.pid == os.getpid():
+                # another thread already did the work while we waited
+                # on the lock.
+                return
+            connections = self._connections()
+            self.reset()
+        for connection in connections:
+            forget_connection(connection)
+
+    def release(self, connection):
+        "Releases the connection back to the pool"
+        self._checkpid()
+        if connection.pid != self.pid:
+            # a connection that was in use when the process forked
+            forget_connection(connection)
+            return
+        super(ConnectionPool, self).release(connection)
+
+    def disconnect(self):
+        "Disconnects all connections in the pool"
+        self._checkpid()
+        for connection in self._connections():
+            connection.disconnect()
+
+
+class _Waiter(object):
+    # woken up with a ``connection``, or with the ``slot`` of a connection
+    # that couldn't be made, to make one itself
+    __slots__ = ('event', 'connection', 'slot')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.connection = None
+        self.slot = False
+
+
+def _reap_idle_connections(pool_ref, interval):
+    # only hold a weak reference between runs, so an unused pool can be
+    # garbage collected, which ends this thread
+    while True:
+        mod_time.sleep(interval)
+        pool = pool_ref()
+        if pool is None or pool._reaper is not threading.current_thread():
+            return
+        pool.reap()
+        del pool
+
+
+class BoundedConnectionPool(ConnectionPool):
+    """
+    Thread-safe connection pool holding at most ``max_connections``.
+
+    When all connections are in use, ``get_connection`` blocks for up to
+    ``timeout`` seconds, or forever if it's None, before it raises a
+    ``ConnectionError``. Waiting clients are served first come first served:
+    a released connection is handed straight to the longest waiting one.
+
+    ``min_connections`` connections are created and connected up front and
+    are never reaped. Connections idle for more than ``max_idle_time``
+    seconds are disconnected and dropped by a background thread running
+    every ``reap_interval`` seconds, by default half of ``max_idle_time``.
+
+    ``stats()`` returns the pool's counters.
+    """
+    COUNTERS = ('created', 'reaped', 'waits', 'wait_time', 'timeouts')
+
+    def __init__(self, max_connections=50, timeout=20, min_connections=0,
+                 max_idle_time=None, reap_interval=None,
+                 connection_class=Connection, **connection_kwargs):
+        if min_connections > max_connections:
+            raise ValueError('"min_connections" must not be larger than '
+                             '"max_connections"')
+        self.timeout = timeout
+        self.min_connections = min_connections
+        self.max_idle_time = max_idle_time
+        self.reap_interval = reap_interval or (
+            max_idle_time and max_idle_time / 2.0)
+        super(BoundedConnectionPool, self).__init__(
+            connection_class=connection_class,
+            max_connections=max_connections,
+            **connection_kwargs)
+        self.prewarm()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self._check_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._created_connections = 0
+        # (connection, released at) with the longest idle one on the left
+        self._idle = deque()
+        self._in_use = set()
+        self._waiters = deque()
+        self._stats = dict.fromkeys(self.COUNTERS, 0)
+        self._reaper = None
+        if self.max_idle_time is not None:
+            self._reaper = threading.Thread(
+                target=_reap_idle_connections,
+                args=(weakref.ref(self), self.reap_interval))
+            self._reaper.daemon = True
+            self._reaper.start()
+
+    def make_connection(self):
+        "Create a new connection"
+        return self._setup_connection(
+            self.connection_class(**self.connection_kwargs))
+
+    def prewarm(self):
+        "Fill the pool up to ``min_connections`` connected connections"
+        with self._lock:
+            missing = self.min_connections - self._created_connections
+            self._created_connections += max(missing, 0)
+        for _ in range(missing):
+            connection = self.make_connection()
+            try:
+                connection.connect()
+            except RedisError:
+                # connect lazily once the server is back
+                pass
+            with self._lock:
+                self._stats['created'] += 1
+            self.release(connection, _in_use=False)
+
+    def get_connection(self, command_name, *keys, **options):
+        "Get a connection from the pool, waiting for one if necessary"
+        self._checkpid()
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.allow(self.ping)
+        waiter = None
+        with self._lock:
+            if self._idle:
+                connection = self._idle.pop()[0]
+                self._in_use.add(connection)
+                return connection
+            if self._created_connections < self.max_connections:
+                self._created_connections += 1
+            else:
+                waiter = _Waiter()
+                self._waiters.append(waiter)
+
+        if waiter is not None:
+            start = mod_time.time()
+            waiter.event.wait(self.timeout)
+            with self._lock:
+                self._stats['waits'] += 1
+                self._stats['wait_time'] += mod_time.time() - start
+                # the connection may have been handed over right after the
+                # timeout, check under the lock
+                if waiter.connection is None and not waiter.slot:
+                    self._waiters.remove(waiter)
+                    self._stats['timeouts'] += 1
+                    raise ConnectionError("No connection available.")
+            if waiter.connection is not None:
+                return waiter.connection
+
+        try:
+            connection = self.make_connection()
+        except Exception:
+            self._free_slot()
+            raise
+        with self._lock:
+            self._stats['created'] += 1
+            self._in_use.add(connection)
+        return connection
+
+    def _free_slot(self):
+        # the slot of a connection that couldn't be made goes to the longest
+        # waiting client, if any
+        with self._lock:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.slot = True
+                waiter.event.set()
+            else:
+                self._created_connections -= 1
+
+    def _connections(self):
+        # no locking, after a fork the lock may be held by a thread that
+        # only exists in the parent
+        return [c for c, _ in list(self._idle)] + list(self._in_use)
+
+    def release(self, connection, _in_use=True):
+        "Releases the connection back to the pool"
+        self._checkpid()
+        if connection.pid != self.pid:
+            # a connection that was in use when the process forked
+            forget_connection(connection)
+            return
+        with self._lock:
+            if _in_use:
+                self._in_use.discard(connection)
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.connection = connection
+                self._in_use.add(connection)
+                waiter.event.set()
+                return
+            self._idle.append((connection, mod_time.time()))
+
+    def reap(self):
+        "Disconnect and drop connections idle for more than max_idle_time"
+        deadline = mod_time.time() - self.max_idle_time
+        reaped = []
+        with self._lock:
+            while self._idle and self._idle[0][1] < deadline and \
+                    self._created_connections > self.min_connections:
+                reaped.append(self._idle.popleft()[0])
+                self._created_connections -= 1
+            self._stats['reaped'] += len(reaped)
+        for connection in reaped:
+            connection.disconnect()
+        return len(reaped)
+
+    def stats(self):
+        """
+        Return the pool's counters: connections ``in_use``, ``idle`` and
+        clients ``waiting`` right now, and in total connections ``created``
+        and ``reaped``, ``waits`` for a connection, seconds of
+        ``wait_time`` and ``timeouts``.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_use'] = len(self._in_use)
+            stats['idle'] = len(self._idle)
+            stats['waiting'] = len(self._waiters)
+        return stats
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 *-*
+from __future__ import with_statement
+
+import os
+import select
+import threading
+import time as mod_time
+import weakref
+from collections import deque
+from itertools import count
+
+from redis.exceptions import RedisError
+
+from ..callbacks import parse_info
+from .timeouts import socket_timeout
+
+
+def replication_info(pool, timeout=None):
+    """
+    Return the parsed ``INFO replication`` of the server behind ``pool``,
+    waiting up to ``timeout`` seconds, if given, instead of the socket
+    timeout of its connections
+    """
+    connection = pool.get_connection('INFO')
+    try:
+        with socket_timeout(connection, timeout):
+            connection.send_command('INFO', 'replication')
+            return parse_info(connection.read_response())
+    except RedisError:
+        connection.disconnect()
+        raise
+    finally:
+        pool.release(connection)
+
+
+def _check_replicas(selector_ref, interval):
+    # only hold a weak reference between runs, so an unused selector can be
+    # garbage collected, which ends this thread
+    while True:
+        selector = selector_ref()
+        if selector is None or \
+                selector._checker is not threading.current_thread():
+            return
+        selector.check()
+        del selector
+        mod_time.sleep(interval)
+
+
+class ReplicaSelector(object):
+    """
+    Chooses the pool read-only commands go to among the ``replicas`` pools
+    of the ``primary`` pool.
+
+    Replicas take turns. Every ``check_interval`` seconds a background
+    thread, started with the first command, reads the replication offsets
+    from ``INFO replication`` of the primary and of the replicas, waiting
+    up to ``check_timeout`` seconds for each. Replicas that are unreachable,
+    whose link to the primary is down or whose offset is more than
+    ``max_lag`` bytes behind the primary's are skipped until the next
+    check. Until the first check and without any healthy replica the
+    primary is used. With ``check_interval=None`` the replicas are only
+    checked by calling ``check()``, all of them are used until then.
+    """
+
+    def __init__(self, primary, replicas, max_lag=None, check_interval=1.0,
+                 check_timeout=1.0):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self._check_lock = threading.Lock()
+        self._checked_at = None
+        self._healthy = []
+        if check_interval is None:
+            self._healthy = list(self.replicas)
+        self._lag = {}
+        self._counter = count()
+        self._checker = None
+        self._checker_pid = None
+
+    def __repr__(self):
+        return '%s<primary=%r,replicas=%r>' % (
+            type(self).__name__, self.primary, self.replicas)
+
+    def get_pool(self):
+        "Return the pool the next read-only command should use"
+        if self.check_interval is not None and \
+                self._checker_pid != os.getpid():
+            self._start_checker()
+        healthy = self._healthy
+        if not healthy:
+            return self.primary
+        return healthy[next(self._counter) % len(healthy)]
+
+    def _start_checker(self):
+        # in a forked child as well, where the parent's thread doesn't run
+        with self._check_lock:
+            if self._checker_pid == os.getpid():
+                return
+            self._checker_pid = os.getpid()
+            self._checker = threading.Thread(
+                target=_check_replicas,
+                args=(weakref.ref(self), self.check_interval))
+            self._checker.daemon = True
+            self._checker.start()
+
+    def check(self):
+        """
+        Check the replicas now and return the healthy ones. Returns the
+        previous result right away if another thread is already checking.
+        """
+        if not self._check_lock.acquire(False):
+            return self._healthy
+        try:
+            self._checked_at = mod_time.time()
+            try:
+                primary_offset = replication_info(
+                    self.primary,
+                    self.check_timeout).get('master_repl_offset')
+            except RedisError:
+                # can't tell how far behind the replicas are
+                primary_offset = None
+            healthy = []
+            lag = {}
+            for pool in self.replicas:
+                try:
+                    info = replication_info(pool, self.check_timeout)
+                except RedisError:
+                    continue
+                if info.get('master_link_status') != 'up':
+                    continue
+                offset = info.get('slave_repl_offset')
+                if primary_offset is not None and offset is not None:
+                    lag[pool] = max(primary_offset - offset, 0)
+                    if self.max_lag is not None and lag[pool] > self.max_lag:
+                        continue
+                healthy.append(pool)
+            self._healthy = healthy
+            self._lag = lag
+            return healthy
+        finally:
+            self._check_lock.release()
+
+    def lag(self):
+        """
+        Return the replication lag in bytes of each replica pool as of the
+        last check, where it could be determined
+        """
+        return dict(self._lag)
+
+
+def wait_for_reply(connections, timeout=None):
+    """
+    Return the first of ``connections`` with a reply to read within
+    ``timeout`` seconds, or forever if None, and None if there's none
+    """
+    for connection in connections:
+        if connection._parser.can_read():
+            return connection
+    fds = [connection._sock.fileno() for connection in connections]
+    # poll where there is, as select fails for descriptors past FD_SETSIZE
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        for fd in fds:
+            poller.register(fd, select.POLLIN)
+        readable = [fd for fd, _ in poller.poll(
+            None if timeout is None else timeout * 1000)]
+    else:
+        readable = select.select(fds, [], [], timeout)[0]
+    for connection, fd in zip(connections, fds):
+        if fd in readable:
+            return connection
+    return None
+
+
+class HedgingPolicy(object):
+    """
+    Decides when a read-only command the primary hasn't answered yet is
+    sent to a replica as well, the first reply being used.
+
+    The delay is the ``percentile`` of the latencies of the last
+    ``samples`` reads as seen by the caller, at least ``min_delay`` seconds.
+    Until ``min_samples`` have been taken ``initial_delay`` is used. The
+    percentile is worked out again every ``update_every`` reads.
+
+    ``stats()`` returns the counters.
+    """
+    COUNTERS = ('reads', 'hedged', 'hedge_wins')
+
+    def __init__(self, percentile=95, initial_delay=0.01, min_delay=0.001,
+                 samples=1000, min_samples=100, update_every=100):
+        if not 0 < percentile < 100:
+            raise ValueError('"percentile" must be between 0 and 100')
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.update_every = update_every
+        self._latencies = deque(maxlen=samples)
+        self._delay = initial_delay
+        self._since_update = 0
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(self.COUNTERS, 0)
+
+    def __repr__(self):
+        return '%s<percentile=%s,delay=%s>' % (
+            type(self).__name__, self.percentile, self._delay)
+
+    def delay(self):
+        "Return the seconds to wait for the primary before hedging"
+        return self._delay
+
+    def record(self, latency, hedged, hedge_won):
+        """
+        Record a read answered after ``latency`` seconds, whether it was
+        ``hedged`` and if so whether the replica's reply was used
+        """
+        with self._lock:
+            self._latencies.append(latency)
+            stats = self._stats
+            stats['reads'] += 1
+            if hedged:
+                stats['hedged'] += 1
+                if hedge_won:
+                    stats['hedge_wins'] += 1
+            self._since_update += 1
+            if self._since_update < self.update_every or \
+                    len(self._latencies) < self.min_samples:
+                return
+            self._since_update = 0
+            latencies = list(self._latencies)
+        latencies.sort()
+        index = int(len(latencies) * self.percentile / 100.0)
+        self._delay = max(latencies[min(index, len(latencies) - 1)],
+                          self.min_delay)
+
+    def stats(self):
+        """
+        Return the counters: ``reads`` answered, how many were ``hedged``,
+        the ``hedge_wins`` among them, and the current ``delay``
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['delay'] = self._delay
+        return stats
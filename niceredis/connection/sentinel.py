@@ -0,0 +1,146 @@
+# -*- coding: utf-8 *-*
+import random
+import weakref
+
+from redis.connection import Connection
+from redis.exceptions import ConnectionError, ReadOnlyError
+from redis.sentinel import MasterNotFoundError, SlaveNotFoundError
+
+from .pool import ConnectionPool
+
+
+class SentinelManagedConnection(Connection):
+    """
+    Connection whose address is looked up through its pool, from the
+    addresses a ``SentinelClient`` resolved, every time it (re)connects.
+    """
+
+    def __init__(self, **kwargs):
+        self.connection_pool = kwargs.pop('connection_pool')
+        super(SentinelManagedConnection, self).__init__(**kwargs)
+
+    def __repr__(self):
+        pool = self.connection_pool
+        s = '%s<service=%s%%s>' % (type(self).__name__, pool.service_name)
+        if self.host:
+            host_info = ',host=%s,port=%s' % (self.host, self.port)
+            s = s % host_info
+        return s
+
+    def connect_to(self, address):
+        self.host, self.port = address
+        self._description_args['host'] = self.host
+        self._description_args['port'] = self.port
+        super(SentinelManagedConnection, self).connect()
+
+    def connect(self):
+        if self._sock:
+            return  # already connected
+        address = self.connection_pool.get_address()
+        try:
+            self.connect_to(address)
+        except ConnectionError:
+            # the cached address may be outdated if we missed a failover,
+            # ask the sentinels again before giving up
+            self.connection_pool.address_failed(address)
+            self.connect_to(self.connection_pool.get_address())
+
+    def read_response(self):
+        try:
+            return super(SentinelManagedConnection, self).read_response()
+        except ReadOnlyError:
+            if self.connection_pool.is_master:
+                # When talking to a master, a ReadOnlyError likely
+                # indicates that the previous master that we're still
+                # connected to has been demoted to a replica. Forget its
+                # address, the next connect() asks the sentinels again.
+                self.connection_pool.address_failed((self.host, self.port))
+                self.disconnect()
+                raise ConnectionError('The previous master is now a replica')
+            raise
+
+
+class SentinelConnectionPool(ConnectionPool):
+    """
+    Connection pool for the master, or the replicas, of the sentinel
+    monitored service ``service_name``.
+
+    Addresses come from the ``sentinel`` (a ``SentinelClient``), which
+    caches them and tells the pool when a node fails over: idle connections
+    to that node are disconnected right away, the ones in use when they're
+    released. Connections to the other nodes are kept.
+    """
+
+    def __init__(self, service_name, sentinel, is_master=True, **kwargs):
+        kwargs.setdefault('connection_class', SentinelManagedConnection)
+        self.service_name = service_name
+        self.sentinel = sentinel
+        self.is_master = is_master
+        super(SentinelConnectionPool, self).__init__(**kwargs)
+        self.connection_kwargs['connection_pool'] = weakref.proxy(self)
+
+    def __repr__(self):
+        return "%s<service=%s(%s)>" % (
+            type(self).__name__,
+            self.service_name,
+            self.is_master and 'master' or 'replica',
+        )
+
+    def reset(self):
+        super(SentinelConnectionPool, self).reset()
+        self._replica_counter = None
+
+    def get_address(self):
+        "Return the address a new connection should connect to"
+        if self.is_master:
+            return self.sentinel.master_address(self.service_name)
+        replicas = self.sentinel.replica_addresses(self.service_name)
+        if not replicas:
+            # fall back to the master
+            try:
+                return self.sentinel.master_address(self.service_name)
+            except MasterNotFoundError:
+                raise SlaveNotFoundError(
+                    'No replica found for %r' % (self.service_name,))
+        # round robin over the replicas, starting at a random one
+        if self._replica_counter is None:
+            self._replica_counter = random.randint(0, len(replicas) - 1)
+        self._replica_counter = (self._replica_counter + 1) % len(replicas)
+        return replicas[self._replica_counter]
+
+    def address_failed(self, address):
+        "Forget the cached addresses after failing to use ``address``"
+        self.sentinel.invalidate(self.service_name)
+
+    def is_current(self, address):
+        """
+        Whether ``address`` is still a valid node for this pool, judging by
+        the cached addresses only. Unknown means valid.
+        """
+        master = self.sentinel.master_address(self.service_name,
+                                              discover=False)
+        if self.is_master:
+            return master is None or address == master
+        replicas = self.sentinel.replica_addresses(self.service_name,
+                                                   discover=False)
+        if replicas is None:
+            return True
+        return address in replicas or address == master
+
+    def drop_address(self, address):
+        """
+        Disconnect the idle connections to ``address``. Connections to it
+        that are in use are disconnected when they are released.
+        """
+        self._checkpid()
+        for connection in list(self._available_connections):
+            if (connection.host, connection.port) == address:
+                connection.disconnect()
+
+    def release(self, connection):
+        "Releases the connection back to the pool"
+        if connection._sock is not None and \
+                not self.is_current((connection.host, connection.port)):
+            # the node failed over while the connection was in use
+            connection.disconnect()
+        super(SentinelConnectionPool, self).release(connection)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 *-*
+from __future__ import with_statement
+
+import time as mod_time
+from contextlib import contextmanager
+
+from redis.exceptions import TimeoutError
+
+
+def get_deadline(timeout=None, deadline=None):
+    """
+    Return the time.time() by which a call given ``timeout`` seconds and an
+    absolute ``deadline`` has to end, the earlier of both, or None without
+    either
+    """
+    if timeout is not None:
+        timeout_at = mod_time.time() + timeout
+        if deadline is None or timeout_at < deadline:
+            deadline = timeout_at
+    return deadline
+
+
+def time_left(deadline):
+    """
+    Return the seconds left until ``deadline``, None without a deadline, or
+    raise a TimeoutError if it has passed
+    """
+    if deadline is None:
+        return None
+    left = deadline - mod_time.time()
+    if left <= 0:
+        raise TimeoutError('Deadline exceeded')
+    return left
+
+
+@contextmanager
+def socket_timeout(connection, timeout):
+    """
+    Use ``timeout`` seconds, if not None, for the socket operations of
+    ``connection`` instead of its socket_timeout until the block ends. Each
+    write or read waits that long, as does connecting.
+    """
+    if timeout is None:
+        yield
+        return
+    # unix socket connections have no separate connect timeout
+    timeouts = ['socket_timeout']
+    if hasattr(connection, 'socket_connect_timeout'):
+        timeouts.append('socket_connect_timeout')
+    previous = [getattr(connection, name) for name in timeouts]
+    for name in timeouts:
+        setattr(connection, name, timeout)
+    if connection._sock is not None:
+        connection._sock.settimeout(timeout)
+    try:
+        yield
+    finally:
+        for name, value in zip(timeouts, previous):
+            setattr(connection, name, value)
+        # the connection may have been made again in the meantime
+        if connection._sock is not None:
+            connection._sock.settimeout(connection.socket_timeout)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 *-*
+from itertools import chain
+
+from redis.connection import SYM_EMPTY
+
+from .packer import pack_command
+
+# chunks of at least this many bytes are sent as they are, smaller ones are
+# joined together up to this size
+LARGE_CHUNK = 16 * 1024
+
+
+def coalesce(chunks, large=LARGE_CHUNK):
+    """
+    Return the byte strings ``chunks`` as a list of buffers to send in
+    order: runs of small chunks are joined, chunks of at least ``large``
+    bytes are kept as they are instead of being copied
+    """
+    output = []
+    pieces = []
+    size = 0
+    for chunk in chunks:
+        if len(chunk) >= large:
+            if pieces:
+                output.append(SYM_EMPTY.join(pieces))
+                pieces = []
+                size = 0
+            output.append(chunk)
+            continue
+        pieces.append(chunk)
+        size += len(chunk)
+        if size >= large:
+            output.append(SYM_EMPTY.join(pieces))
+            pieces = []
+            size = 0
+    if pieces:
+        output.append(SYM_EMPTY.join(pieces))
+    return output
+
+
+def pack_buffers(connection, commands):
+    """
+    Pack the argument tuples ``commands`` into buffers for the connection's
+    ``send_packed_command``, keeping large values apart, see ``coalesce``
+    """
+    return coalesce(chain.from_iterable(
+        [pack_command(connection, args) for args in commands]))
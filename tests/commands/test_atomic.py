@@ -0,0 +1,72 @@
+# -*- coding: utf-8 *-*
+import datetime
+
+import pytest
+from redis._compat import b
+
+
+class TestAtomicCommands(object):
+    @pytest.fixture(autouse=True)
+    def reset_scripts(self, r):
+        r.script_flush()
+
+    def test_compare_and_set(self, r):
+        r['a'] = 1
+        assert r.compare_and_set('a', 2, 3) is False
+        assert r['a'] == b('1')
+        assert r.compare_and_set('a', 1, 3) is True
+        assert r['a'] == b('3')
+        assert r.compare_and_set('b', 1, 3) is False
+        assert 'b' not in r
+
+    def test_get_and_expire(self, r):
+        assert r.get_and_expire('a', 60) is None
+        assert 'a' not in r
+        r['a'] = 'foo'
+        assert r.get_and_expire('a', datetime.timedelta(minutes=1)) == \
+            b('foo')
+        assert 0 < r.ttl('a') <= 60
+
+    def test_lpush_capped(self, r):
+        assert r.lpush_capped('a', 3, '1', '2') == 2
+        assert r.lpush_capped('a', 3, '3', '4') == 3
+        assert r.lrange('a', 0, -1) == [b('4'), b('3'), b('2')]
+
+    def test_rate_limit(self, r):
+        assert r.rate_limit('a', 2, 60) is True
+        assert r.rate_limit('a', 2, 60) is True
+        assert r.rate_limit('a', 2, 60) is False
+        assert r.zcard('a') == 2
+        assert 0 < r.pttl('a') <= 60000
+
+    def test_rate_limit_window_slides(self, r):
+        assert r.rate_limit('a', 1, 60) is True
+        assert r.rate_limit('a', 1, 60) is False
+        # move the counted hit out of the window
+        member, score = r.zrange('a', 0, 0, withscores=True)[0]
+        r.zadd('a', **{member: score - 61000})
+        assert r.rate_limit('a', 1, 60) is True
+
+    def test_mincrby(self, r):
+        r['a'] = 1
+        assert r.mincrby({'a': 2, 'b': 5}) == {'a': 3, 'b': 5}
+        assert r.ttl('a') is None
+        assert r.mincrby({'a': 1, 'b': -1}, 60) == {'a': 4, 'b': 4}
+        assert 0 < r.ttl('a') <= 60
+        assert 0 < r.ttl('b') <= 60
+
+    def test_zpop_min(self, r):
+        r.zadd('a', a1=1, a2=2, a3=3)
+        assert r.zpop_min('a') == [b('a1')]
+        assert r.zpop_min('a', 5, withscores=True) == \
+            [(b('a2'), 2.0), (b('a3'), 3.0)]
+        assert r.zpop_min('a') == []
+        assert 'a' not in r
+
+    def test_in_pipeline(self, r):
+        r['a'] = 1
+        r.zadd('z', z1=1, z2=2)
+        pipe = r.pipeline()
+        pipe.compare_and_set('a', 1, 2).zpop_min('z', withscores=True)
+        pipe.get('a')
+        assert pipe.execute() == [True, [(b('z1'), 1.0)], b('2')]
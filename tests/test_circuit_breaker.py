@@ -0,0 +1,120 @@
+import time
+
+import pytest
+import redis
+
+import niceredis
+from niceredis.connection import CircuitBreaker, CircuitOpenError
+
+
+def healthy():
+    return True
+
+
+def unhealthy():
+    raise redis.ConnectionError('Connection refused')
+
+
+class TestCircuitBreaker(object):
+    def test_trips_after_failures_within_window(self):
+        breaker = CircuitBreaker(failure_threshold=3, window=10)
+        for _ in range(2):
+            breaker.record_failure()
+        assert breaker.state == 'closed'
+        breaker.allow(unhealthy)
+        breaker.record_failure()
+        assert breaker.state == 'open'
+        with pytest.raises(CircuitOpenError):
+            breaker.allow(healthy)
+
+    def test_old_failures_dont_count(self):
+        breaker = CircuitBreaker(failure_threshold=2, window=0.01)
+        breaker.record_failure()
+        time.sleep(0.02)
+        breaker.record_failure()
+        assert breaker.state == 'closed'
+
+    def test_half_open_probe(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        events = []
+        breaker.add_listener(
+            lambda b, old, new: events.append((b, old, new)))
+        breaker.record_failure()
+        with pytest.raises(CircuitOpenError):
+            breaker.allow(unhealthy)
+        assert breaker.state == 'open'
+        breaker.allow(healthy)
+        assert breaker.state == 'closed'
+        assert [event[1:] for event in events] == [
+            ('closed', 'open'), ('open', 'half-open'), ('half-open', 'open'),
+            ('open', 'half-open'), ('half-open', 'closed')]
+        assert events[0][0] is breaker
+        stats = breaker.stats()
+        assert stats['trips'] == 2
+        assert stats['probes'] == 2
+        assert stats['failed_probes'] == 1
+        assert stats['state'] == 'closed'
+
+    def test_probe_raising_other_errors(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+
+        def broken():
+            raise ValueError('bug in the probe')
+        with pytest.raises(ValueError):
+            breaker.allow(broken)
+        assert breaker.state == 'open'
+        assert breaker.stats()['failed_probes'] == 1
+        breaker.allow(healthy)
+        assert breaker.state == 'closed'
+
+    def test_fails_fast_while_probing(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+
+        def probe():
+            # another caller while the probe runs
+            with pytest.raises(CircuitOpenError):
+                breaker.allow(healthy)
+            return True
+        breaker.allow(probe)
+        assert breaker.stats()['rejected'] == 1
+
+    def test_copy(self):
+        breaker = CircuitBreaker(failure_threshold=1)
+        breaker.record_failure()
+        copy = breaker.copy()
+        assert copy.state == 'closed'
+        assert copy.failure_threshold == 1
+
+
+class TestClientCircuitBreaker(object):
+    def test_fails_fast_once_open(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        # nothing listens on this port
+        client = niceredis.StrictRedis(port=6398, circuit_breaker=breaker)
+        with pytest.raises(redis.ConnectionError) as ex:
+            client.ping()
+        assert not isinstance(ex.value, CircuitOpenError)
+        assert breaker.state == 'open'
+        with pytest.raises(CircuitOpenError):
+            client.get('a')
+        with pytest.raises(CircuitOpenError):
+            client.pipeline().get('a').execute()
+
+    def test_closes_when_the_server_answers(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        client = niceredis.StrictRedis(db=9, circuit_breaker=breaker)
+        breaker.record_failure()
+        assert client.ping()
+        assert breaker.state == 'closed'
+        assert breaker.stats()['probes'] == 1
+
+    def test_breaker_per_shard(self):
+        breaker = CircuitBreaker()
+        client = niceredis.ShardedRedis([('localhost', 6379)] * 2, db=9,
+                                        circuit_breaker=breaker)
+        breakers = [shard.connection_pool.circuit_breaker
+                    for shard in client.shards.values()]
+        assert breakers[0] is not breakers[1]
+        assert breaker not in breakers
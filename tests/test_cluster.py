@@ -0,0 +1,172 @@
+import pytest
+import redis
+from redis._compat import b
+
+import niceredis
+from niceredis.client.cluster import (RedisCluster, crc16, key_slot,
+                                      parse_redirect)
+from niceredis.connection import CircuitBreaker
+
+CLUSTER_NODE = ('127.0.0.1', 7000)
+
+
+def cluster_available():
+    try:
+        client = niceredis.StrictRedis(*CLUSTER_NODE)
+        return 'cluster_state:ok' in client.execute_command('CLUSTER INFO')
+    except redis.RedisError:
+        return False
+
+
+skip_without_cluster = pytest.mark.skipif(
+    not cluster_available(),
+    reason='needs a Redis Cluster at %s:%s' % CLUSTER_NODE)
+
+
+@pytest.fixture()
+def rc(request):
+    client = RedisCluster([CLUSTER_NODE])
+    client.flushdb()
+    request.addfinalizer(client.flushdb)
+    return client
+
+
+def node_id(client):
+    return b(client.execute_command('CLUSTER MYID'))
+
+
+def move_slot(rc, slot, source, target, migrate_keys=True):
+    "Move ``slot`` from the ``source`` to the ``target`` node client"
+    target.execute_command('CLUSTER SETSLOT', slot, 'IMPORTING',
+                           node_id(source))
+    source.execute_command('CLUSTER SETSLOT', slot, 'MIGRATING',
+                           node_id(target))
+    if not migrate_keys:
+        return
+    port = target.connection_pool.connection_kwargs['port']
+    for key in source.execute_command('CLUSTER GETKEYSINSLOT', slot, 1000):
+        source.execute_command('MIGRATE', '127.0.0.1', port, key, 0, 1000)
+    for node in rc.shards.values():
+        node.execute_command('CLUSTER SETSLOT', slot, 'NODE', node_id(target))
+
+
+def lose_reply(rc, key):
+    "Make the reply to the next command on the node of ``key`` get lost"
+    pool = rc.get_shard(key).connection_pool
+    connection = pool.get_connection('_')
+    pool.release(connection)
+    read_response = connection.read_response
+
+    def read():
+        connection.read_response = read_response
+        read_response()
+        raise redis.ConnectionError('Error while reading from socket')
+    connection.read_response = read
+
+
+class TestSlots(object):
+    def test_crc16(self):
+        assert crc16(b('123456789')) == 0x31c3
+
+    def test_key_slot(self):
+        assert key_slot(b('foo')) == 12182
+        assert key_slot(b('{user1000}.following')) == \
+            key_slot(b('{user1000}.followers'))
+        assert key_slot(b('foo{}{bar}')) == key_slot(b('foo{}{bar}'))
+
+    def test_parse_redirect(self):
+        assert parse_redirect(redis.ResponseError(
+            'MOVED 3999 127.0.0.1:6381')) == \
+            ('MOVED', 3999, ('127.0.0.1', 6381))
+        assert parse_redirect(redis.ResponseError('ASK 1 ::1:7000')) == \
+            ('ASK', 1, ('::1', 7000))
+        assert parse_redirect(redis.ResponseError('ERR wrong type')) is None
+
+
+@skip_without_cluster
+class TestRedisCluster(object):
+    def test_routes_to_slot_owner(self, rc):
+        rc.set('foo', 'bar')
+        assert rc.get('foo') == b('bar')
+        owner = rc.get_shard('foo')
+        assert owner.connection_pool.connection_kwargs['port'] == \
+            rc.slots[key_slot(b('foo'))][1]
+
+    def test_multi_key_commands(self, rc):
+        keys = ['key%d' % i for i in range(20)]
+        assert rc.mset(dict([(key, key) for key in keys]))
+        assert rc.mget(keys) == [b(key) for key in keys]
+        assert rc.dbsize() == 20
+        assert rc.delete(*keys) == 20
+        rc.sadd('{s}a', 1, 2)
+        rc.sadd('{s}b', 2)
+        assert rc.sinter('{s}a', '{s}b') == set([b('2')])
+
+    def test_moved(self, rc):
+        rc.set('foo', 'bar')
+        slot = key_slot(b('foo'))
+        source = rc.get_shard('foo')
+        target = rc.get_node([address for address in set(rc.slots)
+                              if address != rc.slots[slot]][0])
+        move_slot(rc, slot, source, target)
+        try:
+            assert rc.pipeline().get('foo').execute() == [b('bar')]
+            assert rc.get_shard('foo') is target
+            assert rc.get('foo') == b('bar')
+        finally:
+            move_slot(rc, slot, target, source)
+
+    def test_ask(self, rc):
+        slot = key_slot(b('foo'))
+        source = rc.get_shard('foo')
+        target = rc.get_node([address for address in set(rc.slots)
+                              if address != rc.slots[slot]][0])
+        move_slot(rc, slot, source, target, migrate_keys=False)
+        try:
+            # new keys of a migrating slot go to the target
+            rc.set('foo', 'bar')
+            assert rc.get('foo') == b('bar')
+            assert target.execute_command('CLUSTER COUNTKEYSINSLOT', slot) == 1
+            # while the slot isn't moved yet
+            assert rc.get_shard('foo') is source
+        finally:
+            for node in (source, target):
+                node.execute_command('CLUSTER SETSLOT', slot, 'STABLE')
+
+    def test_pipeline(self, rc):
+        pipe = rc.pipeline()
+        for i in range(20):
+            pipe.set('key%d' % i, i)
+        for i in range(20):
+            pipe.get('key%d' % i)
+        pipe.incr('key0')
+        assert pipe.execute() == [True] * 20 + \
+            [b(str(i)) for i in range(20)] + [1]
+
+    def test_pipeline_errors(self, rc):
+        pipe = rc.pipeline()
+        with pytest.raises(redis.RedisError):
+            pipe.mget('a', 'b')
+        pipe.set('a', 'x').incr('a').get('a')
+        result = pipe.execute(raise_on_error=False)
+        assert isinstance(result[1], redis.ResponseError)
+        assert result[2] == b('x')
+
+    def test_idempotent_command_retried(self):
+        rc = RedisCluster([CLUSTER_NODE], circuit_breaker=CircuitBreaker())
+        rc.set('foo', 'bar')
+        lose_reply(rc, 'foo')
+        assert rc.get('foo') == b('bar')
+        assert rc.retry_policy.stats.get() == {
+            'retries': 1, 'recovered': 1, 'exhausted': 0, 'unsafe': 0}
+        breaker = rc.get_shard('foo').connection_pool.circuit_breaker
+        assert breaker.stats()['failures'] == 1
+        rc.delete('foo')
+
+    def test_non_idempotent_command_not_replayed(self, rc):
+        rc.set('ctr', 1)
+        lose_reply(rc, 'ctr')
+        with pytest.raises(redis.ConnectionError):
+            rc.incr('ctr')
+        assert rc.get('ctr') == b('2')
+        assert rc.retry_policy.stats.get()['unsafe'] == 1
@@ -0,0 +1,213 @@
+from __future__ import with_statement
+
+import os
+import threading
+import time
+
+import pytest
+import redis
+from redis._compat import b
+
+import niceredis
+from niceredis.connection import BoundedConnectionPool
+
+from .conftest import _get_client
+
+
+def get_pool(**kwargs):
+    params = {'host': 'localhost', 'port': 6379, 'db': 9, 'timeout': 0.1}
+    params.update(kwargs)
+    return BoundedConnectionPool(**params)
+
+
+class TestBoundedConnectionPool(object):
+    def test_reuses_connections(self):
+        pool = get_pool(max_connections=2)
+        c1 = pool.get_connection('_')
+        pool.release(c1)
+        assert pool.get_connection('_') is c1
+        assert pool.stats()['created'] == 1
+
+    def test_blocks_when_exhausted(self):
+        pool = get_pool(max_connections=2)
+        pool.get_connection('_')
+        pool.get_connection('_')
+        start = time.time()
+        with pytest.raises(redis.ConnectionError):
+            pool.get_connection('_')
+        assert time.time() - start >= 0.1
+        stats = pool.stats()
+        assert stats['in_use'] == 2
+        assert stats['timeouts'] == 1
+        assert stats['waits'] == 1
+        assert stats['wait_time'] >= 0.1
+
+    def test_waiters_are_served_in_order(self):
+        pool = get_pool(max_connections=1, timeout=None)
+        connection = pool.get_connection('_')
+        served = []
+
+        def wait(name):
+            c = pool.get_connection('_')
+            served.append(name)
+            pool.release(c)
+
+        threads = []
+        for name in range(5):
+            thread = threading.Thread(target=wait, args=(name,))
+            thread.start()
+            threads.append(thread)
+            # make sure the threads queue up in order
+            while pool.stats()['waiting'] <= name:
+                time.sleep(0.001)
+        pool.release(connection)
+        for thread in threads:
+            thread.join()
+        assert served == list(range(5))
+        assert pool.stats()['created'] == 1
+
+    def test_waiter_gets_the_slot_of_a_failed_connection(self):
+        pool = get_pool(max_connections=1, timeout=1)
+        make_connection = pool.make_connection
+        failing = threading.Event()
+        fail = threading.Event()
+
+        def broken():
+            pool.make_connection = make_connection
+            failing.set()
+            fail.wait()
+            raise redis.RedisError('Out of file descriptors')
+        pool.make_connection = broken
+        errors = []
+        served = []
+
+        def get(results):
+            try:
+                results.append(pool.get_connection('_'))
+            except redis.RedisError as e:
+                errors.append(e)
+        first = threading.Thread(target=get, args=(served,))
+        first.start()
+        failing.wait()
+        second = threading.Thread(target=get, args=(served,))
+        second.start()
+        while pool.stats()['waiting'] < 1:
+            time.sleep(0.001)
+        fail.set()
+        first.join()
+        second.join()
+        assert len(errors) == 1
+        assert len(served) == 1
+        pool.release(served[0])
+        assert pool.stats()['created'] == 1
+
+    def test_prewarm(self):
+        pool = get_pool(max_connections=5, min_connections=2)
+        stats = pool.stats()
+        assert stats['idle'] == 2
+        assert stats['created'] == 2
+        connection = pool.get_connection('_')
+        assert connection._sock is not None
+
+    def test_reap_idle_connections(self):
+        pool = get_pool(max_connections=5, min_connections=1,
+                        max_idle_time=0.05, reap_interval=10)
+        connections = [pool.get_connection('_') for _ in range(3)]
+        for connection in connections:
+            connection.connect()
+            pool.release(connection)
+        assert pool.reap() == 0
+        time.sleep(0.06)
+        assert pool.reap() == 2
+        stats = pool.stats()
+        assert stats['idle'] == 1
+        assert stats['reaped'] == 2
+        assert len([c for c in connections if c._sock is None]) == 2
+
+    def test_background_reaper(self):
+        pool = get_pool(max_connections=5, max_idle_time=0.02)
+        pool.release(pool.get_connection('_'))
+        time.sleep(0.1)
+        assert pool.stats()['idle'] == 0
+        assert pool.stats()['reaped'] == 1
+
+
+class TestClientPoolOptions(object):
+    def test_bounded_pool(self):
+        client = niceredis.Redis(db=9, max_connections=3, pool_timeout=1,
+                                 min_connections=1)
+        assert isinstance(client.connection_pool, BoundedConnectionPool)
+        assert client.connection_pool.max_connections == 3
+        assert client.connection_pool.timeout == 1
+        assert client.ping()
+        stats = client.pool_stats()
+        assert stats['created'] == 1
+        assert stats['idle'] == 1
+
+    def test_default_pool_stats(self, r):
+        r.ping()
+        assert r.pool_stats() == {'in_use': 0, 'idle': 1, 'created': 1}
+
+
+def run_in_child(func):
+    "Run ``func`` in a forked child, returns if it returned a true value"
+    pid = os.fork()
+    if pid == 0:
+        try:
+            result = func()
+        except Exception:
+            result = False
+        os._exit(0 if result else 1)
+    return os.waitpid(pid, 0)[1] == 0
+
+
+class TestForkSafety(object):
+    def _test_pool_after_fork(self, client):
+        client.ping()
+        connection = client.connection_pool.get_connection('_')
+        client.connection_pool.release(connection)
+
+        def child():
+            client.set('a', 'child')
+            assert client.get('a') == b('child')
+            # the inherited connection is gone, a new one is used
+            assert client.pool_stats()['created'] == 1
+            return True
+        assert run_in_child(child)
+
+        # the parent's connection is still usable
+        assert connection._sock is not None
+        assert client.connection_pool.get_connection('_') is connection
+        client.connection_pool.release(connection)
+        assert client.get('a') == b('child')
+
+    def test_default_pool(self, r):
+        self._test_pool_after_fork(r)
+
+    def test_bounded_pool(self, request):
+        client = _get_client(niceredis.Redis, request, max_connections=2)
+        self._test_pool_after_fork(client)
+
+    def test_in_use_connection_released_in_child(self, r):
+        connection = r.connection_pool.get_connection('_')
+        connection.connect()
+
+        def child():
+            r.connection_pool.release(connection)
+            assert connection._sock is None
+            return r.ping()
+        assert run_in_child(child)
+        assert connection._sock is not None
+        connection.send_command('PING')
+        assert connection.read_response() == b('PONG')
+
+    def test_after_fork(self, r):
+        r.ping()
+        # nothing happens without a fork
+        r.after_fork()
+        assert r.pool_stats()['idle'] == 1
+
+        def child():
+            r.after_fork()
+            return r.pool_stats() == {'in_use': 0, 'idle': 0, 'created': 0}
+        assert run_in_child(child)
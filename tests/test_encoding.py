@@ -1,9 +1,13 @@
 from __future__ import with_statement
 
 import pytest
-from redis._compat import u, unichr, unicode
+from redis._compat import b, long, u, unichr, unicode
+from redis.connection import Token
 
-from .conftest import r as _redis_client
+import niceredis
+from niceredis.connection import EncodingCache
+
+from .conftest import _get_client, r as _redis_client
 
 
 class TestEncoding(object):
@@ -32,3 +36,47 @@ class TestCommandsAndTokensArentEncoded(object):
 
     def test_basic_command(self, r):
         r.set('hello', 'world')
+
+
+class TestEncodingCache(object):
+    def test_encodes_like_connection(self, r):
+        connection = r.connection_pool.get_connection('_')
+        cache = EncodingCache(size=4)
+        for value in (b('bytes'), u('text'), unichr(3456) + u('abcd'), 1,
+                      long(2), 1.5, Token('GET'), None):
+            assert cache.encode(value) == connection.encode(value)
+        r.connection_pool.release(connection)
+        # only text is memorized
+        assert cache.stats() == {'cached': 2, 'hits': 0, 'misses': 2,
+                                 'hit_rate': 0.0}
+
+    def test_bounded(self):
+        cache = EncodingCache(size=4)
+        for i in range(10):
+            cache.encode(u('key:%d') % i)
+        assert len(cache) <= 4
+        # the recently used ones are kept
+        cache.encode(u('key:9'))
+        assert cache.hits == 1
+        cache.encode(u('key:0'))
+        assert cache.misses == 11
+
+    def test_recently_used_survive(self):
+        cache = EncodingCache(size=4)
+        cache.encode(u('hot'))
+        for i in range(10):
+            cache.encode(u('key:%d') % i)
+            cache.encode(u('hot'))
+        assert cache.stats()['hits'] == 10
+
+    def test_client(self, request):
+        client = _get_client(niceredis.StrictRedis, request,
+                             encoding='utf-16', encoding_cache_size=100)
+        cache = client.connection_pool.encoding_cache
+        value = unichr(3456) + u('abcd')
+        client.set(value, value)
+        assert client.get(value).decode('utf-16') == value
+        client.mset({u('a'): 1, u('b'): 2})
+        assert client.mget(u('a'), u('b'), u('c')) == [b('1'), b('2'), None]
+        assert cache.stats() == {'cached': 4, 'hits': 4, 'misses': 4,
+                                 'hit_rate': 0.5}
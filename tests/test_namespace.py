@@ -0,0 +1,136 @@
+from redis._compat import b, u, unichr
+
+import niceredis
+from niceredis.client.sharded import ShardedRedis
+
+from .conftest import _get_client
+
+
+class TestNamespace(object):
+    def test_keys_prefixed(self, r):
+        view = r.namespace('app:')
+        view.set('a', '1')
+        view.mset({'b': '2', 'c': '3'})
+        assert sorted(r.keys()) == [b('app:a'), b('app:b'), b('app:c')]
+        assert view.get('a') == b('1')
+        assert view.mget('a', 'b', 'x') == [b('1'), b('2'), None]
+        assert view.key_prefix == b('app:')
+
+    def test_multi_key_commands(self, r):
+        view = r.namespace('app:')
+        view.sadd('s1', 'a', 'b')
+        view.sadd('s2', 'b', 'c')
+        assert view.sinter('s1', 's2') == set([b('b')])
+        view.zadd('z1', a=1, b=2)
+        view.zadd('z2', b=3)
+        assert view.zunionstore('z', ['z1', 'z2']) == 2
+        assert view.zrange('z', 0, -1, withscores=True) == \
+            [(b('a'), 1.0), (b('b'), 5.0)]
+        assert r.exists('app:z')
+
+    def test_sort_patterns(self, r):
+        view = r.namespace('app:')
+        view.rpush('l', '1', '2', '3')
+        view.mset({'w_1': 10, 'w_2': 5, 'w_3': 1, 'o_1': 'one'})
+        assert view.sort('l', by='w_*', get=['#', 'o_*']) == \
+            [b('3'), None, b('2'), None, b('1'), b('one')]
+
+    def test_sort_patterns_not_escaped(self, r):
+        view = r.namespace('app[1]:')
+        view.rpush('l', '1', '2')
+        view.mset({'w_1': 2, 'w_2': 1, 'o_1': 'one', 'o_2': 'two'})
+        assert view.sort('l', by='w_*', get='o_*') == [b('two'), b('one')]
+        assert r.get('app[1]:o_1') == b('one')
+        # while KEYS and SCAN take the prefix literally
+        assert sorted(view.keys('o_*')) == [b('o_1'), b('o_2')]
+        assert sorted(view.scan_iter('w_*')) == [b('w_1'), b('w_2')]
+
+    def test_keys_and_scan_stripped(self, r):
+        r.set('other', 'x')
+        view = r.namespace('app:')
+        view.mset({'a': 1, 'b': 2})
+        assert sorted(view.keys()) == [b('a'), b('b')]
+        assert view.keys('a*') == [b('a')]
+        assert sorted(view.scan_iter()) == [b('a'), b('b')]
+        cursor, keys = view.scan()
+        assert sorted(keys) == [b('a'), b('b')]
+
+    def test_glob_characters_escaped(self, r):
+        r.set('ab', 'x')
+        view = r.namespace('a?')
+        view.set('c', 'y')
+        r.set('aXc', 'z')
+        assert view.keys() == [b('c')]
+        assert list(view.scan_iter()) == [b('c')]
+
+    def test_blpop(self, r):
+        view = r.namespace('app:')
+        view.rpush('l', 'v')
+        assert view.blpop(['x', 'l'], timeout=1) == (b('l'), b('v'))
+        assert view.blpop('l', timeout=1) is None
+
+    def test_decoded_responses(self, request):
+        client = _get_client(niceredis.StrictRedis, request,
+                             decode_responses=True)
+        name = unichr(3456) + u('abcd')
+        view = client.namespace(name)
+        view.set('a', '1')
+        assert client.keys() == [name + u('a')]
+        assert view.keys() == [u('a')]
+
+    def test_pipeline(self, r):
+        view = r.namespace('app:')
+        for transaction in (True, False):
+            pipe = view.pipeline(transaction=transaction)
+            pipe.set('a', '1').rpush('l', 'v').keys('a').blpop('l', 1)
+            assert pipe.execute() == [True, 1, [b('a')], (b('l'), b('v'))]
+            # the recorded replies go with the executed commands
+            pipe.get('a')
+            assert pipe.execute() == [b('1')]
+        assert r.get('app:a') == b('1')
+
+    def test_classes_reused(self, r):
+        view = r.namespace('app:')
+        assert r.namespace('other:').__class__ is view.__class__
+        assert view.namespace('users:').__class__ is view.__class__
+        assert view.pipeline().__class__ is view.pipeline().__class__
+
+    def test_watch(self, r):
+        view = r.namespace('app:')
+        view.set('a', 1)
+        with view.pipeline() as pipe:
+            pipe.watch('a')
+            value = int(pipe.get('a'))
+            pipe.multi()
+            pipe.set('a', value + 1)
+            pipe.execute()
+        assert r.get('app:a') == b('2')
+
+    def test_nested(self, r):
+        view = r.namespace('app:').namespace('users:')
+        assert view.key_prefix == b('app:users:')
+        view.set('1', 'bob')
+        assert r.get('app:users:1') == b('bob')
+        assert view.keys() == [b('1')]
+
+    def test_prepared(self, r):
+        view = r.namespace('app:')
+        view.hset('user:1', 'name', 'bob')
+        assert view.prepare('HGET', None, 'name')('user:1') == b('bob')
+        # keys given when preparing get the prefix as well
+        assert view.prepare('HGET', 'user:1', None)('name') == b('bob')
+        get_name = r.prepare('HGET', None, 'name')
+        assert get_name.using(view)('user:1') == b('bob')
+
+    def test_sharded(self, request):
+        shards = dict([(name, _get_client(niceredis.StrictRedis, request,
+                                          db=db))
+                       for name, db in (('a', 9), ('b', 10))])
+        view = ShardedRedis(shards).namespace('app:')
+        keys = ['k%d' % i for i in range(10)]
+        view.mset(dict([(key, key) for key in keys]))
+        assert view.mget(keys) == [b(key) for key in keys]
+        assert sorted(view.keys()) == [b(key) for key in keys]
+        assert sorted(view.scan_iter()) == [b(key) for key in keys]
+        assert sorted(shards['a'].keys() + shards['b'].keys()) == \
+            sorted([b('app:' + key) for key in keys])
@@ -0,0 +1,206 @@
+import socket
+
+import pytest
+import redis
+from redis._compat import b, u, unichr
+
+import niceredis
+from niceredis.connection import BufferParser, ConnectionPool, Resp3Parser
+
+from .conftest import _get_client
+
+
+@pytest.fixture()
+def br(request):
+    return _get_client(niceredis.StrictRedis, request,
+                       parser_class=BufferParser)
+
+
+class FakeConnection(object):
+    decode_responses = False
+
+    def __init__(self, sock):
+        self._sock = sock
+
+
+@pytest.fixture()
+def fed_parser(request):
+    "parser on one end of a socket pair and the other end to feed it"
+    ours, theirs = socket.socketpair()
+    request.addfinalizer(theirs.close)
+    parser = BufferParser(socket_read_size=8)
+    parser.on_connect(FakeConnection(ours))
+    request.addfinalizer(parser.on_disconnect)
+    return parser, theirs
+
+
+class TestBufferParser(object):
+    def test_uses_the_parser(self, br):
+        connection = br.connection_pool.get_connection('_')
+        assert isinstance(connection._parser, BufferParser)
+        br.connection_pool.release(connection)
+
+    def test_replies(self, br):
+        assert br.set('a', 'foo') is True
+        assert br.get('a') == b('foo')
+        assert br.get('b') is None
+        assert br.incr('c') == 1
+        assert br.rpush('d', *range(10000)) == 10000
+        assert br.lrange('d', 0, -1) == [b(str(i)) for i in range(10000)]
+        assert br.lrange('e', 0, -1) == []
+        assert br.blpop('e', 1) is None
+        assert br.hset('h', 'x', '') == 1
+        assert br.hgetall('h') == {b('x'): b('')}
+
+    def test_nested_arrays(self, br):
+        pipe = br.pipeline()
+        pipe.rpush('a', 1, 2).lrange('a', 0, -1).hgetall('h').get('b')
+        assert pipe.execute() == [2, [b('1'), b('2')], {}, None]
+        assert br.eval("return {1, {2, {3, {}}}, 'x'}", 0) == \
+            [1, [2, [3, []]], b('x')]
+
+    def test_errors(self, br):
+        br.set('a', 'foo')
+        with pytest.raises(redis.ResponseError):
+            br.lpush('a', 1)
+        pipe = br.pipeline()
+        pipe.incr('a').get('a')
+        with pytest.raises(redis.ResponseError):
+            pipe.execute()
+        assert br.get('a') == b('foo')
+
+    def test_decode_responses(self, request):
+        br = _get_client(niceredis.StrictRedis, request,
+                         parser_class=BufferParser, decode_responses=True)
+        value = unichr(3456) + u('abcd') + unichr(3421)
+        br.set('a', value)
+        assert br.get('a') == value
+        assert br.mget('a', 'b') == [value, None]
+
+    def test_large_replies_with_a_small_buffer(self, request):
+        pool = ConnectionPool(db=9, parser_class=BufferParser,
+                              socket_read_size=16)
+        sr = _get_client(niceredis.StrictRedis, request, connection_pool=pool)
+        value = b('v') * 100000
+        sr.mset(dict(('k%d' % i, value) for i in range(3)))
+        assert sr.mget('k0', 'k1', 'k2', 'k3') == [value] * 3 + [None]
+        sr.set('a', value * 20)
+        assert sr.get('a') == value * 20
+        connection = pool.get_connection('_')
+        # the buffer grown beyond max_buffer_size is dropped
+        assert len(connection._parser._buffer) == 16
+        pool.release(connection)
+
+    def test_partial_reads(self, fed_parser):
+        parser, sock = fed_parser
+        # more than fits in the 8 byte buffer at once
+        sock.sendall(b('*3\r\n$5\r\nhello\r\n*2\r\n:1\r\n+OK\r\n$-1\r\n'
+                       '-ERR no\r\n'))
+        assert parser.read_response() == \
+            [b('hello'), [1, b('OK')], None]
+        assert parser.can_read()
+        error = parser.read_response()
+        assert isinstance(error, redis.ResponseError)
+        assert str(error) == 'no'
+        assert not parser.can_read()
+
+    def test_closed_connection(self, fed_parser):
+        parser, sock = fed_parser
+        sock.sendall(b('$10\r\nabc'))
+        sock.close()
+        with pytest.raises(redis.ConnectionError):
+            parser.read_response()
+
+    def test_resp3_types(self, fed_parser):
+        parser, sock = fed_parser
+        sock.sendall(b('%2\r\n$1\r\na\r\n~2\r\n:1\r\n:2\r\n$1\r\nb\r\n,1.5\r\n'
+                       '*5\r\n_\r\n#t\r\n#f\r\n(12345678901234567890\r\n'
+                       '=8\r\ntxt:text\r\n'
+                       '|1\r\n+ttl\r\n:3\r\n>2\r\n+message\r\n%0\r\n'
+                       '!9\r\nERR blob!\r\n'))
+        assert parser.read_response() == {b('a'): set([1, 2]), b('b'): 1.5}
+        assert parser.read_response() == \
+            [None, True, False, 12345678901234567890, b('text')]
+        # the attribute is dropped
+        assert parser.read_response() == [b('message'), {}]
+        error = parser.read_response()
+        assert isinstance(error, redis.ResponseError)
+        assert str(error) == 'blob!'
+
+
+class TestResp3(object):
+    @pytest.fixture()
+    def r3(self, request):
+        return _get_client(niceredis.StrictRedis, request, protocol=3)
+
+    def test_negotiated(self, r3):
+        connection = r3.connection_pool.get_connection('_')
+        assert isinstance(connection._parser, Resp3Parser)
+        r3.connection_pool.release(connection)
+        assert r3.protocol == 3
+        assert r3.execute_command('HELLO')[b('proto')] == 3
+
+    def test_password(self, request, sr):
+        sr.config_set('requirepass', 'secret')
+
+        def reset():
+            client = niceredis.StrictRedis(password='secret')
+            client.config_set('requirepass', '')
+            client.connection_pool.disconnect()
+        request.addfinalizer(reset)
+        r3 = _get_client(niceredis.StrictRedis, request, protocol=3,
+                         password='secret')
+        connection = r3.connection_pool.get_connection('_')
+        connection.disconnect()
+        sent = []
+        send_command = connection.send_command
+
+        def record(*args):
+            sent.append(args)
+            send_command(*args)
+        connection.send_command = record
+        connection.connect()
+        # authenticated once, before switching
+        assert sent == [('AUTH', 'secret'), ('SELECT', 9), ('HELLO', 3)]
+        connection.send_command('HELLO')
+        assert connection.read_response()[b('proto')] == 3
+        r3.connection_pool.release(connection)
+
+    def test_replies(self, r3):
+        r3.hmset('h', {'a': 1, 'b': 2})
+        assert r3.hgetall('h') == {b('a'): b('1'), b('b'): b('2')}
+        assert r3.hgetall('missing') == {}
+        r3.sadd('s', 'a', 'b')
+        assert r3.smembers('s') == set([b('a'), b('b')])
+        assert r3.smembers('missing') == set()
+        r3.zadd('z', a=1.5, b=2)
+        assert r3.zscore('z', 'a') == 1.5
+        assert r3.zscore('z', 'c') is None
+        assert r3.zincrby('z', 'a') == 2.5
+        assert r3.zrange('z', 0, -1, withscores=True) == \
+            [(b('b'), 2.0), (b('a'), 2.5)]
+        assert r3.zrevrange('z', 0, -1, withscores=True,
+                            score_cast_func=int) == [(b('a'), 2), (b('b'), 2)]
+        assert r3.zrange('z', 0, -1) == [b('b'), b('a')]
+        assert r3.config_get('maxmemory') == {'maxmemory': '0'}
+        assert r3.get('missing') is None
+        assert 'redis_version' in r3.info()
+
+    def test_pipeline(self, r3):
+        pipe = r3.pipeline()
+        pipe.hset('h', 'a', 1).hgetall('h').sadd('s', 'a').smembers('s')
+        assert pipe.execute() == [1, {b('a'): b('1')}, 1, set([b('a')])]
+
+    def test_callbacks(self, sr, r3):
+        for command in ('HGETALL', 'SMEMBERS', 'ZSCORE'):
+            assert command in sr.response_callbacks
+            assert command not in r3.response_callbacks
+
+    def test_protocol_from_the_pool(self, r3):
+        client = niceredis.StrictRedis(connection_pool=r3.connection_pool)
+        assert client.protocol == 3
+        with pytest.raises(ValueError):
+            niceredis.StrictRedis(connection_pool=r3.connection_pool,
+                                  protocol=2)
+        with pytest.raises(ValueError):
+            niceredis.StrictRedis(protocol=4)
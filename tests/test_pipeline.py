@@ -1,9 +1,15 @@
 from __future__ import with_statement
 
+import socket
+
 import pytest
 import redis
 from redis._compat import b, u, unichr, unicode
 
+from niceredis.client.retry import RetryPolicy
+
+from .test_connection_pool import run_in_child
+
 
 class TestPipeline(object):
     def test_pipeline(self, r):
@@ -224,3 +230,284 @@ class TestPipeline(object):
             assert unicode(ex.value).startswith(expected)
 
         assert r[key] == b('1')
+
+    def test_execute_iter(self, r):
+        with r.pipeline(transaction=False) as pipe:
+            pipe.set('a', 'a1').get('a').zadd('z', z1=1)
+            pipe.zrange('z', 0, 5, withscores=True)
+            replies = pipe.execute_iter()
+            assert next(replies) is True
+            assert list(replies) == [b('a1'), True, [(b('z1'), 1.0)]]
+            assert len(pipe) == 0
+            assert pipe.connection is None
+
+    def test_execute_iter_transaction(self, r):
+        with r.pipeline() as pipe:
+            pipe.set('a', 'a1').get('a')
+            assert list(pipe.execute_iter()) == [True, b('a1')]
+
+    def test_execute_iter_error_raised(self, r):
+        r['c'] = 'a'
+        with r.pipeline(transaction=False) as pipe:
+            pipe.set('a', 1).lpush('c', 3).set('d', 4)
+            replies = pipe.execute_iter()
+            assert next(replies) is True
+            with pytest.raises(redis.ResponseError) as ex:
+                next(replies)
+            assert unicode(ex.value).startswith('Command # 2 (LPUSH c 3) of '
+                                                'pipeline caused error: ')
+            # the commands after the error were still executed
+            assert r['d'] == b('4')
+
+            # make sure the pipe was restored to a working state
+            assert pipe.set('z', 'zzz').execute() == [True]
+
+    def test_execute_iter_error_in_response(self, r):
+        r['c'] = 'a'
+        with r.pipeline(transaction=False) as pipe:
+            pipe.set('a', 1).lpush('c', 3).set('d', 4)
+            result = list(pipe.execute_iter(raise_on_error=False))
+            assert result[0]
+            assert isinstance(result[1], redis.ResponseError)
+            assert result[2]
+
+    def test_execute_iter_abandoned(self, r):
+        with r.pipeline(transaction=False) as pipe:
+            pipe.set('a', 1).set('b', 2).set('c', 3)
+            replies = pipe.execute_iter()
+            assert next(replies) is True
+            replies.close()
+            assert len(pipe) == 0
+
+            # the unread replies were dropped with the connection
+            assert pipe.get('a').get('c').execute() == [b('1'), b('3')]
+
+    def test_flushing_pipeline_writes_ahead(self, r):
+        with r.pipeline(transaction=False, flush_size=1) as pipe:
+            assert pipe.flushing
+            pipe.set('a', 'a1').get('a')
+            # the commands are on the wire before execute() is called
+            assert r['a'] == b('a1')
+            assert pipe.execute() == [True, b('a1')]
+            assert pipe.set('b', 'b1').execute() == [True]
+
+    def test_flushing_pipeline_buffers_small_batches(self, r):
+        with r.pipeline(transaction=False, flush_size=1024) as pipe:
+            pipe.set('a', 'a1').get('a')
+            assert 'a' not in r
+            assert pipe.execute() == [True, b('a1')]
+
+    def test_flushing_pipeline_reset_without_execute(self, r):
+        with r.pipeline(transaction=False, flush_size=1) as pipe:
+            pipe.set('a', 'a1').set('b', 'b1')
+            conn = pipe.connection
+            pipe.reset()
+            # the unread replies were dropped with the connection
+            assert conn._sock is None
+            assert pipe.get('a').execute() == [b('a1')]
+
+    def test_flushing_pipeline_not_used_for_transactions(self, r):
+        with r.pipeline(flush_size=1) as pipe:
+            assert not pipe.flushing
+            pipe.set('a', 'a1')
+            assert 'a' not in r
+            assert pipe.execute() == [True]
+
+    def test_flushing_pipeline_error_raised(self, r):
+        r['c'] = 'a'
+        with r.pipeline(transaction=False, flush_size=1) as pipe:
+            pipe.set('a', 1).lpush('c', 3).set('d', 4)
+            with pytest.raises(redis.ResponseError) as ex:
+                pipe.execute()
+            assert unicode(ex.value).startswith('Command # 2 (LPUSH c 3) of '
+                                                'pipeline caused error: ')
+            assert pipe.set('z', 'zzz').execute() == [True]
+
+    def test_flushing_pipeline_failed_flush_not_replayed(self, r):
+        with r.pipeline(transaction=False, flush_size=1) as pipe:
+            pipe.incr('a')
+            pipe.connection._sock.shutdown(socket.SHUT_RDWR)
+            pipe.incr('b')
+            # the INCR written ahead may have run, so it isn't sent again
+            with pytest.raises(redis.ConnectionError):
+                pipe.execute()
+        assert r['a'] == b('1')
+        assert 'b' not in r
+        assert r.retry_policy.stats.get()['unsafe'] == 1
+
+    def test_flushing_pipeline_failed_flush_retried(self, r):
+        with r.pipeline(transaction=False, flush_size=1) as pipe:
+            pipe.set('a', 'a1')
+            pipe.connection._sock.shutdown(socket.SHUT_RDWR)
+            pipe.set('b', 'b1').get('a')
+            assert pipe.execute() == [True, True, b('a1')]
+        stats = r.retry_policy.stats.get()
+        assert stats['retries'] == stats['recovered'] == 1
+
+    def test_result_references(self, r):
+        r['session'] = 42
+        r.hmset('user:42', {'name': 'joe'})
+        with r.pipeline(transaction=False) as pipe:
+            user_id = pipe.get('session').ref()
+            pipe.hgetall(user_id.map(lambda i: b('user:') + i))
+            pipe.set('last-user', user_id)
+            assert pipe.execute() == [b('42'), {b('name'): b('joe')}, True]
+            assert r['last-user'] == b('42')
+
+    def test_result_references_use_one_round_trip_per_stage(self, r):
+        r['a'] = 'b'
+        r['b'] = 'c'
+        with r.pipeline(transaction=False) as pipe:
+            pipe.get('a')
+            first = pipe.ref()
+            pipe.get(first).set('x', 1)
+            second = pipe.ref(1)
+            pipe.get(second).get(first)
+
+            sent = []
+            execute = pipe._execute_pipeline
+
+            def _execute_pipeline(connection, commands, raise_on_error):
+                sent.append([args[0] for args, _ in commands])
+                return execute(connection, commands, raise_on_error)
+            pipe._execute_pipeline = _execute_pipeline
+
+            assert pipe.execute() == [b('b'), b('c'), True, None, b('c')]
+            assert sent == [['GET', 'SET'], ['GET', 'GET'], ['GET']]
+
+    def test_result_references_to_failed_commands(self, r):
+        r['c'] = 'a'
+        with r.pipeline(transaction=False) as pipe:
+            pipe.lpush('c', 3)
+            pipe.set('d', pipe.ref()).set('e', 1)
+            result = pipe.execute(raise_on_error=False)
+            assert isinstance(result[0], redis.ResponseError)
+            assert isinstance(result[1], redis.ResponseError)
+            assert result[2]
+            assert 'd' not in r
+
+            pipe.lpush('c', 3)
+            pipe.set('d', pipe.ref())
+            with pytest.raises(redis.ResponseError) as ex:
+                pipe.execute()
+            assert unicode(ex.value).startswith('Command # 1 (LPUSH c 3) of '
+                                                'pipeline caused error: ')
+
+    def test_result_references_not_in_transaction(self, r):
+        with r.pipeline() as pipe:
+            pipe.get('a')
+            with pytest.raises(redis.RedisError):
+                pipe.ref()
+
+    def test_result_references_in_flushing_pipeline(self, r):
+        r['a'] = 'b'
+        with r.pipeline(transaction=False, flush_size=1) as pipe:
+            key = pipe.get('a').ref()
+            pipe.set(key, 'x').set('y', 'z')
+            assert r['y'] == b('z')
+            assert 'b' not in r
+            assert pipe.execute() == [b('b'), True, True]
+            assert r['b'] == b('x')
+
+    def test_transaction_max_attempts(self, r):
+        r['a'] = 1
+        attempts = []
+
+        def my_transaction(pipe):
+            attempts.append(1)
+            r.incr('a')
+            pipe.multi()
+            pipe.set('b', 1)
+
+        with pytest.raises(redis.WatchError):
+            r.transaction(my_transaction, 'a',
+                          retry_policy=RetryPolicy(max_attempts=3))
+        assert len(attempts) == 3
+        assert 'b' not in r
+        assert r.transaction_stats.get('a') == {
+            'transactions': 1, 'attempts': 3, 'conflicts': 3, 'commits': 0,
+            'fallbacks': 0, 'aborts': 1}
+
+    def test_transaction_fallback(self, r):
+        r['a'] = 1
+
+        def my_transaction(pipe):
+            r.incr('a')
+            pipe.multi()
+            pipe.incr('a')
+
+        def fallback(client):
+            return client.incr('a', 10)
+
+        result = r.transaction(my_transaction, 'a', fallback=fallback,
+                               retry_policy=RetryPolicy(max_attempts=2))
+        assert result == 13
+        assert r.transaction_stats.get('a')['fallbacks'] == 1
+
+    def test_transaction_stats(self, r):
+        r['user:1:visits'] = 1
+        r['user:2:visits'] = 1
+        has_run = []
+
+        def my_transaction(pipe):
+            if not has_run:
+                r.incr('user:1:visits')
+                has_run.append('it has')
+            pipe.multi()
+            pipe.incr('user:1:visits')
+
+        r.transaction(my_transaction, 'user:1:visits')
+        r.transaction(lambda pipe: pipe.incr('user:2:visits'),
+                      'user:2:visits')
+        stats = r.transaction_stats
+        assert stats.get('user:*:visits') == {
+            'transactions': 2, 'attempts': 3, 'conflicts': 1, 'commits': 2,
+            'fallbacks': 0, 'aborts': 0}
+        assert stats.conflict_rate('user:*:visits') == 1 / 3.0
+
+        r.transaction(lambda pipe: pipe.incr('user:2:visits'),
+                      'user:2:visits', stats_key='visits')
+        assert stats.get('visits')['commits'] == 1
+
+    def test_pipeline_after_fork(self, r):
+        with r.pipeline(transaction=False, flush_size=1) as pipe:
+            pipe.set('a', 'a1')
+            connection = pipe.connection
+
+            def child():
+                pipe.get('a')
+                return pipe.execute() == [True, b('a1')]
+            assert run_in_child(child)
+
+            # the command written ahead is still answered in the parent
+            assert connection._sock is not None
+            assert pipe.execute() == [True]
+
+    def test_pipeline_after_fork_not_replayed(self, r):
+        with r.pipeline(transaction=False, flush_size=1) as pipe:
+            pipe.incr('a')
+
+            def child():
+                try:
+                    pipe.execute()
+                except redis.ConnectionError:
+                    return True
+            assert run_in_child(child)
+            assert pipe.execute() == [1]
+        assert r['a'] == b('1')
+
+    def test_watch_lost_after_fork(self, r):
+        r['a'] = 1
+        with r.pipeline() as pipe:
+            pipe.watch('a')
+
+            def child():
+                try:
+                    pipe.get('a')
+                except redis.WatchError:
+                    return not pipe.watching
+            assert run_in_child(child)
+            assert pipe.watching
+            pipe.multi()
+            pipe.get('a')
+            assert pipe.execute() == [b('1')]
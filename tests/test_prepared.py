@@ -0,0 +1,56 @@
+import pytest
+from redis._compat import b, u, unichr
+
+from niceredis.connection import CommandTemplate, pack_command
+
+
+class TestPreparedCommands(object):
+    def test_packed_like_connection(self, r):
+        connection = r.connection_pool.get_connection('_')
+        large = b('v') * 10000
+        for args, values in (
+                (('HGET', None, 'name'), ('user:1',)),
+                (('SET', None, None), ('a', large)),
+                (('CONFIG GET', None), ('maxmemory',)),
+                (('ZADD', 'z', None, 1.5, None), (2, unichr(3456) + u('a'))),
+                (('PING',), ())):
+            template = CommandTemplate(args)
+            full = list(template.args)
+            for slot, value in zip(template.slots, values):
+                full[slot] = value
+            expected = connection.pack_command(*full)
+            assert b('').join(pack_command(connection, full)) == \
+                b('').join(expected)
+        # large values stay apart
+        template = CommandTemplate(('SET', None, None))
+        assert large in pack_command(connection, (template, 'a', large))
+        r.connection_pool.release(connection)
+
+    def test_call(self, r):
+        get_name = r.prepare('HGET', None, 'name')
+        assert repr(get_name) == "PreparedCommand<HGET ? 'name'>"
+        r.hset('user:1', 'name', 'bob')
+        assert get_name('user:1') == b('bob')
+        assert get_name('user:2') is None
+        # the response callback applies
+        assert r.prepare('HGETALL', None)('user:1') == {b('name'): b('bob')}
+        assert r.prepare('ZRANGE', None, 0, -1)('z', withscores=False) == []
+        with pytest.raises(TypeError):
+            get_name('user:1', 'user:2')
+
+    def test_pipeline(self, r):
+        set_name = r.prepare('HSET', None, 'name', None)
+        get_name = r.prepare('HGET', None, 'name')
+        for transaction in (True, False):
+            pipe = r.pipeline(transaction=transaction)
+            set_name.using(pipe)('user:1', 'bob')
+            get_name.using(pipe)('user:1')
+            pipe.prepare('HGET', None, 'name')('user:2')
+            assert pipe.execute()[1:] == [b('bob'), None]
+
+    def test_flushing_pipeline(self, r):
+        incr = r.prepare('INCRBY', 'a', None)
+        with r.pipeline(transaction=False, flush_size=1) as pipe:
+            for i in range(3):
+                incr.using(pipe)(i)
+            assert pipe.execute() == [0, 1, 3]
@@ -1,5 +1,7 @@
 from __future__ import with_statement
 
+import pickle
+import threading
 import time
 
 import pytest
@@ -7,7 +9,13 @@ import redis
 from redis._compat import basestring, u, unichr
 from redis.exceptions import ConnectionError
 
+import niceredis
+from niceredis import HandlerPool
+from niceredis.client import dispatch
+from niceredis.client.pubsub import MESSAGE_TYPES, Message
+
 from .conftest import r as _redis_client
+from .test_connection_pool import run_in_child
 
 
 def wait_for_message(pubsub, timeout=0.1, ignore_subscribe_messages=False):
@@ -23,6 +31,13 @@ def wait_for_message(pubsub, timeout=0.1, ignore_subscribe_messages=False):
     return None
 
 
+def push_data(message):
+    # a handler run in a worker process
+    client = niceredis.StrictRedis(db=9)
+    client.rpush('handled', message['data'])
+    client.connection_pool.disconnect()
+
+
 def make_message(type, channel, data, pattern=None):
     return {
         'type': type,
@@ -229,6 +244,25 @@ class TestPubSubMessages(object):
         assert isinstance(message, dict)
         assert message == make_message('message', 'foo', 'test message')
 
+    def test_published_message_after_fork(self, r):
+        p = r.pubsub(ignore_subscribe_messages=True)
+        p.subscribe('foo')
+        assert wait_for_message(p) is None
+
+        def child():
+            # the subscription is made again on a new connection
+            assert wait_for_message(p) is None
+            assert r.publish('foo', 'from child') == 2
+            return wait_for_message(p) == \
+                make_message('message', 'foo', 'from child')
+        assert run_in_child(child)
+
+        assert wait_for_message(p) == \
+            make_message('message', 'foo', 'from child')
+        assert r.publish('foo', 'test message') == 1
+        assert wait_for_message(p) == \
+            make_message('message', 'foo', 'test message')
+
     def test_published_message_to_pattern(self, r):
         p = r.pubsub(ignore_subscribe_messages=True)
         p.subscribe('foo')
@@ -384,6 +418,326 @@ class TestPubSubAutoDecoding(object):
                                                  pattern=self.pattern)
 
 
+class TestMessageClasses(object):
+    def test_message(self, r):
+        p = r.pubsub(ignore_subscribe_messages=True, message_class=Message)
+        p.subscribe('foo')
+        p.psubscribe('f*')
+        r.publish('foo', 'test message')
+        messages = p.get_messages()
+        messages.extend(p.get_messages())
+        assert sorted([m.type for m in messages]) == ['message', 'pmessage']
+        for message in messages:
+            assert isinstance(message, Message)
+            assert message.channel == message['channel'] == b'foo'
+            pattern = message.pattern and 'f*'
+            assert message == make_message(message.type, 'foo',
+                                           'test message', pattern)
+            assert pickle.loads(pickle.dumps(message)) == message
+        with pytest.raises(KeyError):
+            messages[0]['other']
+
+    def test_message_handler(self, r):
+        handled = []
+        p = r.pubsub(message_class=Message)
+        p.subscribe(foo=handled.append)
+        assert p.get_messages() == [
+            Message('subscribe', None, b'foo', 1)]
+        r.publish('foo', 'test message')
+        assert wait_for_message(p) is None
+        assert handled == [Message('message', None, b'foo', b'test message')]
+
+    def test_tuple(self, r):
+        p = r.pubsub(message_class=tuple)
+        p.subscribe('foo')
+        r.publish('foo', 'test message')
+        assert wait_for_message(p) == ('subscribe', None, b'foo', 1)
+        assert wait_for_message(p) == \
+            ('message', None, b'foo', b'test message')
+
+    def test_decoded_types_interned(self, request):
+        r = _redis_client(request=request, decode_responses=True)
+        p = r.pubsub()
+        p.subscribe('foo')
+        message = wait_for_message(p)
+        assert message['type'] == 'subscribe'
+        assert message['type'] is MESSAGE_TYPES[b'subscribe']
+
+
+class TestGetMessages(object):
+    def test_drains_buffered(self, r):
+        p = r.pubsub(ignore_subscribe_messages=True)
+        p.subscribe('foo')
+        for i in range(100):
+            r.publish('foo', i)
+        messages = []
+        end = time.time() + 1
+        while len(messages) < 100 and time.time() < end:
+            messages.extend(p.get_messages())
+        assert [m['data'] for m in messages] == \
+            [str(i).encode('utf-8') for i in range(100)]
+        assert p.get_messages() == []
+
+    def test_max_count(self, r):
+        p = r.pubsub()
+        p.subscribe('foo')
+        for i in range(10):
+            r.publish('foo', i)
+        time.sleep(0.05)
+        messages = p.get_messages(max_count=4)
+        assert len(messages) == 4
+        assert messages[0]['type'] == 'subscribe'
+        assert p.get_messages(max_count=0) == []
+        messages = p.get_messages(ignore_subscribe_messages=True)
+        assert [m['data'] for m in messages] == \
+            [str(i).encode('utf-8') for i in range(3, 10)]
+
+    def test_before_subscribing(self, r):
+        p = r.pubsub()
+        assert p.get_messages() == []
+        assert p.connection is None
+
+    def test_handlers(self, r):
+        handled = []
+        p = r.pubsub(ignore_subscribe_messages=True)
+        p.subscribe(foo=handled.append)
+        p.subscribe('bar')
+        r.publish('foo', 'one')
+        r.publish('bar', 'two')
+        time.sleep(0.05)
+        messages = p.get_messages()
+        assert [m['data'] for m in messages] == [b'two']
+        assert [m['data'] for m in handled] == [b'one']
+
+    def test_not_subscribed(self, r):
+        p = r.pubsub()
+        p.subscribe('foo')
+        p.unsubscribe('foo')
+        time.sleep(0.05)
+        assert [m['type'] for m in p.get_messages()] == \
+            ['subscribe', 'unsubscribe']
+        assert not p.subscribed
+
+
+class TestPubSubWorkerThread(object):
+    def wait_for(self, condition, timeout=1):
+        end = time.time() + timeout
+        while not condition() and time.time() < end:
+            time.sleep(0.01)
+        return condition()
+
+    def test_handles_messages(self, r):
+        messages = []
+        p = r.pubsub()
+        p.subscribe(foo=messages.append)
+        thread = p.run_in_thread()
+        for i in range(100):
+            r.publish('foo', i)
+        assert self.wait_for(lambda: len(messages) == 100)
+        assert [m['data'] for m in messages] == \
+            [str(i).encode('utf-8') for i in range(100)]
+        thread.stop()
+        assert not thread.is_alive()
+
+    def test_blocks_while_idle(self, r):
+        messages = []
+        p = r.pubsub()
+        p.subscribe(foo=messages.append)
+        reads = []
+        parse_response = p.parse_response
+
+        def counting_parse_response(*args, **kwargs):
+            reads.append(1)
+            return parse_response(*args, **kwargs)
+        p.parse_response = counting_parse_response
+        thread = p.run_in_thread()
+        time.sleep(0.3)
+        # the subscribe reply, then nothing to read until stopped
+        assert len(reads) <= 3
+        start = time.time()
+        thread.stop()
+        assert time.time() - start < 0.5
+        assert not thread.is_alive()
+        assert messages == []
+
+    def test_ends_when_unsubscribed(self, r):
+        p = r.pubsub()
+        p.subscribe(foo=lambda message: p.unsubscribe('foo'))
+        thread = p.run_in_thread()
+        r.publish('foo', 'bye')
+        thread.join(1)
+        assert not thread.is_alive()
+        assert not p.subscribed
+        thread.stop()
+
+    def test_stop_in_handler(self, r):
+        p = r.pubsub()
+        p.subscribe(foo=lambda message: thread.stop())
+        thread = p.run_in_thread()
+        r.publish('foo', 'stop')
+        thread.join(1)
+        assert not thread.is_alive()
+        assert p.subscribed
+
+    def test_needs_handlers(self, r):
+        p = r.pubsub()
+        p.subscribe('foo')
+        with pytest.raises(redis.PubSubError):
+            p.run_in_thread()
+
+
+class TestHandlerPool(object):
+    def blocked_pool(self, request, **kwargs):
+        # a pool whose single worker waits for the event
+        event = threading.Event()
+        handled = []
+        pool = HandlerPool(workers=1, **kwargs)
+
+        def close():
+            event.set()
+            pool.close()
+        request.addfinalizer(close)
+
+        def handler(message):
+            event.wait()
+            handled.append(message)
+        return pool, handler, event, handled
+
+    def dispatch_all(self, p, pool, count):
+        end = time.time() + 2
+        while pool.stats()['dispatched'] < count and time.time() < end:
+            p.get_message()
+
+    def test_per_channel_order(self, r):
+        pool = HandlerPool(workers=3)
+        handled = {}
+
+        def handler(message):
+            handled.setdefault(message['channel'], []).append(message['data'])
+        p = r.pubsub(ignore_subscribe_messages=True, handler_pool=pool)
+        p.subscribe(foo=handler, bar=handler)
+        p.psubscribe(**{'b*': handler})
+        for i in range(50):
+            r.publish('foo', i)
+            r.publish('bar', i)
+        self.dispatch_all(p, pool, 150)
+        pool.close()
+        expected = [str(i).encode('utf-8') for i in range(50)]
+        assert handled[b'foo'] == expected
+        # by the channel and the pattern, in order
+        assert handled[b'bar'][::2] == handled[b'bar'][1::2] == expected
+        stats = pool.stats()
+        assert stats['dispatched'] == stats['handled'] == 150
+        assert stats['queued'] == 0
+
+    def test_drop(self, request):
+        pool, handler, event, handled = self.blocked_pool(
+            request, queue_size=2, policy='drop')
+        results = [pool.dispatch('foo', handler, i) for i in range(5)]
+        # one taken by the worker, two queued
+        time.sleep(0.05)
+        assert results.count(False) >= 2
+        stats = pool.stats()
+        assert stats['dropped'] == results.count(False)
+        assert stats['queued'] <= 2
+        event.set()
+        pool.close()
+        assert handled == [i for i, queued in enumerate(results) if queued]
+
+    def test_spill(self, request):
+        pool, handler, event, handled = self.blocked_pool(
+            request, queue_size=2, policy='spill')
+        for i in range(20):
+            assert pool.dispatch('foo', handler, {'data': i})
+        stats = pool.stats()
+        assert stats['spilled'] >= 17
+        assert stats['queued'] >= 19
+        event.set()
+        pool.close()
+        assert [message['data'] for message in handled] == list(range(20))
+        assert pool.stats()['queued'] == 0
+        lane = pool._lanes[0]
+        assert lane.handlers == {}
+        assert lane._file is None
+
+    def test_spill_file_removed_after_close(self, request):
+        pool, handler, event, handled = self.blocked_pool(
+            request, queue_size=1, policy='spill')
+        for i in range(5):
+            pool.dispatch('foo', handler, i)
+        lane = pool._lanes[0]
+        assert lane._file is not None
+        # the worker is still busy, it handles the rest once released
+        pool.close(timeout=0.05)
+        assert lane._file is not None
+        event.set()
+        pool._threads[0].join(1)
+        assert handled == list(range(5))
+        assert lane._file is None
+        assert lane.handlers == {}
+
+    def test_block(self, request):
+        pool, handler, event, handled = self.blocked_pool(request,
+                                                          queue_size=1)
+        pool.dispatch('foo', handler, 0)
+        pool.dispatch('foo', handler, 1)
+        thread = threading.Thread(target=pool.dispatch,
+                                  args=('foo', handler, 2))
+        thread.start()
+        thread.join(0.1)
+        assert thread.is_alive()
+        event.set()
+        thread.join(1)
+        assert not thread.is_alive()
+        pool.close()
+        assert handled == [0, 1, 2]
+        assert pool.stats()['max_depth'] == 1
+
+    def test_errors(self):
+        errors = []
+        pool = HandlerPool(workers=1, error_handler=lambda message, e:
+                           errors.append((message, e)))
+
+        def handler(message):
+            raise ValueError(message)
+        pool.dispatch('foo', handler, 'boom')
+        pool.close()
+        assert [(m, type(e)) for m, e in errors] == [('boom', ValueError)]
+        assert pool.stats()['errors'] == 1
+        with pytest.raises(RuntimeError):
+            pool.dispatch('foo', handler, 'late')
+
+    def test_errors_logged(self, monkeypatch):
+        logged = []
+        monkeypatch.setattr(dispatch.logger, 'exception',
+                            lambda *args: logged.append(args))
+        pool = HandlerPool(workers=1)
+
+        def handler(message):
+            raise ValueError(message)
+        pool.dispatch('foo', handler, 'boom')
+        pool.close()
+        assert logged == [('Error handling the message %r', 'boom')]
+        assert pool.stats()['errors'] == 1
+
+    def test_processes(self, r):
+        pool = HandlerPool(workers=2, processes=True)
+        p = r.pubsub(ignore_subscribe_messages=True, handler_pool=pool)
+        p.subscribe(foo=push_data)
+        for i in range(10):
+            r.publish('foo', i)
+        self.dispatch_all(p, pool, 10)
+        pool.close()
+        assert r.lrange('handled', 0, -1) == \
+            [str(i).encode('utf-8') for i in range(10)]
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            HandlerPool(policy='wait')
+        with pytest.raises(ValueError):
+            HandlerPool(workers=0)
+
+
 class TestPubSubRedisDown(object):
 
     def test_channel_subscribe(self, r):
@@ -0,0 +1,262 @@
+import socket
+import threading
+import time
+
+import pytest
+import redis
+from redis._compat import b
+
+import niceredis
+from niceredis.client.base import RedisBase
+from niceredis.connection import ConnectionPool, HedgingPolicy, ReplicaSelector
+from niceredis.connection import replica as replica_module
+
+
+class CountingPool(ConnectionPool):
+    def __init__(self, name, **kwargs):
+        params = {'host': 'localhost', 'port': 6379, 'db': 9}
+        params.update(kwargs)
+        super(CountingPool, self).__init__(**params)
+        self.name = name
+        self.used = 0
+
+    def get_connection(self, command_name, *keys, **options):
+        self.used += 1
+        return super(CountingPool, self).get_connection(
+            command_name, *keys, **options)
+
+
+@pytest.fixture()
+def stalled_port(request):
+    "port of a server that accepts connections but never answers"
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    request.addfinalizer(sock.close)
+    return sock.getsockname()[1]
+
+
+@pytest.fixture()
+def offsets(monkeypatch):
+    "replication info by pool name, None meaning the pool is unreachable"
+    offsets = {'primary': {'role': 'master', 'master_repl_offset': 1000}}
+
+    def replication_info(pool, timeout=None):
+        info = offsets[pool.name]
+        if info is None:
+            raise redis.ConnectionError()
+        return info
+    monkeypatch.setattr(replica_module, 'replication_info', replication_info)
+    return offsets
+
+
+def replica_info(offset, link='up'):
+    return {'role': 'slave', 'master_link_status': link,
+            'slave_repl_offset': offset}
+
+
+class TestReadOnlyCommands(object):
+    def test_derived_from_mixins(self, r):
+        assert set(['GET', 'MGET', 'HGETALL', 'LRANGE', 'SMEMBERS', 'SSCAN',
+                    'ZRANGEBYSCORE', 'SCAN']) <= r.read_only_commands
+        assert not set(['SET', 'DEL', 'SORT', 'EVALSHA', 'SINTERSTORE',
+                        'BLPOP']) & r.read_only_commands
+
+    def test_includes_new_mixins(self):
+        class FooCommands(RedisBase):
+            READ_ONLY_COMMANDS = set(('FOO.GET',))
+
+        class FooRedis(FooCommands, niceredis.StrictRedis):
+            pass
+
+        client = FooRedis(db=9)
+        assert 'FOO.GET' in client.read_only_commands
+        assert 'GET' in client.read_only_commands
+
+
+class TestReplicaSelector(object):
+    def test_skips_lagging_replicas(self, offsets):
+        offsets.update({'a': replica_info(990), 'b': replica_info(100)})
+        a, b = CountingPool('a'), CountingPool('b')
+        selector = ReplicaSelector(CountingPool('primary'), [a, b],
+                                   max_lag=100)
+        assert selector.check() == [a]
+        assert selector.lag() == {a: 10, b: 900}
+        assert set([selector.get_pool() for _ in range(4)]) == set([a])
+
+    def test_round_robin(self, offsets):
+        offsets.update({'a': replica_info(1000), 'b': replica_info(1000)})
+        a, b = CountingPool('a'), CountingPool('b')
+        selector = ReplicaSelector(CountingPool('primary'), [a, b])
+        selector.check()
+        assert [selector.get_pool() for _ in range(4)].count(a) == 2
+
+    def test_skips_down_replicas(self, offsets):
+        offsets.update({'a': replica_info(1000, link='down'), 'b': None})
+        primary = CountingPool('primary')
+        selector = ReplicaSelector(primary, [CountingPool('a'),
+                                             CountingPool('b')])
+        assert selector.check() == []
+        assert selector.get_pool() is primary
+
+    def wait_for_pool(self, selector, pool, timeout=1):
+        end = time.time() + timeout
+        while selector.get_pool() is not pool and time.time() < end:
+            time.sleep(0.01)
+        return selector.get_pool()
+
+    def test_checks_every_interval(self, offsets):
+        offsets['a'] = replica_info(1000)
+        a = CountingPool('a')
+        selector = ReplicaSelector(CountingPool('primary'), [a],
+                                   max_lag=100, check_interval=0.05)
+        # the primary until the first check
+        assert selector.get_pool() is selector.primary
+        assert self.wait_for_pool(selector, a) is a
+        offsets['a'] = replica_info(0)
+        assert self.wait_for_pool(selector, selector.primary) is \
+            selector.primary
+
+    def test_checks_in_background(self, offsets, monkeypatch):
+        offsets['a'] = replica_info(1000)
+        a = CountingPool('a')
+        selector = ReplicaSelector(CountingPool('primary'), [a],
+                                   check_interval=0.05)
+        assert self.wait_for_pool(selector, a) is a
+        # a check hanging on a replica doesn't hold up reads
+        checking = threading.Event()
+        release = threading.Event()
+
+        def replication_info(pool, timeout=None):
+            checking.set()
+            release.wait()
+            return offsets[pool.name]
+        monkeypatch.setattr(replica_module, 'replication_info',
+                            replication_info)
+        try:
+            assert checking.wait(1)
+            start = time.time()
+            assert selector.get_pool() is a
+            assert time.time() - start < 0.1
+        finally:
+            release.set()
+
+    def test_check_timeout(self, stalled_port):
+        # no SELECT on connecting, which would wait forever
+        stalled = CountingPool('a', host='127.0.0.1', port=stalled_port,
+                               db=0)
+        selector = ReplicaSelector(CountingPool('primary'), [stalled],
+                                   check_interval=None, check_timeout=0.1)
+        start = time.time()
+        assert selector.check() == []
+        assert time.time() - start < 1
+
+    def test_unreachable_replica(self):
+        primary = CountingPool('primary')
+        selector = ReplicaSelector(primary, [CountingPool('a', port=16379)])
+        assert selector.check() == []
+        assert selector.get_pool() is primary
+
+
+class TestReadWriteSplitting(object):
+    def test_reads_go_to_replicas(self, offsets, r):
+        offsets['replica'] = replica_info(1000)
+        primary = CountingPool('primary')
+        replica = CountingPool('replica')
+        client = niceredis.StrictRedis(connection_pool=primary,
+                                       replicas=[replica])
+        client.replica_selector.check()
+        client.set('a', 'foo')
+        assert primary.used == 1
+        assert client.get('a') == b('foo')
+        assert client.hgetall('b') == {}
+        assert replica.used == 2
+        assert primary.used == 1
+
+    def test_pipelines_use_the_primary(self, offsets, r):
+        offsets['replica'] = replica_info(1000)
+        primary = CountingPool('primary')
+        replica = CountingPool('replica')
+        client = niceredis.StrictRedis(connection_pool=primary,
+                                       replicas=[replica])
+        pipe = client.pipeline()
+        pipe.set('a', 'foo').get('a')
+        assert pipe.execute() == [True, b('foo')]
+        assert replica.used == 0
+
+    def test_replica_addresses(self):
+        client = niceredis.StrictRedis(db=9, replicas=[('127.0.0.1', 6379)])
+        pool = client.replica_selector.replicas[0]
+        assert pool.connection_kwargs['host'] == '127.0.0.1'
+        assert pool.connection_kwargs['db'] == 9
+        # not a replica, reads fall back to the primary
+        client.set('a', 'foo')
+        assert client.get('a') == b('foo')
+
+
+class TestHedgedReads(object):
+    def test_slow_primary(self, offsets, r, stalled_port):
+        offsets['replica'] = replica_info(1000)
+        r.set('a', 'foo')
+        # no SELECT on connecting, which would wait forever
+        primary = CountingPool('primary', host='127.0.0.1', port=stalled_port,
+                               db=0)
+        replica = CountingPool('replica')
+        hedging = HedgingPolicy(initial_delay=0.01)
+        client = niceredis.StrictRedis(connection_pool=primary,
+                                       replicas=[replica], hedging=hedging)
+        client.replica_selector.check()
+        start = time.time()
+        assert client.get('a') == b('foo')
+        assert time.time() - start < 1
+        assert primary.used == replica.used == 1
+        stats = hedging.stats()
+        assert (stats['reads'], stats['hedged'], stats['hedge_wins']) == \
+            (1, 1, 1)
+        # the primary's connection waiting for the reply is dropped
+        assert primary._available_connections[0]._sock is None
+
+    def test_fast_primary(self, offsets, r):
+        offsets['replica'] = replica_info(1000)
+        r.set('a', 'foo')
+        primary = CountingPool('primary')
+        replica = CountingPool('replica')
+        hedging = HedgingPolicy(initial_delay=1)
+        client = niceredis.StrictRedis(connection_pool=primary,
+                                       replicas=[replica], hedging=hedging)
+        assert client.get('a') == b('foo')
+        assert client.mget('a', 'b') == [b('foo'), None]
+        assert replica.used == 0
+        assert hedging.stats()['hedged'] == 0
+        assert primary._available_connections[0]._sock is not None
+
+    def test_wait_for_reply(self, r, monkeypatch):
+        pool = r.connection_pool
+        quiet = pool.get_connection('_')
+        busy = pool.get_connection('_')
+        quiet.connect()
+        for poll in (True, False):
+            if not poll:
+                monkeypatch.delattr(replica_module.select, 'poll',
+                                    raising=False)
+            busy.send_command('PING')
+            assert replica_module.wait_for_reply([quiet, busy], 1) is busy
+            assert busy.read_response() == b('PONG')
+            assert replica_module.wait_for_reply([quiet, busy], 0.01) is None
+        pool.release(quiet)
+        pool.release(busy)
+
+    def test_delay_from_percentile(self):
+        hedging = HedgingPolicy(percentile=50, initial_delay=1, min_delay=0,
+                                min_samples=4, update_every=4)
+        for latency in (0.4, 0.1, 0.3):
+            hedging.record(latency, False, False)
+        assert hedging.delay() == 1
+        hedging.record(0.2, True, True)
+        assert hedging.delay() == 0.3
+        assert hedging.stats() == {'reads': 4, 'hedged': 1, 'hedge_wins': 1,
+                                   'delay': 0.3}
+
+    def test_needs_replicas(self):
+        with pytest.raises(ValueError):
+            niceredis.StrictRedis(hedging=HedgingPolicy())
@@ -0,0 +1,169 @@
+import pytest
+import redis
+from redis._compat import b
+
+import niceredis
+from niceredis.client.retry import RetryPolicy
+
+from .conftest import _get_client
+
+
+def kill_connection(client, connection=None):
+    "Have the server close ``connection``, or the idle one of ``client``"
+    if connection is None:
+        connection = client.connection_pool.get_connection('_')
+        connection.connect()
+        client.connection_pool.release(connection)
+    address = '%s:%s' % connection._sock.getsockname()[:2]
+    niceredis.StrictRedis(db=9).client_kill(address)
+
+
+def fail_sending(client, times=1):
+    "Make sending fail ``times`` on the connection of ``client``"
+    connection = client.connection_pool.get_connection('_')
+    client.connection_pool.release(connection)
+    failures = [1] * times
+    send_packed_command = connection.send_packed_command
+
+    def send(command):
+        if failures:
+            failures.pop()
+            raise redis.ConnectionError('Error 32 while writing to socket')
+        return send_packed_command(command)
+    connection.send_packed_command = send
+
+
+def fail_reading(client, times=1):
+    "Make reading replies fail ``times`` on the connection of ``client``"
+    connection = client.connection_pool.get_connection('_')
+    client.connection_pool.release(connection)
+    failures = [1] * times
+    read_response = connection.read_response
+
+    def read():
+        if failures:
+            failures.pop()
+            raise redis.ConnectionError('Error while reading from socket')
+        return read_response()
+    connection.read_response = read
+
+
+class TestRetryPolicy(object):
+    def test_max_attempts(self):
+        policy = RetryPolicy(max_attempts=3)
+        assert policy.should_retry(1)
+        assert policy.should_retry(2)
+        assert not policy.should_retry(3)
+        assert RetryPolicy().should_retry(1000)
+        with pytest.raises(ValueError):
+            RetryPolicy(max_attempts=0)
+
+    def test_exponential_backoff(self):
+        policy = RetryPolicy(backoff=0.01, max_backoff=0.05, jitter=False)
+        delays = [policy.get_delay(attempt) for attempt in range(1, 6)]
+        assert delays == [0.01, 0.02, 0.04, 0.05, 0.05]
+        assert RetryPolicy().get_delay(10) == 0
+
+    def test_jitter(self):
+        policy = RetryPolicy(backoff=0.01, max_backoff=0.05)
+        for attempt in range(1, 6):
+            assert 0 <= policy.get_delay(attempt) <= 0.05
+
+    def test_retry_counts(self):
+        policy = RetryPolicy(max_attempts=2)
+        assert policy.retry(1)
+        assert not policy.retry(2)
+        assert policy.stats.get() == {'retries': 1, 'recovered': 0,
+                                      'exhausted': 1, 'unsafe': 0}
+        policy.stats.reset()
+        assert policy.stats.get()['retries'] == 0
+
+
+class TestCommandRetries(object):
+    def test_idempotent_command_retried(self, sr):
+        sr.set('a', 1)
+        kill_connection(sr)
+        assert sr.get('a') == b('1')
+        assert sr.retry_policy.stats.get() == {
+            'retries': 1, 'recovered': 1, 'exhausted': 0, 'unsafe': 0}
+
+    def test_non_idempotent_command_not_replayed(self, sr):
+        sr.set('a', 1)
+        kill_connection(sr)
+        with pytest.raises(redis.ConnectionError):
+            sr.incr('a')
+        assert sr.retry_policy.stats.get()['unsafe'] == 1
+        assert sr.get('a') == b('1')
+
+    def test_non_idempotent_options_not_replayed(self, sr):
+        sr.set('a', 1)
+        kill_connection(sr)
+        with pytest.raises(redis.ConnectionError):
+            sr.set('b', 1, nx=True)
+        kill_connection(sr)
+        assert sr.set('c', 1)
+        assert sr.retry_policy.stats.get()['unsafe'] == 1
+
+    def test_is_idempotent(self, sr):
+        assert sr.is_idempotent(('SET', 'NX', 1))
+        assert not sr.is_idempotent(('SET', 'a', 1, 'NX'))
+        assert not sr.is_idempotent(('SET', 'a', 1, 'EX', 10, 'xx'))
+        assert not sr.is_idempotent(('SET', 'a', 1, b('GET')))
+        assert not sr.is_idempotent(('ZADD', 'z', 'INCR', 1, 'm'))
+        assert not sr.is_idempotent(('SETBIT', 'a', 1, 1))
+        for args in (('DEL', 'a'), ('SADD', 's', 'm'), ('ZADD', 'z', 1, 'm'),
+                     ('HDEL', 'h', 'f'), ('PFADD', 'p', 'x')):
+            assert sr.is_idempotent(args)
+        pipe = sr.pipeline()
+        assert not pipe.is_idempotent(('SET', 'a', 1, 'NX'))
+
+    def test_unsent_command_retried(self, sr):
+        fail_sending(sr)
+        assert sr.incr('a') == 1
+        assert sr.retry_policy.stats.get()['recovered'] == 1
+
+    def test_max_attempts(self, request):
+        sr = _get_client(niceredis.StrictRedis, request,
+                         retry_policy=RetryPolicy(max_attempts=3))
+        fail_sending(sr, 2)
+        assert sr.ping()
+        fail_sending(sr, 3)
+        with pytest.raises(redis.ConnectionError):
+            sr.ping()
+        assert sr.retry_policy.stats.get() == {
+            'retries': 4, 'recovered': 1, 'exhausted': 1, 'unsafe': 0}
+
+    def test_pipeline(self, sr):
+        kill_connection(sr)
+        assert sr.pipeline().set('a', 1).get('a').execute() == \
+            [True, b('1')]
+        kill_connection(sr)
+        with pytest.raises(redis.ConnectionError):
+            sr.pipeline().incr('a').execute()
+        assert sr.get('a') == b('1')
+        assert sr.retry_policy.stats.get()['unsafe'] == 1
+
+    def test_pipeline_iter(self, request):
+        sr = _get_client(niceredis.StrictRedis, request,
+                         retry_policy=RetryPolicy(max_attempts=3))
+        sr.set('a', 1)
+        fail_reading(sr, 2)
+        pipe = sr.pipeline().set('b', 2).get('a')
+        assert list(pipe.execute_iter()) == [True, b('1')]
+        assert sr.retry_policy.stats.get() == {
+            'retries': 2, 'recovered': 1, 'exhausted': 0, 'unsafe': 0}
+        fail_reading(sr, 3)
+        with pytest.raises(redis.ConnectionError):
+            list(sr.pipeline().get('a').execute_iter())
+        assert sr.retry_policy.stats.get()['exhausted'] == 1
+
+    def test_pubsub(self, sr):
+        p = sr.pubsub(ignore_subscribe_messages=True)
+        p.subscribe('foo')
+        assert p.get_message() is None
+        kill_connection(sr, p.connection)
+        # connecting again subscribes again
+        assert p.get_message() is None
+        assert sr.publish('foo', 'x') == 1
+        assert p.get_message()['data'] == b('x')
+        assert p.retry_policy.stats.get()['recovered'] == 1
@@ -79,3 +79,14 @@ class TestScripting(object):
         assert r.script_exists(multiply.sha) == [False]
         # [SET worked, GET 'a', result of multiple script]
         assert pipe.execute() == [True, b('2'), 6]
+
+    def test_script_object_in_flushing_pipeline(self, r):
+        multiply = r.register_script(multiply_script)
+        multiply.sha = r.script_load(multiply_script)
+        # the sha is known but the server forgot the script
+        r.script_flush()
+        pipe = r.pipeline(transaction=False, flush_size=1)
+        pipe.set('a', 2)
+        multiply(keys=['a'], args=[3], client=pipe)
+        assert r.script_exists(multiply.sha) == [True]
+        assert pipe.execute() == [True, 6]
@@ -0,0 +1,151 @@
+from __future__ import with_statement
+
+import time
+
+import pytest
+from redis._compat import b
+
+import niceredis
+from niceredis.client.sentinel import MasterNotFoundError, SentinelClient
+
+
+class SentinelStub(niceredis.StrictRedis):
+    "Answers SENTINEL commands from ``state``, everything else for real"
+
+    def __init__(self, state):
+        super(SentinelStub, self).__init__(host='localhost', port=6379, db=9)
+        self.state = state
+        self.calls = 0
+
+    def sentinel_masters(self):
+        self.calls += 1
+        return dict([(name, {'ip': ip, 'port': port, 'is_master': True,
+                             'is_sdown': False, 'is_odown': False,
+                             'num-other-sentinels': 0})
+                     for name, (ip, port) in self.state['masters'].items()])
+
+    def sentinel_slaves(self, service_name):
+        self.calls += 1
+        return [{'ip': ip, 'port': port, 'is_sdown': False, 'is_odown': False}
+                for ip, port in self.state['replicas'].get(service_name, [])]
+
+
+@pytest.fixture()
+def state():
+    return {'masters': {'mymaster': ('localhost', 6379)},
+            'replicas': {'mymaster': [('127.0.0.1', 6379)]}}
+
+
+@pytest.fixture()
+def sentinel(request, state):
+    sentinel = SentinelClient([('localhost', 6379)], watch=False, db=9)
+    sentinel.sentinels = [SentinelStub(state)]
+    request.addfinalizer(sentinel.close)
+    return sentinel
+
+
+def switch_master(old, new):
+    return {'type': 'message', 'pattern': None, 'channel': b('+switch-master'),
+            'data': b('mymaster %s %s %s %s' % (old + new))}
+
+
+class TestSentinelClient(object):
+    def test_discovers_and_caches_master(self, sentinel):
+        assert sentinel.master_address('mymaster') == ('localhost', 6379)
+        assert sentinel.master_address('mymaster') == ('localhost', 6379)
+        assert sentinel.sentinels[0].calls == 1
+
+    def test_master_not_found(self, sentinel):
+        with pytest.raises(MasterNotFoundError):
+            sentinel.master_address('other')
+        assert sentinel.master_address('other', discover=False) is None
+
+    def test_master_for(self, sentinel):
+        master = sentinel.master_for('mymaster')
+        master.set('a', 1)
+        assert master.get('a') == b('1')
+        connection = master.connection_pool.get_connection('_')
+        assert (connection.host, connection.port) == ('localhost', 6379)
+
+    def test_replica_for(self, sentinel):
+        replica = sentinel.replica_for('mymaster')
+        assert replica.ping()
+        connection = replica.connection_pool.get_connection('_')
+        assert (connection.host, connection.port) == ('127.0.0.1', 6379)
+
+    def test_replica_falls_back_to_master(self, sentinel, state):
+        state['replicas'] = {}
+        replica = sentinel.replica_for('mymaster')
+        assert replica.ping()
+        connection = replica.connection_pool.get_connection('_')
+        assert (connection.host, connection.port) == ('localhost', 6379)
+
+    def test_switch_master_drops_failed_node_only(self, sentinel):
+        master = sentinel.master_for('mymaster')
+        replica = sentinel.replica_for('mymaster')
+        master_pool = master.connection_pool
+        replica_pool = replica.connection_pool
+        idle = master_pool.get_connection('_')
+        in_use = master_pool.get_connection('_')
+        replica_connection = replica_pool.get_connection('_')
+        for connection in (idle, in_use, replica_connection):
+            connection.connect()
+        master_pool.release(idle)
+        replica_pool.release(replica_connection)
+
+        sentinel.on_switch_master(
+            switch_master(('localhost', 6379), ('127.0.0.1', 6379)))
+
+        assert sentinel.master_address('mymaster', discover=False) == \
+            ('127.0.0.1', 6379)
+        assert idle._sock is None
+        # in use, disconnected once released
+        assert in_use._sock is not None
+        master_pool.release(in_use)
+        assert in_use._sock is None
+        assert replica_connection._sock is not None
+        # new connections go to the new master
+        connection = master_pool.get_connection('_')
+        connection.connect()
+        assert (connection.host, connection.port) == ('127.0.0.1', 6379)
+
+    def test_replica_down_drops_its_connections(self, sentinel):
+        replica = sentinel.replica_for('mymaster')
+        pool = replica.connection_pool
+        connection = pool.get_connection('_')
+        connection.connect()
+        pool.release(connection)
+        sentinel.on_instance_event({
+            'type': 'message', 'pattern': None, 'channel': b('+sdown'),
+            'data': b('slave 127.0.0.1:6379 127.0.0.1 6379 '
+                      '@ mymaster localhost 6379')})
+        assert connection._sock is None
+        assert sentinel.replica_addresses('mymaster', discover=False) is None
+
+    def test_rediscovers_when_cached_master_is_unreachable(self, sentinel,
+                                                           state):
+        state['masters']['mymaster'] = ('localhost', 16379)
+        master = sentinel.master_for('mymaster')
+        assert sentinel.master_address('mymaster') == ('localhost', 16379)
+        # failover happened while we weren't watching
+        state['masters']['mymaster'] = ('localhost', 6379)
+        assert master.ping()
+        assert sentinel.master_address('mymaster') == ('localhost', 6379)
+
+    def test_watches_switch_master_events(self, request, state, r):
+        sentinel = SentinelClient([('localhost', 6379)], db=9)
+        sentinel.sentinels = [SentinelStub(state)]
+        request.addfinalizer(sentinel.close)
+        sentinel.master_for('mymaster')
+        for _ in range(50):
+            if r.execute_command('PUBSUB NUMSUB', '+switch-master')[1]:
+                break
+            time.sleep(0.01)
+        assert sentinel.master_address('mymaster') == ('localhost', 6379)
+
+        r.publish('+switch-master', 'mymaster localhost 6379 127.0.0.1 6379')
+        for _ in range(50):
+            if sentinel.master_address('mymaster') != ('localhost', 6379):
+                break
+            time.sleep(0.01)
+        assert sentinel.master_address('mymaster') == ('127.0.0.1', 6379)
@@ -0,0 +1,212 @@
+from multiprocessing.pool import RUN
+
+import pytest
+import redis
+from redis._compat import b
+
+import niceredis
+from niceredis.client.retry import RetryPolicy
+from niceredis.client.sharded import HashRing, ShardedRedis
+
+from .conftest import _get_client
+
+
+@pytest.fixture()
+def shr(request):
+    # databases of the test server stand in for the shards
+    shards = dict([(name, _get_client(niceredis.StrictRedis, request, db=db))
+                   for name, db in (('a', 9), ('b', 10), ('c', 11))])
+    return ShardedRedis(shards)
+
+
+def keys_on_different_shards(client, count=3):
+    keys, names = [], set()
+    i = 0
+    while len(keys) < count:
+        key = 'key%d' % i
+        if client.get_shard_name(key) not in names:
+            names.add(client.get_shard_name(key))
+            keys.append(key)
+        i += 1
+    return keys
+
+
+class TestKeyPositions(object):
+    def test_key_positions(self, r):
+        assert r.get_key_positions(('GET', 'a')) == [1]
+        assert r.get_key_positions(('MSET', 'a', 1, 'b', 2)) == [1, 3]
+        assert r.get_key_positions(('BLPOP', 'a', 'b', 0)) == [1, 2]
+        assert r.get_key_positions(('BITOP', 'AND', 'd', 'a')) == [2, 3]
+        assert r.get_key_positions(('PING',)) == []
+        assert r.get_key_positions(('OBJECT', 'encoding', 'a')) == [2]
+
+    def test_numkeys(self, r):
+        assert r.get_key_positions(('EVALSHA', 'sha', 2, 'a', 'b', 1)) == \
+            [3, 4]
+        assert r.get_key_positions(
+            ('ZUNIONSTORE', 'd', 2, 'a', 'b', 'WEIGHTS', 1, 2)) == [1, 3, 4]
+
+
+class TestHashRing(object):
+    def test_spreads_keys(self):
+        ring = HashRing(['a', 'b', 'c'])
+        counts = {'a': 0, 'b': 0, 'c': 0}
+        for i in range(3000):
+            counts[ring.get_node(b('key%d' % i))] += 1
+        assert min(counts.values()) > 700
+
+    def test_adding_a_node_moves_few_keys(self):
+        ring = HashRing(['a', 'b', 'c'])
+        before = [ring.get_node(b('key%d' % i)) for i in range(3000)]
+        ring.add_node('d')
+        after = [ring.get_node(b('key%d' % i)) for i in range(3000)]
+        moved = [(x, y) for x, y in zip(before, after) if x != y]
+        assert set(y for x, y in moved) == set(['d'])
+        assert len(moved) < 1200
+
+    def test_removing_a_node(self):
+        ring = HashRing(['a', 'b'])
+        ring.remove_node('a')
+        assert ring.get_node(b('foo')) == 'b'
+        ring.remove_node('b')
+        with pytest.raises(redis.RedisError):
+            ring.get_node(b('foo'))
+
+
+class TestShardedRedis(object):
+    def test_routes_by_key(self, shr):
+        for key in keys_on_different_shards(shr):
+            shr.set(key, 'value')
+            assert shr.get(key) == b('value')
+            assert shr.get_shard(key).get(key) == b('value')
+        assert shr.dbsize() == 3
+
+    def test_commands_of_all_mixins(self, shr):
+        shr.hset('h', 'f', 1)
+        shr.rpush('l', 1, 2)
+        shr.sadd('s', 1)
+        shr.zadd('z', a=1)
+        assert shr.get_shard('h').hgetall('h') == {b('f'): b('1')}
+        assert shr.get_shard('l').lrange('l', 0, -1) == [b('1'), b('2')]
+        assert shr.get_shard('s').smembers('s') == set([b('1')])
+        assert shr.get_shard('z').zrange('z', 0, -1) == [b('a')]
+
+    def test_hash_tags(self, shr):
+        assert len(set(shr.get_shard_name('{user1}.%d' % i)
+                       for i in range(20))) == 1
+        shr.sadd('{user1}.a', 1, 2)
+        shr.sadd('{user1}.b', 2, 3)
+        assert shr.sinter('{user1}.a', '{user1}.b') == set([b('2')])
+
+    def test_mget_mset_delete_across_shards(self, shr):
+        keys = keys_on_different_shards(shr)
+        assert shr.mset(dict([(key, key.upper()) for key in keys]))
+        assert shr.mget(list(reversed(keys)) + ['missing']) == \
+            [b(key.upper()) for key in reversed(keys)] + [None]
+        assert shr.delete(*keys) == 3
+        assert shr.mget(keys) == [None, None, None]
+
+    def test_other_multi_key_commands_across_shards(self, shr):
+        keys = keys_on_different_shards(shr, 2)
+        with pytest.raises(redis.RedisError):
+            shr.sinter(*keys)
+
+    def test_keyless_commands(self, shr):
+        keys = keys_on_different_shards(shr)
+        for key in keys:
+            shr.set(key, 1)
+        assert sorted(shr.keys()) == sorted([b(key) for key in keys])
+        assert sorted(shr.scan_iter()) == sorted([b(key) for key in keys])
+        assert shr.ping()
+        assert sorted(shr.echo('x').keys()) == ['a', 'b', 'c']
+        assert shr.flushdb()
+        assert shr.dbsize() == 0
+
+    def test_scripts(self, shr):
+        script = shr.register_script("return redis.call('GET', KEYS[1])")
+        for key in keys_on_different_shards(shr):
+            shr.set(key, key)
+            assert script(keys=[key]) == b(key)
+
+    def test_lock(self, shr):
+        lock = shr.lock('lock')
+        assert lock.acquire(blocking=False)
+        assert shr.get_shard('lock').get('lock') is not None
+        lock.release()
+
+    def test_shard_names_from_list(self, request):
+        client = ShardedRedis([('localhost', 6379)], db=9)
+        assert list(client.shards) == [0]
+        assert client.shards[0].connection_pool.connection_kwargs['db'] == 9
+
+    def test_pipeline_across_shards(self, shr):
+        keys = keys_on_different_shards(shr)
+        pipe = shr.pipeline()
+        for key in keys:
+            pipe.set(key, key)
+        for key in reversed(keys):
+            pipe.get(key)
+        pipe.sadd('{s}a', 1, 2).sadd('{s}b', 2).sinter('{s}a', '{s}b')
+        assert len(pipe) == 9
+        assert pipe.execute() == [True] * 3 + \
+            [b(key) for key in reversed(keys)] + [2, 1, set([b('2')])]
+        assert len(pipe) == 0
+        assert pipe.execute() == []
+
+    def test_pipeline_class_reused(self, shr):
+        assert shr.pipeline().__class__ is shr.pipeline().__class__
+
+    def test_pipeline_errors(self, shr):
+        keys = keys_on_different_shards(shr)
+        pipe = shr.pipeline()
+        with pytest.raises(redis.RedisError):
+            pipe.sinter(*keys)
+        pipe.set(keys[0], 'x').get(keys[1]).incr(keys[0]).get(keys[0])
+        with pytest.raises(redis.ResponseError) as ex:
+            pipe.execute()
+        # numbered in the order of the whole pipeline
+        assert str(ex.value).startswith('Command # 3 (INCRBY %s 1) of '
+                                        'pipeline caused error: ' % keys[0])
+        pipe.incr(keys[0]).get(keys[0])
+        result = pipe.execute(raise_on_error=False)
+        assert isinstance(result[0], redis.ResponseError)
+        assert result[1] == b('x')
+
+    def test_transactions_need_a_shard(self, shr):
+        with pytest.raises(redis.RedisError):
+            shr.pipeline(transaction=True)
+        pipe = shr.get_shard('foo').pipeline()
+        pipe.set('foo', 1).get('foo')
+        assert pipe.execute() == [True, b('1')]
+
+    def test_executor_grows_with_the_shards(self, shr, request):
+        keys = keys_on_different_shards(shr)
+        shr.mset(dict.fromkeys(keys, 1))
+        assert shr._executor_size == 3
+        # still used by a call running on another thread
+        executor = shr._acquire_executor()
+        shr.add_shard('d', _get_client(niceredis.StrictRedis, request, db=12))
+        assert shr.mget(keys) == [b('1')] * 3
+        assert shr._executor is not executor
+        assert shr._executor_size == 4
+        assert executor.map(abs, [-1, -2]) == [1, 2]
+        shr._release_executor(executor)
+        assert executor._state != RUN
+        assert shr._executor_users == {shr._executor: 0}
+        # kept once a shard is removed
+        shr.remove_shard('d')
+        shr.mget(keys)
+        assert shr._executor_size == 4
+
+    def test_client_state(self):
+        policy = RetryPolicy(max_attempts=3)
+        client = ShardedRedis([('localhost', 6379)], retry_policy=policy,
+                              protocol=3)
+        assert client.retry_policy is policy
+        assert client.shards[0].retry_policy is policy
+        assert client.protocol == 3
+        assert client.transaction_stats.get('a')['transactions'] == 0
+        assert not client.is_idempotent(('INCRBY', 'a', 1))
+        assert not client.is_idempotent(('SET', 'a', 1, 'NX'))
+        assert client.is_idempotent(('SET', 'a', 1))
+        assert ShardedRedis([('localhost', 6379)]).protocol == 2
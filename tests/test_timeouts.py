@@ -0,0 +1,73 @@
+import time
+
+import pytest
+import redis
+from redis._compat import b
+
+import niceredis
+from niceredis.client.retry import RetryPolicy
+from niceredis.connection import CircuitBreaker, get_deadline
+
+from .conftest import _get_client
+
+
+def idle_connection(client):
+    connection = client.connection_pool.get_connection('_')
+    client.connection_pool.release(connection)
+    return connection
+
+
+class TestDeadlines(object):
+    def test_get_deadline(self):
+        assert get_deadline() is None
+        assert get_deadline(deadline=5) == 5
+        now = time.time()
+        assert now + 1 <= get_deadline(timeout=1) <= time.time() + 1
+        assert get_deadline(timeout=1, deadline=now) == now
+        assert get_deadline(timeout=-1, deadline=now + 10) < now
+
+    def test_timeout(self, sr):
+        start = time.time()
+        with pytest.raises(redis.TimeoutError):
+            sr.execute_command('BLPOP', 'a', 1, timeout=0.05)
+        assert time.time() - start < 0.5
+        # the connection's own timeout is back
+        assert sr.execute_command('RPUSH', 'a', 1, timeout=1) == 1
+        connection = idle_connection(sr)
+        assert connection.socket_timeout is None
+        assert connection._sock.gettimeout() is None
+        assert sr.blpop('a', 1) == (b('a'), b('1'))
+
+    def test_deadline_passed(self, sr):
+        with pytest.raises(redis.TimeoutError):
+            sr.execute_command('GET', 'a', deadline=time.time() - 1)
+        assert sr.execute_command('GET', 'a',
+                                  deadline=time.time() + 5) is None
+
+    def test_retries_stop_at_the_deadline(self, request):
+        sr = _get_client(niceredis.StrictRedis, request,
+                         retry_on_timeout=True,
+                         retry_policy=RetryPolicy(max_attempts=10))
+        start = time.time()
+        with pytest.raises(redis.TimeoutError):
+            # waits a second for a replica that doesn't exist
+            sr.execute_command('WAIT', 1, 1000, timeout=0.05)
+        assert time.time() - start < 0.5
+        assert sr.retry_policy.stats.get()['retries'] == 1
+
+    def test_pipeline(self, sr):
+        pipe = sr.pipeline(transaction=False)
+        pipe.blpop('a', 1)
+        with pytest.raises(redis.TimeoutError):
+            pipe.execute(timeout=0.05)
+        pipe.rpush('a', 1).blpop('a', 1)
+        assert pipe.execute(deadline=time.time() + 1) == \
+            [1, (b('a'), b('1'))]
+
+    def test_deadline_timeouts_dont_trip_the_breaker(self, request):
+        breaker = CircuitBreaker(failure_threshold=1)
+        sr = _get_client(niceredis.StrictRedis, request,
+                         circuit_breaker=breaker)
+        with pytest.raises(redis.TimeoutError):
+            sr.execute_command('BLPOP', 'a', 1, timeout=0.05)
+        assert breaker.state == 'closed'
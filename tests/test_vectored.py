@@ -0,0 +1,48 @@
+from redis._compat import b
+
+from niceredis.connection import coalesce, pack_buffers
+
+
+class TestVectoredWrites(object):
+    def test_coalesce(self):
+        large = b('x') * 20000
+        buffers = coalesce([b('a'), b('b'), large, b('c') * 9000,
+                            b('d') * 9000, b('e')])
+        assert buffers == [b('ab'), large, b('c') * 9000 + b('d') * 9000,
+                           b('e')]
+        # not copied
+        assert buffers[1] is large
+
+    def test_pack_buffers_keeps_large_values(self, r):
+        connection = r.connection_pool.get_connection('_')
+        value = b('v') * 100000
+        buffers = pack_buffers(connection, [('SET', 'a', value),
+                                            ('GET', 'a')])
+        assert value in buffers
+        assert b('').join(buffers) == b('').join(
+            connection.pack_commands([('SET', 'a', value), ('GET', 'a')]))
+        r.connection_pool.release(connection)
+
+    def test_send_packed_buffers(self, r):
+        connection = r.connection_pool.get_connection('_')
+        connection.send_packed_command(
+            pack_buffers(connection, [('PING',)] * 3))
+        assert [connection.read_response() for _ in range(3)] == \
+            [b('PONG')] * 3
+        r.connection_pool.release(connection)
+
+    def test_pipelines_with_large_values(self, r):
+        values = [b(str(i)) * (1024 * 1024) for i in range(3)]
+        for transaction in (True, False):
+            pipe = r.pipeline(transaction=transaction)
+            for i, value in enumerate(values):
+                pipe.set(i, value)
+                pipe.hset('h', i, value)
+            pipe.get(1).hget('h', 2)
+            assert pipe.execute()[-2:] == values[1:]
+
+    def test_flushing_pipeline_with_large_values(self, r):
+        value = b('v') * (1024 * 1024)
+        with r.pipeline(transaction=False, flush_size=1) as pipe:
+            pipe.set('a', value).set('b', 'small').get('a')
+            assert pipe.execute() == [True, True, value]